@@ -1,24 +1,352 @@
-from backend.core.database import Neo4jConnector
+import os
+import csv
+import json
+import time
+import codecs
+import asyncio
+from backend.core import graph_store
+from backend.core.region import default_region
+from backend.core.metrics import timed
+
+FORMATS = {"text/csv": "csv", "application/x-ndjson": "ndjson", "application/ndjson": "ndjson",
+           "application/jsonl": "ndjson", "application/json": "json"}
+TRUE = {"1", "true", "yes", "y", "t"}
+FALSE = {"0", "false", "no", "n", "f", ""}
+
 
 class AdminManager:
-    def __init__(self):
-        self.db = Neo4jConnector()
+    ev_query = """
+    UNWIND $batch AS data
+    MERGE (ev:EVPoint {id: data.id})
+    SET ev.location = point({latitude: data.lat, longitude: data.lon}),
+        ev.lat = data.lat,
+        ev.lon = data.lon,
+        ev.charger_type = data.charger_type,
+        ev.sockets = data.sockets,
+        ev.provider = data.provider
+    """
+    bike_hub_query = """
+    UNWIND $batch AS data
+    MERGE (bh:BikeHub {id: data.id})
+    SET bh.location = point({latitude: data.lat, longitude: data.lon}),
+        bh.lat = data.lat,
+        bh.lon = data.lon,
+        bh.capacity = data.capacity,
+        bh.has_ebikes = data.has_ebikes
+    """
+
+    def __init__(self, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
 
     def add_ev_point(self, data):
-        query = """
-        MERGE (ev:EVPoint {id: $id})
-        SET ev.location = point({latitude: $lat, longitude: $lon}),
-            ev.charger_type = $charger_type,
-            ev.sockets = $sockets,
-            ev.provider = $provider
-        """
-        self.db.write(query, data)
+        self.write_ev_points([ev_point(data)])
 
     def add_bike_hub(self, data):
-        query = """
-        MERGE (bh:BikeHub {id: $id})
-        SET bh.location = point({latitude: $lat, longitude: $lon}),
-            bh.capacity = $capacity,
-            bh.has_ebikes = $has_ebikes
-        """
-        self.db.write(query, data)
+        self.write_bike_hubs([bike_hub(data)])
+
+    def write_ev_points(self, batch):
+        # One transaction per batch, so a failed batch leaves nothing half-written.
+        with timed("admin.ev_points", rows=len(batch)):
+            self.db.write_tx(self.ev_query, {"batch": batch})
+
+    def write_bike_hubs(self, batch):
+        with timed("admin.bike_hubs", rows=len(batch)):
+            self.db.write_tx(self.bike_hub_query, {"batch": batch})
+
+
+def _text(record, name, required=False):
+    value = record.get(name)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        if required:
+            raise ValueError(f"missing {name}")
+        return None
+    return str(value).strip()
+
+
+def _number(record, name, lo, hi):
+    value = record.get(name)
+    if value is None or value == "":
+        raise ValueError(f"missing {name}")
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} is not a number: {value!r}")
+    if not lo <= value <= hi:
+        raise ValueError(f"{name} out of range: {value}")
+    return value
+
+
+def _count(record, name):
+    value = record.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} is not an integer: {value!r}")
+    if number != int(number) or number < 0:
+        raise ValueError(f"{name} is not a non-negative integer: {value!r}")
+    return int(number)
+
+
+def _flag(record, name):
+    value = record.get(name)
+    if isinstance(value, bool) or value is None:
+        return bool(value)
+    text = str(value).strip().lower()
+    if text in TRUE:
+        return True
+    if text in FALSE:
+        return False
+    raise ValueError(f"{name} is not a boolean: {value!r}")
+
+
+def ev_point(record):
+    # Normalised EVPoint row, or ValueError naming the first bad field.
+    return {"id": _text(record, "id", required=True), "lat": _number(record, "lat", -90, 90),
+            "lon": _number(record, "lon", -180, 180), "charger_type": _text(record, "charger_type"),
+            "sockets": _count(record, "sockets"), "provider": _text(record, "provider")}
+
+
+def bike_hub(record):
+    return {"id": _text(record, "id", required=True), "lat": _number(record, "lat", -90, 90),
+            "lon": _number(record, "lon", -180, 180), "capacity": _count(record, "capacity"),
+            "has_ebikes": _flag(record, "has_ebikes")}
+
+
+def body_format(content_type):
+    return FORMATS.get((content_type or "application/json").split(";")[0].strip().lower())
+
+
+async def _lines(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def _csv_records(chunks):
+    # A quoted field may hold newlines, so lines are joined until their quotes balance; escaped quotes ("")
+    # come in pairs and never change the balance.
+    pending = None
+    async for line in _lines(chunks):
+        pending = line if pending is None else pending + "\n" + line
+        if pending.count('"') % 2 == 0:
+            yield pending
+            pending = None
+    if pending is not None:
+        yield pending
+
+
+async def _json_array(chunks):
+    # Decodes one array element at a time, so the body is never held as a whole.
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    parser = json.JSONDecoder()
+    buffer, opened, closed, pos = "", False, False, 0
+    final = False
+    stream = chunks.__aiter__()
+    while not closed:
+        try:
+            buffer = buffer[pos:] + decoder.decode(await stream.__anext__())
+        except StopAsyncIteration:
+            buffer, final = buffer[pos:] + decoder.decode(b"", final=True), True
+        pos = 0
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or (opened and buffer[pos] == ",")):
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not opened:
+                if buffer[pos] != "[":
+                    raise ValueError("Body is not a JSON array.")
+                opened, pos = True, pos + 1
+                continue
+            if buffer[pos] == "]":
+                closed = True
+                break
+            try:
+                item, pos = parser.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if final:
+                    raise ValueError(f"Invalid JSON: {e}")
+                break
+            yield item
+        if final and not closed:
+            raise ValueError("Truncated JSON array.")
+
+
+async def records(chunks, fmt):
+    # Yields (row number, record dict or None, error or None) from a streamed CSV, NDJSON or JSON body.
+    if fmt == "csv":
+        header, row = None, 0
+        async for line in _csv_records(chunks):
+            if not line.strip():
+                continue
+            try:
+                values = next(csv.reader([line], strict=True))
+            except csv.Error as e:
+                row += 1
+                yield row, None, f"invalid CSV: {e}"
+                continue
+            if header is None:
+                header = [h.strip().lower() for h in values]
+                continue
+            row += 1
+            if len(values) != len(header):
+                yield row, None, f"expected {len(header)} columns, got {len(values)}"
+            else:
+                yield row, dict(zip(header, values)), None
+    elif fmt == "ndjson":
+        row = 0
+        async for line in _lines(chunks):
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                yield row, json.loads(line), None
+            except json.JSONDecodeError as e:
+                yield row, None, f"invalid JSON: {e}"
+    else:
+        row = 0
+        async for item in _json_array(chunks):
+            row += 1
+            yield row, item, None
+
+
+class BulkImport:
+    # One bulk import: validates rows as they stream in, writes them per region in UNWIND batches of
+    # IMPORT_BATCH_SIZE (one batch in flight while the next is parsed). Written rows of regions loaded here
+    # are handed to the region's router once, at the end of the import; other workers are told through the
+    # store version. Bike hubs are only read from Neo4j, so they stop there.
+    kinds = {"ev_points": (ev_point, "write_ev_points", "upsert_evs"),
+             "bike_hubs": (bike_hub, "write_bike_hubs", None)}
+
+    def __init__(self, kind, regions, batch_size=None, max_errors=None):
+        self.validate, self.writer, self.updater = self.kinds[kind]
+        self.kind = kind
+        self.regions = regions
+        self.batch_size = batch_size or int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+        self.max_errors = max_errors or int(os.getenv("IMPORT_MAX_ERRORS", "100"))
+        self.managers = {}
+        self.batches = {}
+        self.written = {}
+        self.updates = {}
+        self.apply_seconds = 0.0
+        self.rows = 0
+        self.failed = 0
+        self.errors = []
+        self.batch_count = 0
+        self.pending = None
+
+    def error(self, rows, message):
+        self.failed += len(rows)
+        for row in rows:
+            if len(self.errors) < self.max_errors:
+                self.errors.append({"row": row, "error": message})
+
+    def add(self, row, record, problem=None):
+        self.rows += 1
+        if problem is None:
+            try:
+                if not isinstance(record, dict):
+                    raise ValueError("not an object")
+                record = self.validate(record)
+            except ValueError as e:
+                problem = str(e)
+        if problem is None:
+            region = self.regions.index.locate([(record["lat"], record["lon"])])
+            if region is None:
+                problem = "outside every configured region"
+        if problem is not None:
+            self.error([row], problem)
+            return None
+        batch = self.batches.setdefault(region.name, [])
+        batch.append((row, record))
+        return region.name if len(batch) >= self.batch_size else None
+
+    async def flush(self, name):
+        batch = self.batches.pop(name, [])
+        if not batch:
+            return
+        await self.wait()
+        manager = self.managers.get(name)
+        if manager is None:
+            manager = self.managers[name] = AdminManager(self.regions.regions[name])
+        write = getattr(manager, self.writer)
+        self.pending = (name, batch, asyncio.create_task(asyncio.to_thread(write, [r for _, r in batch])))
+
+    async def wait(self):
+        if self.pending is None:
+            return
+        name, batch, task = self.pending
+        self.pending = None
+        self.batch_count += 1
+        try:
+            await task
+        except Exception as e:
+            self.error([row for row, _ in batch], f"batch write failed: {e}")
+            return
+        self.written[name] = self.written.get(name, 0) + len(batch)
+        if self.updater is not None and name in self.regions.loaded():
+            # Only the fields the router reads are kept until the end of the import.
+            self.updates.setdefault(name, []).extend(
+                {"id": r["id"], "lat": r["lat"], "lon": r["lon"], "charger_type": r["charger_type"]} for _, r in batch)
+
+    async def apply(self):
+        # One router update per region rather than per batch: each rebuilds the region's charger index.
+        loaded = self.regions.loaded()
+        for name, updates in self.updates.items():
+            router = loaded.get(name)
+            if router is not None:
+                started = time.time()
+                await asyncio.to_thread(getattr(router, self.updater), updates)
+                self.apply_seconds += time.time() - started
+        self.updates = {}
+
+    def announce(self):
+        # Other workers reload the region's chargers from Neo4j on their next sync.
+        loaded = self.regions.loaded()
+        for name, count in self.written.items():
+            if count:
+                n = graph_store.bump_version(self.regions.regions[name].store_dir(), "evs")
+                if name in loaded:
+                    loaded[name].announced("evs", n)
+
+    async def run(self, chunks, fmt):
+        started = time.time()
+        try:
+            async for row, record, problem in records(chunks, fmt):
+                full = self.add(row, record, problem)
+                if full is not None:
+                    await self.flush(full)
+        except ValueError as e:
+            # A malformed JSON array stops the import; rows already batched are still written.
+            self.error([self.rows + 1], str(e))
+        for name in list(self.batches):
+            await self.flush(name)
+        await self.wait()
+        if self.updater is not None:
+            await self.apply()
+            await asyncio.to_thread(self.announce)
+        written = sum(self.written.values())
+        seconds = time.time() - started
+        return {
+            "kind": self.kind,
+            "rows": self.rows,
+            "written": written,
+            "failed": self.failed,
+            "batches": self.batch_count,
+            "regions": dict(self.written),
+            "seconds": round(seconds, 3),
+            "apply_seconds": round(self.apply_seconds, 3),
+            "rows_per_s": round(written / seconds, 1) if seconds > 0 else None,
+            "errors": self.errors,
+        }
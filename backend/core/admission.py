@@ -0,0 +1,191 @@
+import os
+import math
+import time
+import asyncio
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Deadline of the request being served; asyncio.to_thread copies the context, so the search loops
+# running in worker threads and the Neo4j connectors see it without it being passed down.
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+# Admission classes: routing modes, plus matrices and isochrones, which cost far more than one route.
+KINDS = ("transit", "walk", "drive", "ev", "matrix", "isochrone", "other")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Overloaded(Exception):
+    def __init__(self, mode, retry_after):
+        super().__init__(f"Too many '{mode}' requests in flight, retry in {retry_after}s.")
+        self.mode = mode
+        self.retry_after = retry_after
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.at = time.monotonic() + seconds
+        self.cancelled = False
+
+    def remaining(self):
+        return 0.0 if self.cancelled else max(self.at - time.monotonic(), 0.0)
+
+    def cancel(self):
+        # Worker threads cannot be interrupted; they stop at their next check instead.
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled or time.monotonic() >= self.at:
+            raise DeadlineExceeded(f"Deadline of {self.seconds:g}s exceeded.")
+
+
+def current():
+    # The running request's Deadline, or None outside one (ingestion, preloading, benchmarks).
+    return _deadline.get()
+
+
+@contextmanager
+def deadline(seconds):
+    token = _deadline.set(Deadline(seconds))
+    try:
+        yield _deadline.get()
+    finally:
+        _deadline.reset(token)
+
+
+def _limit(mode, default):
+    return int(os.getenv(f"ADMISSION_LIMIT_{mode.upper()}", str(default)))
+
+
+class _Mode:
+    def __init__(self, limit):
+        self.limit = limit
+        self.slots = asyncio.Semaphore(limit)
+        self.running = 0
+        self.waiting = 0
+        self.service = 0.0  # moving average of seconds per request, for Retry-After
+        self.counts = {"admitted": 0, "completed": 0, "shed": 0, "timeouts": 0, "cancelled": 0, "errors": 0}
+
+
+class AdmissionController:
+    # Per-mode concurrency limits: ADMISSION_LIMIT requests of a mode run at once (ADMISSION_LIMIT_<MODE>
+    # overrides it) and up to ADMISSION_QUEUE more wait for a slot. Beyond that, or when the wait would
+    # outlast the deadline, requests are shed with a Retry-After estimated from the queue depth.
+    def __init__(self, limit=None, queue=None, timeout=None, poll=None):
+        self.limit = limit or int(os.getenv("ADMISSION_LIMIT", "32"))
+        self.queue = queue if queue is not None else int(os.getenv("ADMISSION_QUEUE", "64"))
+        self.timeout = timeout or float(os.getenv("REQUEST_TIMEOUT", "15"))
+        self.poll = poll or float(os.getenv("DISCONNECT_POLL", "0.25"))
+        self.modes = {}
+        self.lock = threading.Lock()
+
+    def _mode(self, mode):
+        state = self.modes.get(mode)
+        if state is None:
+            state = self.modes[mode] = _Mode(_limit(mode, self.limit))
+        return state
+
+    def _count(self, state, name):
+        with self.lock:
+            state.counts[name] += 1
+
+    def retry_after(self, state):
+        # Time for the queue ahead to drain at the current service rate, at least a second.
+        return max(1, math.ceil((state.waiting + 1) * max(state.service, 0.1) / state.limit))
+
+    def deadline(self, requested=None):
+        # Clients may ask for less than REQUEST_TIMEOUT, never for more; NaN and infinity are ignored.
+        try:
+            seconds = float(requested)
+        except (TypeError, ValueError):
+            seconds = self.timeout
+        if not math.isfinite(seconds):
+            seconds = self.timeout
+        seconds = min(max(seconds, 0.1), self.timeout)
+        return Deadline(seconds)
+
+    async def run(self, mode, work, request=None, timeout=None):
+        # Runs work() under the mode's limit and a deadline; cancels it on expiry or client disconnect.
+        mode = mode if mode in KINDS else "other"
+        state = self._mode(mode)
+        limit = self.deadline(timeout)
+        if not state.slots.locked():
+            await state.slots.acquire()  # a free slot is taken without yielding
+        elif state.waiting >= self.queue:
+            self._count(state, "shed")
+            raise Overloaded(mode, self.retry_after(state))
+        else:
+            state.waiting += 1
+            try:
+                await asyncio.wait_for(state.slots.acquire(), limit.remaining())
+            except asyncio.TimeoutError:
+                self._count(state, "shed")
+                raise Overloaded(mode, self.retry_after(state))
+            finally:
+                state.waiting -= 1
+        self._count(state, "admitted")
+        state.running += 1
+        started = time.monotonic()
+        token = _deadline.set(limit)
+        try:
+            return await self._watch(state, limit, work, request)
+        finally:
+            _deadline.reset(token)
+            state.running -= 1
+            state.service += 0.2 * (time.monotonic() - started - state.service)
+            state.slots.release()
+
+    async def _watch(self, state, limit, work, request):
+        task = asyncio.ensure_future(work())
+        watcher = asyncio.ensure_future(self._disconnected(request)) if request is not None else None
+        try:
+            done, _ = await asyncio.wait({task, watcher} - {None}, timeout=limit.remaining(),
+                                         return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            limit.cancel()
+            task.cancel()
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        if task not in done:
+            # Cancelling the task closes any Bolt connection mid-query; threads stop at their next check.
+            limit.cancel()
+            task.cancel()
+            if watcher in done:
+                self._count(state, "cancelled")
+                raise ClientDisconnected()
+            self._count(state, "timeouts")
+            raise DeadlineExceeded(f"Deadline of {limit.seconds:g}s exceeded.")
+        try:
+            result = task.result()
+        except DeadlineExceeded:
+            self._count(state, "timeouts")
+            raise
+        except Exception:
+            self._count(state, "errors")
+            raise
+        self._count(state, "completed")
+        return result
+
+    async def _disconnected(self, request):
+        try:
+            while not await request.is_disconnected():
+                await asyncio.sleep(self.poll)
+        except Exception:
+            # Disconnects cannot be seen on this transport; the deadline still applies.
+            await asyncio.get_running_loop().create_future()
+
+    def stats(self):
+        with self.lock:
+            return {mode: {**state.counts, "running": state.running, "waiting": state.waiting,
+                           "limit": state.limit, "service_s": round(state.service, 4)}
+                    for mode, state in self.modes.items()}
@@ -1,19 +1,44 @@
 import os
-import requests
+import fcntl
 import zipfile
 from backend.ingestion.osm_loader import OSMLoader
 from backend.ingestion.gtfs_loader import GTFSLoader
+from backend.ingestion.ch_builder import CHBuilder
+from backend.ingestion.graph_exporter import GraphExporter
+from backend.ingestion.refresh import FeedRefresher, download
 from backend.core.database import Neo4jConnector
+from backend.core.projection import ProjectionManager
+from backend.core.region import default_region
 
 class Bootstrapper:
-    def __init__(self):
-        self.db = Neo4jConnector()
-        self.gtfs_url = os.getenv("HYDERABAD_GTFS_URL", "https://storage.googleapis.com/tumi-transit-data/hyderabad/hyderabad_gtfs.zip")
-        self.data_dir = "/app/data"
+    def __init__(self, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
+        self.gtfs_url = self.region.gtfs_url
+        self.data_dir = self.region.data_dir
+        # INGEST_REFRESH=1 applies feed changes to an already loaded database on startup.
+        self.refresh_on_start = os.getenv("INGEST_REFRESH", "0") == "1"
         os.makedirs(self.data_dir, exist_ok=True)
 
     def run(self):
-        print("Bootstrapper: Running system validation and ingestion...")
+        # Every uvicorn worker runs startup; the first one to take the lock ingests and exports.
+        return self._locked(self._run)
+
+    def refresh(self):
+        return self._locked(FeedRefresher(self.region).run)
+
+    def _locked(self, work):
+        with open(os.path.join(self.data_dir, ".bootstrap.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return work()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _run(self):
+        print(f"Bootstrapper: Running system validation and ingestion for region '{self.region.name}'...")
+        if self.region.database:
+            self._create_database(self.region.database)
         
         is_empty = self.db.query("MATCH (n) RETURN count(n) as c")[0]["c"] == 0
         
@@ -30,45 +55,47 @@ class Bootstrapper:
             for q in constraints:
                 self.db.write(q)
 
-            osm_loader = OSMLoader()
+            osm_loader = OSMLoader(pbf_path=self.region.osm_file, region=self.region)
             osm_loader.load_network()
             
-            gtfs_zip = os.path.join(self.data_dir, "gtfs.zip")
-            gtfs_ext = os.path.join(self.data_dir, "gtfs")
-            self._download_file(self.gtfs_url, gtfs_zip)
-            with zipfile.ZipFile(gtfs_zip, 'r') as zip_ref:
-                zip_ref.extractall(gtfs_ext)
-            
-            gtfs_loader = GTFSLoader(gtfs_ext)
-            gtfs_loader.load_gtfs()
+            # Regions without a GTFS feed are road-only.
+            if self.gtfs_url:
+                gtfs_zip = os.path.join(self.data_dir, "gtfs.zip")
+                gtfs_ext = os.path.join(self.data_dir, "gtfs")
+                self._download_file(self.gtfs_url, gtfs_zip)
+                with zipfile.ZipFile(gtfs_zip, 'r') as zip_ref:
+                    zip_ref.extractall(gtfs_ext)
+
+                gtfs_loader = GTFSLoader(gtfs_ext, region=self.region)
+                gtfs_loader.load_gtfs()
+
+            GraphExporter(self.data_dir, region=self.region).export()
+            FeedRefresher(self.region).record()
+        elif self.refresh_on_start:
+            FeedRefresher(self.region).run()
         else:
             print("Database already contains data, skipping ingestion.")
 
-        print("Refreshing GDS Projection...")
-        self.db.write("CALL gds.graph.drop('multimodal', false)")
-        gds_query = """
-        CALL gds.graph.project(
-          'multimodal',
-          {
-            RoadNode: {properties: ['lat', 'lon']},
-            Station: {properties: ['lat', 'lon']},
-            TripEvent: {properties: ['lat', 'lon', 'time']}
-          },
-          {
-            ROAD_SEGMENT: {properties: 'cost', orientation: 'UNDIRECTED'},
-            WALK_TO: {properties: 'cost', orientation: 'UNDIRECTED'},
-            HAS_EVENT: {properties: 'cost'},
-            AT_STATION: {properties: 'cost'}
-          }
-        )
-        """
-        self.db.write(gds_query)
+        ProjectionManager(region=self.region).ensure_all()
+
+        exporter = GraphExporter(self.data_dir, region=self.region)
+        if not exporter.is_exported():
+            exporter.export()
+
+        ch_builder = CHBuilder(region=self.region)
+        if not ch_builder.is_built():
+            print("Building contraction hierarchies...")
+            ch_builder.build()
         print("System Ready.")
 
+    def _create_database(self, name):
+        # Named databases need Neo4j Enterprise; on Community give each region its own neo4j_uri instead.
+        try:
+            Neo4jConnector(self.region.neo4j_uri, "system").write("CREATE DATABASE $name IF NOT EXISTS WAIT",
+                                                                  {"name": name})
+        except Exception as e:
+            print(f"Could not create database '{name}': {e}")
+
     def _download_file(self, url, dest):
         if os.path.exists(dest): return
-        print(f"Downloading {url}...")
-        r = requests.get(url, stream=True)
-        with open(dest, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+        download(url, dest)
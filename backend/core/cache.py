@@ -0,0 +1,126 @@
+import os
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from backend.core.admission import DeadlineExceeded
+
+
+class RouteCache:
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or int(os.getenv("ROUTE_CACHE_SIZE", "10000"))
+        self.ttl = ttl or float(os.getenv("ROUTE_CACHE_TTL", "300"))
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.trip_keys = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            for trip in value.get("trips", ()):
+                self.trip_keys.setdefault(trip, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, value = self.entries.pop(key)
+        for trip in value.get("trips", ()):
+            keys = self.trip_keys.get(trip)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.trip_keys[trip]
+
+    async def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is not None:
+            return value
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # The leading request was cancelled, not this one: compute it here instead.
+                if pending.cancelled():
+                    return await self.get_or_compute(key, compute)
+                raise
+
+        self.misses += 1
+        pending = asyncio.get_running_loop().create_future()
+        self.inflight[key] = pending
+        try:
+            value = await compute()
+        except (asyncio.CancelledError, DeadlineExceeded):
+            # Waiters have deadlines of their own: let them compute it rather than share this failure.
+            pending.cancel()
+            raise
+        except Exception as e:
+            pending.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting on it.
+            pending.exception()
+            raise
+        finally:
+            del self.inflight[key]
+        self.put(key, value)
+        pending.set_result(value)
+        return value
+
+    def invalidate_trips(self, trip_ids):
+        removed = 0
+        with self.lock:
+            for trip in trip_ids:
+                for key in list(self.trip_keys.get(trip, ())):
+                    if key in self.entries:
+                        self._remove(key)
+                        removed += 1
+            self.invalidations += removed
+        return removed
+
+    def invalidate_mode(self, mode):
+        with self.lock:
+            keys = [key for key in self.entries if key[2] == mode]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.trip_keys.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "inflight": len(self.inflight),
+        }
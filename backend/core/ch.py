@@ -0,0 +1,368 @@
+import heapq
+import time
+import numpy as np
+from backend.core import admission, graph_store
+
+INF = float('inf')
+ARRAYS = ("rank", "fwd_offsets", "fwd_targets", "fwd_weights", "fwd_dists", "fwd_mids",
+          "bwd_offsets", "bwd_targets", "bwd_weights", "bwd_dists", "bwd_mids",
+          "sweep_src", "sweep_weights", "sweep_seg_starts", "sweep_seg_nodes",
+          "level_edge_offsets", "level_seg_offsets")
+
+
+def _to_csr(n, rows):
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    for v in range(n):
+        offsets[v + 1] = offsets[v] + len(rows[v])
+    m = int(offsets[-1])
+    targets = np.empty(m, dtype=np.int32)
+    weights = np.empty(m, dtype=np.float64)
+    dists = np.empty(m, dtype=np.float64)
+    mids = np.empty(m, dtype=np.int32)
+    k = 0
+    for v in range(n):
+        for w, (c, d, mid) in rows[v].items():
+            targets[k], weights[k], dists[k], mids[k] = w, c, d, mid
+            k += 1
+    return offsets, targets, weights, dists, mids
+
+
+def _sweep(rank, bwd_offsets, bwd_targets, bwd_weights):
+    # Group downward edges by the level of their lower endpoint so that one-to-all
+    # searches can relax a whole level at once with numpy.
+    n = len(rank)
+    offsets, targets = bwd_offsets.tolist(), bwd_targets.tolist()
+    levels = [0] * n
+    for v in np.argsort(-rank, kind="stable").tolist():
+        a, b = offsets[v], offsets[v + 1]
+        if a < b:
+            levels[v] = 1 + max(levels[u] for u in targets[a:b])
+    levels = np.asarray(levels, dtype=np.int32)
+    owner = np.repeat(np.arange(n, dtype=np.int32), np.diff(bwd_offsets))
+    order = np.lexsort((owner, levels[owner]))
+    owner = owner[order]
+    edge_levels = levels[owner]
+    n_levels = int(levels.max()) + 1 if n else 1
+    level_edge_offsets = np.searchsorted(edge_levels, np.arange(n_levels + 1)).astype(np.int64)
+    seg_starts = np.flatnonzero(np.r_[True, owner[1:] != owner[:-1]]) if len(owner) else np.empty(0, np.int64)
+    return {
+        "sweep_src": bwd_targets[order],
+        "sweep_weights": bwd_weights[order],
+        "sweep_seg_starts": seg_starts.astype(np.int64),
+        "sweep_seg_nodes": owner[seg_starts],
+        "level_edge_offsets": level_edge_offsets,
+        "level_seg_offsets": np.searchsorted(seg_starts, level_edge_offsets).astype(np.int64),
+    }
+
+
+class ContractionHierarchy:
+    def __init__(self, arrays):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.rank)
+
+    @classmethod
+    def build(cls, n, src, dst, weight, distance, witness_limit=500, verbose=True):
+        started = time.time()
+        out_adj = [dict() for _ in range(n)]
+        in_adj = [dict() for _ in range(n)]
+        for u, v, w, d in zip(np.asarray(src).tolist(), np.asarray(dst).tolist(),
+                              np.asarray(weight).tolist(), np.asarray(distance).tolist()):
+            if u == v:
+                continue
+            cur = out_adj[u].get(v)
+            if cur is None or w < cur[0]:
+                out_adj[u][v] = (w, d, -1)
+                in_adj[v][u] = (w, d, -1)
+
+        deleted = [0] * n
+
+        def witness(source, skip, targets, limit, max_settled):
+            dist = {source: 0.0}
+            heap = [(0.0, source)]
+            remaining = len(targets)
+            settled = 0
+            while heap and remaining and settled < max_settled:
+                d, x = heapq.heappop(heap)
+                if d > dist[x]:
+                    continue
+                if d > limit:
+                    break
+                settled += 1
+                if x in targets:
+                    remaining -= 1
+                for y, (w, _, _) in out_adj[x].items():
+                    if y == skip:
+                        continue
+                    nd = d + w
+                    if nd < dist.get(y, INF):
+                        dist[y] = nd
+                        heapq.heappush(heap, (nd, y))
+            return dist
+
+        def shortcuts(v, max_settled):
+            added = []
+            outs = out_adj[v]
+            for u, (wu, du, _) in in_adj[v].items():
+                targets = {w: wu + wv for w, (wv, _, _) in outs.items() if w != u}
+                if not targets:
+                    continue
+                dist = witness(u, v, targets, max(targets.values()), max_settled)
+                for w, (wv, dv, _) in outs.items():
+                    if w != u and dist.get(w, INF) > wu + wv:
+                        added.append((u, w, wu + wv, du + dv))
+            return added
+
+        def priority(v):
+            return len(shortcuts(v, 50)) - len(in_adj[v]) - len(out_adj[v]) + deleted[v]
+
+        heap = [(priority(v), v) for v in range(n)]
+        heapq.heapify(heap)
+        rank = np.zeros(n, dtype=np.int32)
+        up_out = [None] * n
+        up_in = [None] * n
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            if up_out[v] is not None:
+                continue
+            p = priority(v)
+            if heap and p > heap[0][0]:
+                heapq.heappush(heap, (p, v))
+                continue
+
+            added = shortcuts(v, witness_limit)
+            up_out[v] = out_adj[v]
+            up_in[v] = in_adj[v]
+            for w in up_out[v]:
+                del in_adj[w][v]
+                deleted[w] += 1
+            for u in up_in[v]:
+                del out_adj[u][v]
+                deleted[u] += 1
+            for u, w, c, d in added:
+                cur = out_adj[u].get(w)
+                if cur is None or c < cur[0]:
+                    out_adj[u][w] = (c, d, v)
+                    in_adj[w][u] = (c, d, v)
+            out_adj[v] = {}
+            in_adj[v] = {}
+            rank[v] = order
+            order += 1
+            if verbose and order % 100000 == 0:
+                print(f"CH: contracted {order}/{n} nodes in {time.time() - started:.0f}s")
+
+        arrays = {"rank": rank}
+        for prefix, rows in (("fwd", up_out), ("bwd", up_in)):
+            csr = _to_csr(n, rows)
+            for name, arr in zip(("offsets", "targets", "weights", "dists", "mids"), csr):
+                arrays[f"{prefix}_{name}"] = arr
+        arrays.update(_sweep(rank, arrays["bwd_offsets"], arrays["bwd_targets"], arrays["bwd_weights"]))
+        if verbose:
+            print(f"CH built: {n} nodes, {len(arrays['fwd_targets']) + len(arrays['bwd_targets'])} "
+                  f"upward edges in {time.time() - started:.1f}s")
+        return cls(arrays)
+
+    @classmethod
+    def from_graph(cls, graph, profile, **kwargs):
+        return cls.build(len(graph), graph.sources, graph.targets, graph.weights(profile), graph.distance, **kwargs)
+
+    def save(self, directory):
+        graph_store.save_arrays(directory, {name: getattr(self, name) for name in ARRAYS})
+
+    @classmethod
+    def exists(cls, directory):
+        return graph_store.exists(directory, ARRAYS)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        return cls(graph_store.load_arrays(directory, ARRAYS, mmap_mode))
+
+    def _csr(self, direction):
+        if direction == 0:
+            return self.fwd_offsets, self.fwd_targets, self.fwd_weights
+        return self.bwd_offsets, self.bwd_targets, self.bwd_weights
+
+    def _search(self, s, t):
+        dist = ({s: 0.0}, {t: 0.0})
+        parent = ({s: None}, {t: None})
+        heaps = ([(0.0, s)], [(0.0, t)])
+        csr = (self._csr(0), self._csr(1))
+        best, meet = INF, -1
+        if s == t:
+            return 0.0, s, dist, parent
+        while True:
+            side = -1
+            for k in (0, 1):
+                if heaps[k] and heaps[k][0][0] < best and (side < 0 or heaps[k][0][0] < heaps[side][0][0]):
+                    side = k
+            if side < 0:
+                break
+            d, x = heapq.heappop(heaps[side])
+            own = dist[side]
+            if d > own[x]:
+                continue
+            other = dist[1 - side].get(x)
+            if other is not None and d + other < best:
+                best, meet = d + other, x
+            # Stall-on-demand: x is not on a shortest up-down path if a higher node reaches it cheaper.
+            offsets, targets, weights = csr[1 - side]
+            a, b = offsets[x], offsets[x + 1]
+            stalled = False
+            for y, w in zip(targets[a:b].tolist(), weights[a:b].tolist()):
+                dy = own.get(y)
+                if dy is not None and dy + w < d:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+            offsets, targets, weights = csr[side]
+            a, b = int(offsets[x]), int(offsets[x + 1])
+            for k, (y, w) in enumerate(zip(targets[a:b].tolist(), weights[a:b].tolist())):
+                nd = d + w
+                if nd < own.get(y, INF):
+                    own[y] = nd
+                    parent[side][y] = (x, a + k)
+                    heapq.heappush(heaps[side], (nd, y))
+        return best, meet, dist, parent
+
+    def _mid(self, direction, v, target):
+        offsets, targets, mids = (
+            (self.fwd_offsets, self.fwd_targets, self.fwd_mids) if direction == 0
+            else (self.bwd_offsets, self.bwd_targets, self.bwd_mids)
+        )
+        a, b = int(offsets[v]), int(offsets[v + 1])
+        return int(mids[a + targets[a:b].tolist().index(target)])
+
+    def _unpack(self, u, w, mid, out):
+        stack = [(u, w, mid)]
+        while stack:
+            a, b, m = stack.pop()
+            if m < 0:
+                out.append(b)
+                continue
+            # a -> m is stored as a backward up-edge of m, m -> b as a forward up-edge of m.
+            stack.append((m, b, self._mid(0, m, b)))
+            stack.append((a, m, self._mid(1, m, a)))
+
+    def query(self, s, t):
+        best, meet, dist, parent = self._search(s, t)
+        if meet < 0:
+            return None
+        up = []
+        x = meet
+        while parent[0][x] is not None:
+            y, e = parent[0][x]
+            up.append((y, x, float(self.fwd_dists[e]), int(self.fwd_mids[e])))
+            x = y
+        down = []
+        x = meet
+        while parent[1][x] is not None:
+            y, e = parent[1][x]
+            down.append((x, y, float(self.bwd_dists[e]), int(self.bwd_mids[e])))
+            x = y
+
+        path = [s]
+        distance = 0.0
+        for a, b, dd, mid in reversed(up):
+            self._unpack(a, b, mid, path)
+            distance += dd
+        for a, b, dd, mid in down:
+            self._unpack(a, b, mid, path)
+            distance += dd
+        return best, distance, path
+
+    def _upward(self, sources, direction):
+        dist = {}
+        for s, offset in sources:
+            if offset < dist.get(s, (INF,))[0]:
+                dist[s] = (offset, 0.0)
+        heap = [(d, s) for s, (d, _) in dist.items()]
+        heapq.heapify(heap)
+        offsets, targets, weights = self._csr(direction)
+        o_offsets, o_targets, o_weights = self._csr(1 - direction)
+        dists = self.fwd_dists if direction == 0 else self.bwd_dists
+        settled = {}
+        deadline = admission.current()
+        while heap:
+            d, x = heapq.heappop(heap)
+            if x in settled or d > dist[x][0]:
+                continue
+            a, b = int(o_offsets[x]), int(o_offsets[x + 1])
+            stalled = False
+            for y, w in zip(o_targets[a:b].tolist(), o_weights[a:b].tolist()):
+                dy = dist.get(y)
+                if dy is not None and dy[0] + w < d:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+            dd = dist[x][1]
+            settled[x] = (d, dd)
+            if deadline is not None and not len(settled) & 1023:
+                deadline.check()
+            a, b = int(offsets[x]), int(offsets[x + 1])
+            for y, w, ed in zip(targets[a:b].tolist(), weights[a:b].tolist(), dists[a:b].tolist()):
+                nd = d + w
+                cur = dist.get(y)
+                if cur is None or nd < cur[0]:
+                    dist[y] = (nd, dd + ed)
+                    heapq.heappush(heap, (nd, y))
+        return settled
+
+    def buckets(self, targets):
+        # Backward search spaces of the targets, keyed by the node where a forward search meets them.
+        buckets = {}
+        for j, t in enumerate(targets):
+            if t is None:
+                continue
+            for v, (d, dd) in self._upward([(t, 0.0)], 1).items():
+                buckets.setdefault(v, []).append((j, d, dd))
+        return buckets
+
+    def spaces(self, sources):
+        return [self._upward([(s, 0.0)], 0) if s is not None else {} for s in sources]
+
+    def many_to_many(self, sources, targets, buckets=None, spaces=None):
+        # Precomputed buckets/spaces let callers reuse the searches of a fixed node set across queries.
+        if buckets is None:
+            buckets = self.buckets(targets)
+        if spaces is None:
+            spaces = (self._upward([(s, 0.0)], 0) if s is not None else {} for s in sources)
+
+        costs = np.full((len(sources), len(targets)), INF)
+        distances = np.full((len(sources), len(targets)), INF)
+        for i, space in enumerate(spaces):
+            row_cost, row_dist = costs[i], distances[i]
+            best = [INF] * len(targets)
+            best_dist = [INF] * len(targets)
+            for v, (d, dd) in space.items():
+                for j, d2, dd2 in buckets.get(v, ()):
+                    if d + d2 < best[j]:
+                        best[j] = d + d2
+                        best_dist[j] = dd + dd2
+            row_cost[:] = best
+            row_dist[:] = best_dist
+        return costs, distances
+
+    def one_to_all(self, sources):
+        cost = np.full(len(self.rank), INF)
+        settled = self._upward(sources, 0)
+        if settled:
+            nodes = np.fromiter(settled.keys(), dtype=np.int64, count=len(settled))
+            cost[nodes] = [c for c, _ in settled.values()]
+        deadline = admission.current()
+        for level in range(1, len(self.level_edge_offsets) - 1):
+            if deadline is not None and not level & 63:
+                deadline.check()
+            e0, e1 = int(self.level_edge_offsets[level]), int(self.level_edge_offsets[level + 1])
+            if e0 == e1:
+                continue
+            s0, s1 = int(self.level_seg_offsets[level]), int(self.level_seg_offsets[level + 1])
+            cand = cost[self.sweep_src[e0:e1]] + self.sweep_weights[e0:e1]
+            best = np.minimum.reduceat(cand, self.sweep_seg_starts[s0:s1] - e0)
+            nodes = self.sweep_seg_nodes[s0:s1]
+            cost[nodes] = np.minimum(cost[nodes], best)
+        return cost
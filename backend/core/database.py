@@ -1,39 +1,212 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, AsyncGraphDatabase, Query, unit_of_work
+from neo4j.exceptions import Neo4jError
 import os
 import time
+import asyncio
+import weakref
+import threading
+from backend.core import admission
+from backend.core.metrics import timed
+
+# One driver per Neo4j URI; regions on the same instance share it and differ only by database.
+# Async drivers are bound to the event loop that created them, so they are kept per loop.
+_drivers = {}
+_driver_lock = threading.Lock()
+_async_drivers = weakref.WeakKeyDictionary()
+_async_locks = weakref.WeakKeyDictionary()
+_async_registry_lock = threading.Lock()
+
+
+def get_driver(uri=None):
+    uri = uri or _default_uri()
+    with _driver_lock:
+        if uri not in _drivers:
+            _drivers[uri] = _connect(uri)
+    return _drivers[uri]
+
+
+def _loop_drivers():
+    loop = asyncio.get_running_loop()
+    with _async_registry_lock:
+        if loop not in _async_locks:
+            _async_locks[loop] = asyncio.Lock()
+            _async_drivers[loop] = {}
+        return _async_locks[loop], _async_drivers[loop]
+
+
+async def get_async_driver(uri=None):
+    uri = uri or _default_uri()
+    lock, drivers = _loop_drivers()
+    async with lock:
+        if uri not in drivers:
+            drivers[uri] = await _connect_async(uri)
+    return drivers[uri]
+
+
+def close_drivers():
+    # Process shutdown only: connectors share these drivers and never close them themselves.
+    with _driver_lock:
+        for driver in _drivers.values():
+            driver.close()
+        _drivers.clear()
+
+
+async def close_async_drivers():
+    # Closes the drivers of the running loop, on shutdown of the app that owns it.
+    lock, drivers = _loop_drivers()
+    async with lock:
+        for driver in drivers.values():
+            await driver.close()
+        drivers.clear()
+
+
+def _default_uri():
+    return os.getenv("NEO4J_URI", "bolt://neo4j:7687")
+
+
+def _settings(uri=None):
+    uri = uri or _default_uri()
+    auth = (os.getenv("NEO4J_USER", "neo4j"), os.getenv("NEO4J_PASSWORD", "password"))
+    options = {
+        "max_connection_pool_size": int(os.getenv("NEO4J_POOL_SIZE", "100")),
+        "connection_acquisition_timeout": float(os.getenv("NEO4J_ACQUIRE_TIMEOUT", "30")),
+    }
+    return uri, auth, options
+
+
+async def _connect_async(uri=None):
+    uri, auth, options = _settings(uri)
+    max_retries = 12
+    for attempt in range(max_retries):
+        driver = AsyncGraphDatabase.driver(uri, auth=auth, **options)
+        try:
+            await driver.verify_connectivity()
+            print(f"Successfully connected to Neo4j at {uri} (async)")
+            return driver
+        except Exception as e:
+            await driver.close()
+            if attempt == max_retries - 1:
+                print(f"Failed to connect to Neo4j after {max_retries} attempts.")
+                raise e
+            print(f"Neo4j connection attempt {attempt+1}/{max_retries} failed. Retrying in 10s...")
+            await asyncio.sleep(10)
+
+
+def _connect(uri=None):
+    uri, auth, options = _settings(uri)
+    max_retries = 12
+    for attempt in range(max_retries):
+        try:
+            driver = GraphDatabase.driver(uri, auth=auth, **options)
+            driver.verify_connectivity()
+            print(f"Successfully connected to Neo4j at {uri}")
+            return driver
+        except Exception as e:
+            if attempt == max_retries - 1:
+                print(f"Failed to connect to Neo4j after {max_retries} attempts.")
+                raise e
+            print(f"Neo4j connection attempt {attempt+1}/{max_retries} failed. Retrying in 10s...")
+            time.sleep(10)
+
+
+def _timeout():
+    # What is left of the request's deadline becomes the transaction timeout, so Neo4j stops the
+    # query itself instead of holding the session after the client has been answered.
+    deadline = admission.current()
+    if deadline is None:
+        return None
+    deadline.check()
+    return max(deadline.remaining(), 0.001)  # 0 would mean no timeout at all
+
+
+def _deadline_error(e):
+    if "TransactionTimedOut" in (e.code or ""):
+        return admission.DeadlineExceeded(f"Neo4j transaction timed out: {e.message}")
+    return None
+
+
+def _batch_rows(parameters):
+    # UNWIND writes pass their rows as the one list parameter.
+    if parameters:
+        for value in parameters.values():
+            if isinstance(value, list):
+                return len(value)
+    return None
+
 
 class Neo4jConnector:
-    def __init__(self):
-        uri = os.getenv("NEO4J_URI", "bolt://neo4j:7687")
-        user = os.getenv("NEO4J_USER", "neo4j")
-        password = os.getenv("NEO4J_PASSWORD", "password")
-        
-        max_retries = 12
-        self.driver = None
-        
-        for attempt in range(max_retries):
-            try:
-                self.driver = GraphDatabase.driver(uri, auth=(user, password))
-                self.driver.verify_connectivity()
-                print(f"Successfully connected to Neo4j at {uri}")
-                break
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    print(f"Failed to connect to Neo4j after {max_retries} attempts.")
-                    raise e
-                print(f"Neo4j connection attempt {attempt+1}/{max_retries} failed. Retrying in 10s...")
-                time.sleep(10)
+    # The shared driver connects on first use, so purely in-memory work never waits on Neo4j.
+    # database=None uses the server's default database.
+    def __init__(self, uri=None, database=None):
+        self.uri = uri
+        self.database = database
+
+    @property
+    def driver(self):
+        return get_driver(self.uri)
+
+    def session(self):
+        return self.driver.session(database=self.database)
 
     def query(self, cypher, parameters=None):
-        with self.driver.session() as session:
-            result = session.run(cypher, parameters)
-            return [dict(record) for record in result]
+        with timed("neo4j.query") as t, self.session() as session:
+            try:
+                result = session.run(Query(cypher, timeout=_timeout()), parameters)
+                records = [dict(record) for record in result]
+            except Neo4jError as e:
+                raise _deadline_error(e) or e
+            t.rows = len(records)
+            return records
 
     def write(self, cypher, parameters=None):
-        with self.driver.session() as session:
+        with timed("neo4j.write", rows=_batch_rows(parameters)), self.session() as session:
             result = session.run(cypher, parameters)
             return result.consume()
 
-    def close(self):
-        if self.driver:
-            self.driver.close()
+    def write_tx(self, cypher, parameters=None):
+        # Managed transaction: retried by the driver on deadlocks and other transient errors.
+        def work(tx):
+            return tx.run(cypher, parameters).consume()
+        with timed("neo4j.write", rows=_batch_rows(parameters)), self.session() as session:
+            return session.execute_write(work)
+
+
+class AsyncNeo4jConnector:
+    def __init__(self, uri=None, database=None):
+        self.uri = uri
+        self.database = database
+
+    async def query(self, cypher, parameters=None):
+        async def work(tx):
+            result = await tx.run(cypher, parameters)
+            return [dict(record) async for record in result]
+        with timed("neo4j.query") as t:
+            records = await self.read_tx(work)
+            t.rows = len(records)
+            return records
+
+    async def write(self, cypher, parameters=None):
+        async def work(tx):
+            result = await tx.run(cypher, parameters)
+            return await result.consume()
+        driver = await get_async_driver(self.uri)
+        with timed("neo4j.write", rows=_batch_rows(parameters)):
+            async with driver.session(database=self.database) as session:
+                return await session.execute_write(work)
+
+    async def read_tx(self, work, *args, **kwargs):
+        timeout = _timeout()
+        if timeout is not None:
+            inner, deadline = work, admission.current()
+
+            @unit_of_work(timeout=timeout)
+            def work(tx, *args, **kwargs):
+                # Older servers report the timeout as transient; a retry past the deadline stops here.
+                deadline.check()
+                return inner(tx, *args, **kwargs)
+        driver = await get_async_driver(self.uri)
+        async with driver.session(database=self.database) as session:
+            try:
+                return await session.execute_read(work, *args, **kwargs)
+            except Neo4jError as e:
+                raise _deadline_error(e) or e
@@ -0,0 +1,81 @@
+import threading
+import numpy as np
+
+
+class DelayOverlay:
+    # Realtime delays over a TransitEngine timetable, keyed by (trip_id, stop_sequence).
+    # Every applied feed replaces the previous one (GTFS-RT full dataset) and publishes a new
+    # view of the connections re-sorted by effective departure, which the scans read lock-free.
+    def __init__(self, engine):
+        self.engine = engine
+        self.trip_index = {str(t): i for i, t in enumerate(engine.trip_ids.tolist())}
+        self.dep_delay = np.zeros(len(engine.conn_dep), dtype=np.int32)
+        self.arr_delay = np.zeros(len(engine.conn_dep), dtype=np.int32)
+        self.events = {}
+        self.view = None
+        self.lock = threading.Lock()
+
+    def apply(self, updates):
+        # updates: {trip_id: [(stop_sequence or None, stop_id, arrival_delay, departure_delay)]}
+        engine = self.engine
+        dep_delay = np.zeros_like(self.dep_delay)
+        arr_delay = np.zeros_like(self.arr_delay)
+        events = {}
+        for trip_id, stop_updates in updates.items():
+            trip = self.trip_index.get(trip_id)
+            if trip is None:
+                continue
+            conns = engine.trip_conns[engine.trip_offsets[trip]:engine.trip_offsets[trip + 1]]
+            if not len(conns):
+                continue
+            seqs = engine.conn_seq[conns].tolist()
+            stops = engine.conn_dep_stop[conns].tolist() + [int(engine.conn_arr_stop[conns[-1]])]
+            arrival_seqs = seqs[1:] + [seqs[-1] + 1]
+            seq_of_stop = {}
+            for s, stop in zip(seqs + arrival_seqs[-1:], stops):
+                seq_of_stop.setdefault(str(engine.stop_ids[stop]), s)
+
+            by_seq = {}
+            for seq, stop_id, arr, dep in stop_updates:
+                if seq is None:
+                    seq = seq_of_stop.get(stop_id)
+                if seq is not None:
+                    by_seq[seq] = (arr if arr is not None else dep, dep if dep is not None else arr)
+            if not by_seq:
+                continue
+            last = max(by_seq)
+            if last > seqs[-1]:
+                arrival_seqs[-1] = last
+
+            # A delay holds for every later stop until the next update overrides it.
+            current = 0
+            for k, c in enumerate(conns.tolist()):
+                if seqs[k] in by_seq:
+                    current = by_seq[seqs[k]][1]
+                dep_delay[c] = current
+                events.setdefault((trip_id, seqs[k]), current)
+                if arrival_seqs[k] in by_seq:
+                    current = by_seq[arrival_seqs[k]][0]
+                arr_delay[c] = current
+                events[(trip_id, arrival_seqs[k])] = current
+
+        changed = {trip_id for (trip_id, _), _ in set(events.items()) ^ set(self.events.items())}
+        if dep_delay.any() or arr_delay.any():
+            dep = engine.conn_dep + dep_delay
+            order = np.argsort(dep, kind="stable").astype(np.int32)
+            view = (order, dep[order], (engine.conn_arr + arr_delay)[order])
+        else:
+            view = None
+        with self.lock:
+            self.dep_delay, self.arr_delay, self.events, self.view = dep_delay, arr_delay, events, view
+        return changed
+
+    def departure(self, conn):
+        return int(self.engine.conn_dep[conn]) + int(self.dep_delay[conn])
+
+    def arrival(self, conn):
+        return int(self.engine.conn_arr[conn]) + int(self.arr_delay[conn])
+
+    def delayed_events(self):
+        with self.lock:
+            return dict(self.events)
@@ -0,0 +1,215 @@
+import os
+import numpy as np
+from backend.core import admission
+
+INF = float('inf')
+
+# Charging power in kW by charger_type (lower-cased); anything else uses EV_DEFAULT_CHARGER_KW.
+CHARGER_POWER = {
+    "ccs": 50.0, "ccs2": 50.0, "chademo": 50.0, "dc": 50.0, "dc fast": 50.0, "fast": 50.0, "rapid": 50.0,
+    "supercharger": 120.0, "type2": 22.0, "type 2": 22.0, "ac": 7.4, "slow": 3.3,
+}
+
+
+def charger_power(charger_type, default):
+    return CHARGER_POWER.get((charger_type or "").strip().lower(), default)
+
+
+class EVPlanner:
+    # Charging-stop planner over the graph of EV chargers attached to road nodes. Drive times and
+    # distances between chargers are computed once, and only for new chargers after an import; a query
+    # adds only the legs from the start and to the end. The search runs level by level in the number of
+    # stops, so the first level that reaches the end gives the fewest stops, and within it the fastest
+    # plan. A level is a table of best times per (charger, state-of-charge bucket) where a bucket is the
+    # charge level left with.
+    def __init__(self, graph, ch, nodes, powers, buckets=None, reserve=None, max_charge=None, max_stops=None,
+                 detour=None, base=None):
+        self.graph = graph
+        self.ch = ch
+        self.buckets = buckets or int(os.getenv("EV_SOC_BUCKETS", "10"))
+        self.reserve = reserve if reserve is not None else float(os.getenv("EV_RESERVE", "0.1"))
+        self.max_charge = max_charge or float(os.getenv("EV_MAX_CHARGE", "0.8"))
+        self.max_stops = max_stops or int(os.getenv("EV_MAX_STOPS", "5"))
+        self.detour = detour or float(os.getenv("EV_DETOUR", "2.0"))
+        self.corridor = int(os.getenv("EV_CORRIDOR_CHARGERS", "64"))
+
+        usable = np.flatnonzero(np.asarray(nodes) >= 0)
+        self.chargers = usable
+        self.nodes = np.asarray(nodes)[usable].tolist()
+        self.powers = np.asarray(powers, dtype=np.float64)[usable]
+        if base is not None:
+            self._extend(base)
+        elif ch is not None:
+            self.charger_buckets = ch.buckets(self.nodes)
+            self.charger_spaces = ch.spaces(self.nodes)
+            self.times, self.meters = ch.many_to_many(self.nodes, self.nodes, self.charger_buckets,
+                                                      self.charger_spaces)
+        else:
+            self.times, self.meters = self._dijkstra_matrix(self.nodes, self.nodes)
+        np.fill_diagonal(self.times, INF)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def extended(self, nodes, powers):
+        # Planner over a new charger set that reuses this one's legs between road nodes it already had.
+        return EVPlanner(self.graph, self.ch, nodes, powers, self.buckets, self.reserve, self.max_charge,
+                         self.max_stops, self.detour, base=self)
+
+    def _extend(self, base):
+        # Legs between road nodes of the base planner are copied; only the rows and columns of chargers
+        # on new nodes are searched.
+        known = {v: i for i, v in enumerate(base.nodes)}
+        pos = np.asarray([known.get(v, -1) for v in self.nodes], dtype=np.int64)
+        old, new = np.flatnonzero(pos >= 0), np.flatnonzero(pos < 0)
+        old_nodes, fresh = [self.nodes[k] for k in old], [self.nodes[k] for k in new]
+        n = len(self.nodes)
+        self.times, self.meters = np.full((n, n), INF), np.full((n, n), INF)
+        times = base.times[np.ix_(pos[old], pos[old])]
+        times[pos[old][:, None] == pos[old][None, :]] = 0.0  # chargers sharing a node; the diagonal is reset after
+        self.times[np.ix_(old, old)] = times
+        self.meters[np.ix_(old, old)] = base.meters[np.ix_(pos[old], pos[old])]
+        if self.ch is not None:
+            # Bucket entries of kept chargers are renumbered, those of new chargers searched.
+            moved = {}
+            for k in old.tolist():
+                moved.setdefault(int(pos[k]), []).append(k)
+            self.charger_buckets = {}
+            for v, entries in base.charger_buckets.items():
+                kept = [(k, d, dd) for j, d, dd in entries for k in moved.get(j, ())]
+                if kept:
+                    self.charger_buckets[v] = kept
+            fresh_buckets, fresh_spaces = self.ch.buckets(fresh), self.ch.spaces(fresh)
+            for v, entries in fresh_buckets.items():
+                self.charger_buckets.setdefault(v, []).extend((int(new[j]), d, dd) for j, d, dd in entries)
+            self.charger_spaces = [None] * n
+            for k in old.tolist():
+                self.charger_spaces[k] = base.charger_spaces[pos[k]]
+            for j, k in enumerate(new.tolist()):
+                self.charger_spaces[k] = fresh_spaces[j]
+            rows = self.ch.many_to_many(fresh, self.nodes, self.charger_buckets, fresh_spaces)
+            cols = self.ch.many_to_many(old_nodes, fresh, fresh_buckets, [self.charger_spaces[k] for k in old])
+        else:
+            rows = self._dijkstra_matrix(fresh, self.nodes)
+            cols = self._dijkstra_matrix(old_nodes, fresh)
+        self.times[new, :], self.meters[new, :] = rows
+        self.times[np.ix_(old, new)], self.meters[np.ix_(old, new)] = cols
+
+    def _dijkstra_matrix(self, sources, targets):
+        times = np.full((len(sources), len(targets)), INF)
+        meters = np.full((len(sources), len(targets)), INF)
+        wanted = set(targets)
+        for i, s in enumerate(sources):
+            settled = self.graph.dijkstra([(s, 0.0)], 'drive', targets=wanted)
+            for j, t in enumerate(targets):
+                if t in settled:
+                    times[i, j], meters[i, j] = settled[t]
+        return times, meters
+
+    def _legs(self, s, t):
+        # (start -> chargers, chargers -> end, start -> end) times and distances.
+        if self.ch is not None:
+            out_t, out_m = self.ch.many_to_many([s], self.nodes + [t], buckets=self._with_target(t))
+            in_t, in_m = self.ch.many_to_many(self.nodes, [t], spaces=self.charger_spaces)
+        else:
+            out_t, out_m = self._dijkstra_matrix([s], self.nodes + [t])
+            in_t, in_m = self._dijkstra_matrix(self.nodes, [t])
+        return out_t[0, :-1], out_m[0, :-1], in_t[:, 0], in_m[:, 0], out_t[0, -1], out_m[0, -1]
+
+    def _with_target(self, t):
+        j = len(self.nodes)
+        buckets = dict(self.charger_buckets)
+        for v, entries in self.ch.buckets([t]).items():
+            buckets[v] = buckets.get(v, []) + [(j, d, dd) for _, d, dd in entries]
+        return buckets
+
+    def plan(self, s, t, soc, capacity, consumption):
+        # soc in [0, 1], capacity in kWh, consumption in kWh/km. Returns
+        # (stops, total drive+charge seconds, [(charger, arrival kWh, departure kWh, charge seconds)])
+        # with charger as an index into the planner's input arrays, or None when out of reach.
+        kwh_per_m = consumption / 1000.0
+        energy = soc * capacity
+        reserve = self.reserve * capacity
+        out_t, out_m, in_t, in_m, st_t, st_m = self._legs(s, t)
+        if not np.isfinite(st_t):
+            return None
+        if energy - st_m * kwh_per_m >= reserve:
+            return 0, float(st_t), []
+        if not len(self.nodes):
+            return None
+
+        # Chargers off the corridor cannot be part of a sensible plan; of those on it, only the
+        # EV_CORRIDOR_CHARGERS with the smallest detour are searched, as each level is quadratic in them.
+        detour = out_t + in_t
+        near = np.flatnonzero(detour <= self.detour * st_t + 600.0)
+        if not len(near):
+            return None
+        if len(near) > self.corridor:
+            near = np.sort(near[np.argpartition(detour[near], self.corridor)[:self.corridor]])
+        times = self.times[np.ix_(near, near)]
+        need = self.meters[np.ix_(near, near)] * kwh_per_m
+        charge_rate = 3600.0 / self.powers[near]
+        out_t, out_e = out_t[near], out_m[near] * kwh_per_m
+        in_t, in_e = in_t[near], in_m[near] * kwh_per_m
+        top = max(self.max_charge * capacity, reserve)
+        levels = np.linspace(top / self.buckets, top, self.buckets)
+        cols = np.arange(len(near))
+
+        # Level 1: drive from the start to a charger and charge to each level. Arriving above the top
+        # level counts as the top level at no charging time.
+        arrive = np.minimum(energy - out_e, top)
+        table = np.where((arrive >= reserve)[:, None] & np.isfinite(out_t)[:, None],
+                         out_t[:, None] + self._charge(levels[None, :] - arrive[:, None], charge_rate[:, None]), INF)
+        parents = [None]
+        deadline = admission.current()
+        for stops in range(1, self.max_stops + 1):
+            if deadline is not None:
+                deadline.check()
+            finish = np.where(levels[None, :] - in_e[:, None] >= reserve, table + in_t[:, None], INF)
+            if np.isfinite(finish).any():
+                c, b = np.unravel_index(int(np.argmin(finish)), finish.shape)
+                return stops, float(finish[c, b]), self._backtrack(parents, c, b, near, levels, energy, out_e,
+                                                                   need, charge_rate)
+            if stops == self.max_stops:
+                break
+            new = np.full_like(table, INF)
+            parent = np.full(table.shape + (2,), -1, dtype=np.int64)
+            for b in range(self.buckets):
+                src = table[:, b]
+                if not np.isfinite(src).any():
+                    continue
+                arrive = np.minimum(levels[b] - need, top)
+                ok = (arrive >= reserve) & np.isfinite(src)[:, None] & np.isfinite(times)
+                at = np.where(ok, src[:, None] + times, INF)
+                cost = at[:, :, None] + self._charge(levels[None, None, :] - arrive[:, :, None],
+                                                     charge_rate[None, :, None])
+                rows = cost.argmin(axis=0)
+                best = cost[rows, cols[:, None], np.arange(self.buckets)[None, :]]
+                better = best < new
+                new[better] = best[better]
+                parent[better] = np.stack([rows, np.full_like(rows, b)], axis=-1)[better]
+            if not np.isfinite(new).any():
+                break
+            parents.append(parent)
+            table = new
+        return None
+
+    @staticmethod
+    def _charge(added, rate):
+        # Seconds to add `added` kWh; a stop never leaves with less than it arrived with (arrivals are
+        # clamped to the top level first).
+        return np.where(added >= -1e-9, np.maximum(added, 0.0) * rate, INF)
+
+    def _backtrack(self, parents, c, b, near, levels, energy, out_e, need, charge_rate):
+        chain = [(c, b)]
+        for parent in reversed(parents[1:]):
+            c, b = parent[c, b]
+            chain.append((int(c), int(b)))
+        chain.reverse()
+        stops = []
+        for k, (c, b) in enumerate(chain):
+            arrive = energy - out_e[c] if k == 0 else levels[chain[k - 1][1]] - need[chain[k - 1][0], c]
+            depart = max(levels[b], arrive)
+            stops.append((int(self.chargers[near[c]]), float(arrive), float(depart),
+                          float((depart - arrive) * charge_rate[c])))
+        return stops
@@ -0,0 +1,75 @@
+import os
+import json
+import fcntl
+import shutil
+import numpy as np
+
+
+def store_dir(name=None, region=None):
+    # Named regions keep their own arrays under regions/<region>; the default region uses the root.
+    root = os.getenv("GRAPH_STORE_DIR", os.path.join(os.getenv("DATA_DIR", "/app/data"), "graph"))
+    if region:
+        root = os.path.join(root, "regions", region)
+    return os.path.join(root, name) if name else root
+
+
+def exists(directory, names):
+    return all(os.path.exists(os.path.join(directory, f"{name}.npy")) for name in names)
+
+
+def save_arrays(directory, arrays):
+    # Write next to the target and swap directories so attached workers keep their old mappings.
+    tmp = directory + ".tmp"
+    old = directory + ".old"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(arr), allow_pickle=False)
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old)
+    os.replace(tmp, directory)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def load_arrays(directory, names, mmap_mode='r'):
+    return {
+        name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+        for name in names
+    }
+
+
+def version_stamp(directory):
+    # Changes whenever VERSION.json is replaced; None before the first change is announced.
+    try:
+        st = os.stat(os.path.join(directory, "VERSION.json"))
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def read_version(directory):
+    try:
+        with open(os.path.join(directory, "VERSION.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def bump_version(directory, key, **payload):
+    # Announces a change to every worker attached to the store: one counter per key, bumped under a lock so
+    # concurrent announcements are never lost, with the payload describing the latest change.
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "VERSION.json")
+    with open(os.path.join(directory, ".version.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            version = read_version(directory)
+            version[key] = {**payload, "n": version.get(key, {}).get("n", 0) + 1}
+            tmp = f"{path}.{os.getpid()}"
+            with open(tmp, "w") as f:
+                json.dump(version, f)
+            os.replace(tmp, path)
+            return version[key]["n"]
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,112 @@
+import numpy as np
+from backend.core.geo import METERS_PER_DEG_LAT, METERS_PER_DEG_LON
+
+# Directions of cell-boundary edges on the raster, counter-clockwise around filled cells.
+LEFT_TURNS = {(1, 0): (0, 1), (0, 1): (-1, 0), (-1, 0): (0, -1), (0, -1): (1, 0)}
+
+
+def rasterize(lats, lons, cell_size=200.0):
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    dlat = cell_size / METERS_PER_DEG_LAT
+    dlon = cell_size / (METERS_PER_DEG_LON * max(np.cos(np.radians(lats.mean())), 0.01))
+    # One empty cell of padding on every side so that the dilation and the tracing never hit the border.
+    lat0, lon0 = lats.min() - 2 * dlat, lons.min() - 2 * dlon
+    rows = ((lats - lat0) / dlat).astype(np.int64)
+    cols = ((lons - lon0) / dlon).astype(np.int64)
+    grid = np.zeros((rows.max() + 3, cols.max() + 3), dtype=bool)
+    grid[rows, cols] = True
+    # Close the one-cell gaps left between road nodes.
+    filled = grid.copy()
+    filled[1:] |= grid[:-1]
+    filled[:-1] |= grid[1:]
+    filled[:, 1:] |= grid[:, :-1]
+    filled[:, :-1] |= grid[:, 1:]
+    return filled, lat0, lon0, dlat, dlon
+
+
+def _boundary_edges(grid):
+    padded = np.pad(grid, 1)
+    inner = padded[1:-1, 1:-1]
+    edges = {}
+    # (mask, start corner, direction) with x = column and y = row, filled cells on the left.
+    sides = (
+        (inner & ~padded[:-2, 1:-1], (0, 0), (1, 0)),
+        (inner & ~padded[1:-1, 2:], (1, 0), (0, 1)),
+        (inner & ~padded[2:, 1:-1], (1, 1), (-1, 0)),
+        (inner & ~padded[1:-1, :-2], (0, 1), (0, -1)),
+    )
+    for mask, (ox, oy), direction in sides:
+        rows, cols = np.nonzero(mask)
+        for x, y in zip((cols + ox).tolist(), (rows + oy).tolist()):
+            edges.setdefault((x, y), []).append(direction)
+    return edges
+
+
+def _trace(edges):
+    rings = []
+    while edges:
+        start = next(iter(edges))
+        ring = [start]
+        x, y = start
+        direction = None
+        while True:
+            out = edges[(x, y)]
+            if direction is None or len(out) == 1:
+                step = out[0]
+            else:
+                # At a saddle turn left so that diagonal cells end up in separate rings.
+                left = LEFT_TURNS[direction]
+                step = left if left in out else next(d for d in out if d != (-left[0], -left[1]))
+            out.remove(step)
+            if not out:
+                del edges[(x, y)]
+            x, y = x + step[0], y + step[1]
+            if step != direction:
+                ring.append((x - step[0], y - step[1]))
+            direction = step
+            if (x, y) == start:
+                break
+        ring = ring[1:] if ring[0] == ring[1] else ring
+        ring.append(ring[0])
+        rings.append(ring)
+    return rings
+
+
+def _area(ring):
+    xs = np.asarray([p[0] for p in ring], dtype=np.float64)
+    ys = np.asarray([p[1] for p in ring], dtype=np.float64)
+    return 0.5 * float(np.dot(xs[:-1], ys[1:]) - np.dot(xs[1:], ys[:-1]))
+
+
+def _contains(ring, x, y):
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def polygon(lats, lons, cell_size=200.0):
+    if len(lats) == 0:
+        return {"type": "MultiPolygon", "coordinates": []}
+    grid, lat0, lon0, dlat, dlon = rasterize(lats, lons, cell_size)
+    outers, holes = [], []
+    for ring in _trace(_boundary_edges(grid)):
+        area = _area(ring)
+        (outers if area > 0 else holes).append((abs(area), ring))
+    outers.sort(key=lambda r: r[0])
+    polygons = [[ring] for _, ring in outers]
+    for _, ring in holes:
+        # Holes run clockwise, so the empty cell right of the first edge lies inside them.
+        (x1, y1), (x2, y2) = ring[0], ring[1]
+        dx, dy = np.sign(x2 - x1), np.sign(y2 - y1)
+        px, py = x1 + 0.5 * dx + 0.5 * dy, y1 + 0.5 * dy - 0.5 * dx
+        for poly in polygons:
+            if _contains(poly[0], px, py):
+                poly.append(ring)
+                break
+
+    def coords(ring):
+        return [[round(lon0 + x * dlon, 6), round(lat0 + y * dlat, 6)] for x, y in ring]
+
+    return {"type": "MultiPolygon", "coordinates": [[coords(r) for r in poly] for poly in polygons]}
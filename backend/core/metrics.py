@@ -0,0 +1,158 @@
+import time
+import threading
+import contextvars
+import numpy as np
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Per-request list of (stage, seconds) for the Server-Timing header; None when not requested.
+# asyncio.to_thread copies the context, so stages run in worker threads land in the same list.
+_timings = contextvars.ContextVar("server_timing", default=None)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in items]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = np.asarray(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, *labels, value):
+        k = int(np.searchsorted(self.buckets, value, side="left"))
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [np.zeros(len(self.buckets) + 1, dtype=np.int64), 0.0]
+            series[0][k] += 1
+            series[1] += value
+
+    def render(self):
+        with self.lock:
+            items = sorted((k, (s[0].copy(), s[1])) for k, s in self.series.items())
+        lines = []
+        names = self.label_names + ("le",)
+        for k, (counts, total) in items:
+            cumulative = np.cumsum(counts)
+            for bound, c in zip(self.buckets.tolist() + ["+Inf"], cumulative.tolist()):
+                lines.append(f"{self.name}_bucket{_labels(names, k + (bound,))} {c}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, k)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, k)} {int(cumulative[-1])}")
+        return lines
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels=()):
+        # fn returns {label tuple: value}, read at scrape time.
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.fn = fn
+
+    def render(self):
+        try:
+            values = self.fn()
+        except Exception:
+            return []
+        return [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in sorted(values.items())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram("routing_stage_duration_seconds", "Time spent per stage.", ("stage",)))
+STAGE_ROWS = REGISTRY.register(Counter("routing_stage_rows_total", "Rows read or written per stage.", ("stage",)))
+STAGE_BYTES = REGISTRY.register(Counter("routing_stage_bytes_total", "Bytes read or written per stage.", ("stage",)))
+STAGE_ERRORS = REGISTRY.register(Counter("routing_stage_errors_total", "Stages that raised.", ("stage",)))
+HTTP_SECONDS = REGISTRY.register(Histogram("http_request_duration_seconds", "HTTP request latency.",
+                                           ("method", "path", "status")))
+
+
+class timed:
+    # with timed("gds.astar") as t: ...; t.rows = len(results)
+    def __init__(self, stage, rows=None, nbytes=None):
+        self.stage = stage
+        self.rows = rows
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        STAGE_SECONDS.observe(self.stage, value=elapsed)
+        if self.rows:
+            STAGE_ROWS.inc(self.stage, value=self.rows)
+        if self.nbytes:
+            STAGE_BYTES.inc(self.stage, value=self.nbytes)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(self.stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((self.stage, elapsed))
+        return False
+
+
+def start_request_timing():
+    timings = []
+    return timings, _timings.set(timings)
+
+
+def stop_request_timing(token):
+    _timings.reset(token)
+
+
+def server_timing(timings):
+    # Repeated stages (e.g. several Neo4j queries) are summed into one entry.
+    totals = {}
+    for stage, elapsed in timings:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return ", ".join(f"{stage};dur={elapsed * 1000.0:.2f}" for stage, elapsed in totals.items())
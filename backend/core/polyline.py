@@ -0,0 +1,48 @@
+import numpy as np
+
+PRECISION = 6
+
+
+def encode(coords, precision=PRECISION):
+    if len(coords) == 0:
+        return ""
+    points = np.round(np.asarray(coords, dtype=np.float64) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(points, axis=0, prepend=0).ravel()
+    out = []
+    for value in np.where(deltas < 0, ~(deltas << 1), deltas << 1).tolist():
+        while value >= 0x20:
+            out.append(chr((0x20 | (value & 0x1F)) + 63))
+            value >>= 5
+        out.append(chr(value + 63))
+    return "".join(out)
+
+
+def decode(text, precision=PRECISION):
+    factor = float(10 ** precision)
+    coords = []
+    index = lat = lon = 0
+    while index < len(text):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(text[index]) - 63
+                index += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        coords.append([lat / factor, lon / factor])
+    return coords
+
+
+def encode_route(route, precision=PRECISION):
+    segments = []
+    for segment in route.get("segments", []):
+        segment = dict(segment)
+        segment["polyline"] = encode(segment.pop("coords", []), precision)
+        segments.append(segment)
+    return {**route, "segments": segments}
@@ -0,0 +1,50 @@
+import sys
+import time
+import threading
+from collections import Counter
+
+
+class SamplingProfiler:
+    # Wall-clock sampler over every thread's stack; output is in collapsed-stack format
+    # ("frame;frame;frame count"), ready for flamegraph.pl or speedscope.
+    def __init__(self, hz=100, max_depth=64):
+        self.interval = 1.0 / hz
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        next_tick = time.perf_counter()
+        while not self.stop_event.is_set():
+            self.sample()
+            next_tick += self.interval
+            self.stop_event.wait(max(0.0, next_tick - time.perf_counter()))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        return self
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import threading
+from backend.core.region import default_region
+
+ROAD_NODE = {"RoadNode": {"properties": ["lat", "lon"]}}
+ROAD_SEGMENT = {"ROAD_SEGMENT": {"properties": "cost", "orientation": "UNDIRECTED"}}
+
+# Single definition of every GDS projection; walk and drive searches get road-only graphs so that
+# they never filter relationship types at query time.
+PROJECTIONS = {
+    "road": (ROAD_NODE, ROAD_SEGMENT),
+    "walk": (
+        {**ROAD_NODE, "Station": {"properties": ["lat", "lon"]}},
+        {**ROAD_SEGMENT, "WALK_TO": {"properties": "cost", "orientation": "UNDIRECTED"}},
+    ),
+    "multimodal": (
+        {
+            **ROAD_NODE,
+            "Station": {"properties": ["lat", "lon"]},
+            "TripEvent": {"properties": ["lat", "lon", "time"]},
+        },
+        {
+            **ROAD_SEGMENT,
+            "WALK_TO": {"properties": "cost", "orientation": "UNDIRECTED"},
+            "HAS_EVENT": {"properties": "cost"},
+            "AT_STATION": {"properties": "cost"},
+        },
+    ),
+}
+MODES = {"transit": "multimodal", "walk": "walk"}
+
+
+def stamp(db, labels):
+    # Writes that can change projected properties bump their labels' stamps first; versions include the
+    # stamps, so moved nodes or new costs re-project even when no count changes.
+    db.write("UNWIND $labels AS label MERGE (s:WriteStamp {label: label}) SET s.n = coalesce(s.n, 0) + 1",
+             {"labels": sorted(labels)})
+
+
+def projection_for(mode):
+    return MODES.get(mode, "road")
+
+
+class ProjectionUnavailable(Exception):
+    pass
+
+
+class ProjectionManager:
+    # Methods take the base projection name; the catalog name is prefixed per region.
+    def __init__(self, names=None, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
+        self.names = names or os.getenv("GDS_PROJECTIONS", ",".join(PROJECTIONS)).split(",")
+        self.lock = threading.Lock()
+        self.rebuilding = set()
+
+    def version(self, name):
+        # Count-store lookups are O(1) and catch added or removed data; write stamps catch updates in place.
+        nodes, rels = PROJECTIONS[name]
+        counts = {}
+        for label in nodes:
+            counts[label] = self.db.query(f"MATCH (n:{label}) RETURN count(n) AS c")[0]["c"]
+        for rel_type in rels:
+            counts[rel_type] = self.db.query(f"MATCH ()-[r:{rel_type}]->() RETURN count(r) AS c")[0]["c"]
+        rows = self.db.query("MATCH (s:WriteStamp) WHERE s.label IN $labels RETURN s.label AS label, s.n AS n",
+                             {"labels": list(nodes) + list(rels)})
+        stamps = {row["label"]: row["n"] for row in rows}
+        payload = json.dumps([nodes, rels, counts, stamps], sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def exists(self, name):
+        return self.db.query("CALL gds.graph.exists($name) YIELD exists RETURN exists",
+                             {"name": self.region.projection(name)})[0]["exists"]
+
+    def stored_version(self, name):
+        rows = self.db.query("MATCH (m:ProjectionMeta {name: $name}) RETURN m.version AS version",
+                             {"name": self.region.projection(name)})
+        return rows[0]["version"] if rows else None
+
+    def ensure(self, name):
+        version = self.version(name)
+        if self.exists(name) and self.stored_version(name) == version:
+            print(f"GDS projection '{self.region.projection(name)}' is current, reusing it.")
+            return False
+        self.project(name, version)
+        return True
+
+    def ensure_all(self):
+        for name in self.names:
+            self.ensure(name)
+
+    def project(self, name, version=None):
+        version = version or self.version(name)
+        nodes, rels = PROJECTIONS[name]
+        graph = self.region.projection(name)
+        print(f"Projecting GDS graph '{graph}'...")
+        self.db.write("CALL gds.graph.drop($name, false)", {"name": graph})
+        self.db.write("CALL gds.graph.project($name, $nodes, $rels)", {"name": graph, "nodes": nodes, "rels": rels})
+        self.db.write("MERGE (m:ProjectionMeta {name: $name}) SET m.version = $version",
+                      {"name": graph, "version": version})
+
+    def drop_all(self):
+        # Frees the projections' heap; ensure() re-projects them when the region is loaded again.
+        for name in self.names:
+            self.db.write("CALL gds.graph.drop($name, false)", {"name": self.region.projection(name)})
+
+    def rebuild_in_background(self, name):
+        with self.lock:
+            if name in self.rebuilding:
+                return
+            self.rebuilding.add(name)
+
+        def run():
+            try:
+                self.ensure(name)
+            except Exception as e:
+                print(f"Background projection of '{name}' failed: {e}")
+            finally:
+                with self.lock:
+                    self.rebuilding.discard(name)
+
+        threading.Thread(target=run, daemon=True).start()
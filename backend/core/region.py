@@ -0,0 +1,114 @@
+import os
+import json
+import numpy as np
+from backend.core import graph_store
+from backend.core.database import Neo4jConnector, AsyncNeo4jConnector
+
+DEFAULT = "default"
+DEFAULT_BBOX = "17.2,78.2,17.8,79.2"
+DEFAULT_GTFS_URL = "https://storage.googleapis.com/tumi-transit-data/hyderabad/hyderabad_gtfs.zip"
+
+
+class Region:
+    # One independently ingested area: its own database, graph store, projections and indexes.
+    # The default region keeps the single-region layout (root store, unprefixed projections).
+    def __init__(self, name, bbox, osm_file=None, gtfs_url=None, gtfs_rt_url=None, neo4j_uri=None,
+                 database=None, preload=False):
+        self.name = name
+        self.bbox = tuple(float(v) for v in bbox)  # (min_lat, min_lon, max_lat, max_lon)
+        self.osm_file = osm_file
+        self.gtfs_url = gtfs_url
+        self.gtfs_rt_url = gtfs_rt_url
+        self.neo4j_uri = neo4j_uri
+        self.database = database
+        self.preload = preload
+        base = os.getenv("DATA_DIR", "/app/data")
+        self.data_dir = base if self.is_default else os.path.join(base, "regions", name)
+
+    @property
+    def is_default(self):
+        return self.name == DEFAULT
+
+    def store_dir(self, name=None):
+        return graph_store.store_dir(name, region=None if self.is_default else self.name)
+
+    def projection(self, name):
+        return name if self.is_default else f"{self.name}_{name}"
+
+    def connector(self):
+        return Neo4jConnector(self.neo4j_uri, self.database)
+
+    def async_connector(self):
+        return AsyncNeo4jConnector(self.neo4j_uri, self.database)
+
+    def overpass_bbox(self):
+        return ",".join(str(v) for v in self.bbox)
+
+    def contains(self, lat, lon):
+        return self.bbox[0] <= lat <= self.bbox[2] and self.bbox[1] <= lon <= self.bbox[3]
+
+    def __repr__(self):
+        return f"Region({self.name!r}, {self.bbox})"
+
+
+def default_region():
+    return Region(DEFAULT, os.getenv("OSM_BBOX", DEFAULT_BBOX).split(","), osm_file=os.getenv("OSM_FILE"),
+                  gtfs_url=os.getenv("HYDERABAD_GTFS_URL", DEFAULT_GTFS_URL),
+                  gtfs_rt_url=os.getenv("GTFS_RT_URL"), preload=True)
+
+
+def load_regions(path=None):
+    # REGIONS_FILE lists the regions as JSON; without it the environment describes one default region.
+    path = path or os.getenv("REGIONS_FILE")
+    if not path:
+        return [default_region()]
+    with open(path) as f:
+        config = json.load(f)
+    regions = []
+    for entry in config["regions"] if isinstance(config, dict) else config:
+        bbox = entry["bbox"]
+        regions.append(Region(entry["name"], bbox.split(",") if isinstance(bbox, str) else bbox,
+                              osm_file=entry.get("osm_file"), gtfs_url=entry.get("gtfs_url"),
+                              gtfs_rt_url=entry.get("gtfs_rt_url"), neo4j_uri=entry.get("neo4j_uri"),
+                              database=entry.get("database"), preload=entry.get("preload", False)))
+    if not regions:
+        raise ValueError(f"{path} lists no regions.")
+    names = [r.name for r in regions]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{path} repeats a region name.")
+    # Ingestion decides what to load by looking at the database, so every region needs its own.
+    stores = [(r.neo4j_uri, r.database) for r in regions]
+    if len(set(stores)) != len(stores):
+        raise ValueError(f"{path}: every region needs its own neo4j_uri or database.")
+    return regions
+
+
+class RegionIndex:
+    # Bounding boxes of all regions; a point set goes to the smallest region that contains all of it.
+    def __init__(self, regions):
+        self.regions = list(regions)
+        self.boxes = np.asarray([r.bbox for r in self.regions], dtype=np.float64).reshape(-1, 4)
+        self.areas = (self.boxes[:, 2] - self.boxes[:, 0]) * (self.boxes[:, 3] - self.boxes[:, 1])
+
+    def locate(self, points):
+        # Returns the Region serving every (lat, lon) in points, or None if no single region does.
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if not len(pts) or not len(self.regions):
+            return None
+        lats, lons = pts[:, 0][:, None], pts[:, 1][:, None]
+        inside = ((lats >= self.boxes[:, 0]) & (lons >= self.boxes[:, 1]) &
+                  (lats <= self.boxes[:, 2]) & (lons <= self.boxes[:, 3])).all(axis=0)
+        if not inside.any():
+            return None
+        return self.regions[int(np.argmin(np.where(inside, self.areas, np.inf)))]
+
+    def intersecting(self, min_lat, min_lon, max_lat, max_lon):
+        hit = ((self.boxes[:, 0] <= max_lat) & (self.boxes[:, 2] >= min_lat) &
+               (self.boxes[:, 1] <= max_lon) & (self.boxes[:, 3] >= min_lon))
+        return [self.regions[i] for i in np.flatnonzero(hit)]
+
+    def bounds(self):
+        if not len(self.regions):
+            return None
+        return {"min_lat": float(self.boxes[:, 0].min()), "min_lon": float(self.boxes[:, 1].min()),
+                "max_lat": float(self.boxes[:, 2].max()), "max_lon": float(self.boxes[:, 3].max())}
@@ -0,0 +1,258 @@
+import os
+import time
+import fcntl
+import asyncio
+import threading
+from collections import OrderedDict
+from backend.core.bootstrapper import Bootstrapper
+from backend.core.region import RegionIndex, load_regions
+from backend.core.routing import MultimodalRouter
+from backend.ingestion.realtime_feeder import RealtimeFeeder
+
+
+class RegionUnavailable(Exception):
+    pass
+
+
+class RegionManager:
+    # One router per region, ingested and loaded on first use. Regions idle for REGION_IDLE_TTL
+    # seconds (0 = never) are evicted, and at most REGION_MAX_LOADED (0 = unlimited) stay loaded,
+    # least recently used first. Preloaded regions load at startup and are never evicted. Every
+    # REGION_SYNC_INTERVAL seconds loaded regions apply the changes other processes announced.
+    def __init__(self, regions=None, idle_ttl=None, max_loaded=None):
+        self.regions = {r.name: r for r in (regions or load_regions())}
+        self.index = RegionIndex(self.regions.values())
+        self.idle_ttl = idle_ttl if idle_ttl is not None else float(os.getenv("REGION_IDLE_TTL", "1800"))
+        self.max_loaded = max_loaded if max_loaded is not None else int(os.getenv("REGION_MAX_LOADED", "0"))
+        self.sync_interval = float(os.getenv("REGION_SYNC_INTERVAL", "5"))
+        self.routers = OrderedDict()
+        self.feeders = {}
+        self.last_used = {}
+        self.lock = threading.Lock()
+        self.loading = {name: threading.Lock() for name in self.regions}
+        self.holds = {}
+        self.stop_event = threading.Event()
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.regions)
+
+    def locate(self, points):
+        region = self.index.locate(points)
+        if region is None:
+            raise RegionUnavailable("The requested points are not covered by a single configured region.")
+        return region
+
+    async def router_for(self, points):
+        return await self.router(self.locate(points).name)
+
+    async def router(self, name):
+        router = self._touch(name)
+        if router is not None:
+            return router
+        # Ingestion and loading block for a while; keep them off the event loop.
+        return await asyncio.to_thread(self.get, name)
+
+    def _touch(self, name):
+        with self.lock:
+            router = self.routers.get(name)
+            if router is not None:
+                self.routers.move_to_end(name)
+                self.last_used[name] = time.monotonic()
+            return router
+
+    def get(self, name):
+        with self.loading[name]:
+            router = self._touch(name)
+            if router is not None:
+                return router
+            region = self.regions[name]
+            started = time.time()
+            bootstrapper = Bootstrapper(region)
+            self._hold(name)
+            try:
+                bootstrapper.run()
+                router = MultimodalRouter(region)
+                router.load()
+                feeder = None
+                if region.gtfs_rt_url:
+                    feeder = RealtimeFeeder(region.gtfs_rt_url, cache=router.cache, transit=router.transit,
+                                            region=region).start()
+            except Exception:
+                # A failed load must not keep other workers from ever dropping the region's projections.
+                self._unlock(name)
+                raise
+            with self.lock:
+                self.routers[name] = router
+                if feeder is not None:
+                    self.feeders[name] = feeder
+                self.last_used[name] = time.monotonic()
+                self.loads += 1
+            print(f"Region '{name}' loaded in {time.time() - started:.1f}s.")
+        self._enforce_limit(name)
+        return router
+
+    def refresh(self, name):
+        # Applies feed changes to the region's database and stores; every worker, this one included, then
+        # picks them up from the store version.
+        with self.loading[name]:
+            summary = Bootstrapper(self.regions[name]).refresh()
+        self.sync(name)
+        return summary
+
+    def sync(self, name):
+        with self.loading[name]:
+            with self.lock:
+                router = self.routers.get(name)
+                feeder = self.feeders.get(name)
+            if router is None:
+                return None
+            summary = router.sync()
+            if summary is not None and summary["gtfs"] and feeder is not None:
+                feeder.attach(router.transit)
+            return summary
+
+    def evict(self, name):
+        # Under the region's loading lock, so a reload in this worker cannot race the release below.
+        with self.loading[name]:
+            with self.lock:
+                router = self.routers.pop(name, None)
+                feeder = self.feeders.pop(name, None)
+                self.last_used.pop(name, None)
+            if router is None:
+                return False
+            if feeder is not None:
+                feeder.stop()
+            # The mmapped arrays go with the last reference to the router. The projections are shared by
+            # every worker, so they are dropped only by the last worker to let go of the region.
+            if self._release(name):
+                try:
+                    router.projections.drop_all()
+                except Exception as e:
+                    print(f"Dropping projections of region '{name}' failed: {e}")
+                finally:
+                    self._unlock(name)
+        with self.lock:
+            self.evictions += 1
+        print(f"Region '{name}' evicted.")
+        return True
+
+    def _hold(self, name):
+        # Every worker with the region loaded holds a shared lock on it; flock releases it if the worker dies.
+        if name not in self.holds:
+            lock = open(os.path.join(self.regions[name].data_dir, ".serving.lock"), "w")
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            self.holds[name] = lock
+
+    def _release(self, name):
+        # True, with the lock held exclusively, when no other worker still serves the region.
+        lock = self.holds.get(name)
+        if lock is None:
+            return False
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            self._unlock(name)
+            return False
+
+    def _unlock(self, name):
+        lock = self.holds.pop(name)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [name for name, used in self.last_used.items()
+                    if not self.regions[name].preload and now - used > self.idle_ttl]
+        return [name for name in idle if self.evict(name)]
+
+    def _enforce_limit(self, keep):
+        while self.max_loaded:
+            with self.lock:
+                victims = [name for name in self.routers if name != keep and not self.regions[name].preload]
+                if len(self.routers) <= self.max_loaded or not victims:
+                    return
+            self.evict(victims[0])
+
+    def run(self):
+        every = max(min(self.idle_ttl / 4, 60.0), 1.0)
+        checked = time.monotonic()
+        while not self.stop_event.wait(self.sync_interval):
+            for name in self.loaded():
+                try:
+                    self.sync(name)
+                except Exception as e:
+                    print(f"Syncing region '{name}' failed: {e}")
+            if self.idle_ttl > 0 and time.monotonic() - checked >= every:
+                checked = time.monotonic()
+                try:
+                    self.evict_idle()
+                except Exception as e:
+                    print(f"Region eviction failed: {e}")
+
+    def start(self):
+        for name, region in self.regions.items():
+            if region.preload:
+                self.get(name)
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        with self.lock:
+            feeders = list(self.feeders.values())
+        for feeder in feeders:
+            feeder.stop()
+
+    def loaded(self):
+        with self.lock:
+            return dict(self.routers)
+
+    def loaded_feeders(self):
+        with self.lock:
+            return dict(self.feeders)
+
+    async def route_batch(self, requests, admit=None):
+        # Same contract as MultimodalRouter.route_batch, with each request sent to its own region.
+        groups = {}
+        for i, r in enumerate(requests):
+            region = self.index.locate([(r[0], r[1]), (r[2], r[3])])
+            if region is None:
+                yield i, {"segments": [], "totalCost": -1, "totalDistance": 0,
+                          "error": "Points are not covered by a single configured region."}
+            else:
+                groups.setdefault(region.name, []).append(i)
+        for name, indices in groups.items():
+            # A region that fails to load, or a batch that fails before its routes run, errors only its own lines.
+            sent = set()
+            try:
+                router = await self.router(name)
+                async for j, path in router.route_batch([requests[i] for i in indices], admit):
+                    sent.add(j)
+                    yield indices[j], path
+            except Exception as e:
+                error = {"segments": [], "totalCost": -1, "totalDistance": 0,
+                         "error": f"Region '{name}' failed: {e}"}
+                for j, i in enumerate(indices):
+                    if j not in sent:
+                        yield i, error
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "configured": len(self.regions),
+                "loaded": len(self.routers),
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "idle_ttl": self.idle_ttl,
+                "max_loaded": self.max_loaded,
+                "regions": {
+                    name: {"bbox": list(region.bbox), "preload": region.preload, "loaded": name in self.routers,
+                           "idle_s": round(now - self.last_used[name], 1) if name in self.last_used else None}
+                    for name, region in self.regions.items()
+                },
+            }
@@ -0,0 +1,189 @@
+import heapq
+import numpy as np
+from backend.core import admission, graph_store, polyline
+from backend.core.geo import point_distance
+
+WALK_SPEED = 1.4
+MAX_DRIVE_SPEED = 100.0 / 3.6
+INF = float('inf')
+ARRAYS = ("node_ids", "id_order", "lats", "lons", "offsets", "targets", "cost", "distance",
+          "geom_offsets", "geom_lats", "geom_lons")
+
+
+class RoadGraph:
+    def __init__(self, node_ids, id_order, lats, lons, offsets, targets, cost, distance,
+                 geom_offsets, geom_lats, geom_lons):
+        self.node_ids = node_ids
+        self.id_order = id_order
+        self.lats = lats
+        self.lons = lons
+        self.offsets = offsets
+        self.targets = targets
+        self.cost = cost
+        self.distance = distance
+        # Shape points of simplified edges, between (not including) the two end nodes.
+        self.geom_offsets = geom_offsets
+        self.geom_lats = geom_lats
+        self.geom_lons = geom_lons
+
+    @classmethod
+    def from_edges(cls, node_ids, lats, lons, src, dst, cost, distance, geometry=None):
+        node_ids = np.asarray([str(i) for i in node_ids])
+        src = np.asarray(src, dtype=np.int32)
+        order = np.argsort(src, kind="stable")
+        offsets = np.searchsorted(src[order], np.arange(len(node_ids) + 1)).astype(np.int64)
+        shapes = [polyline.decode(geometry[e]) if geometry and geometry[e] else [] for e in order.tolist()]
+        points = [p for shape in shapes for p in shape]
+        return cls(
+            node_ids, np.argsort(node_ids, kind="stable").astype(np.int32),
+            np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64),
+            offsets, np.asarray(dst, dtype=np.int32)[order],
+            np.asarray(cost, dtype=np.float64)[order], np.asarray(distance, dtype=np.float64)[order],
+            np.concatenate([[0], np.cumsum([len(shape) for shape in shapes], dtype=np.int64)]).astype(np.int64),
+            np.asarray([p[0] for p in points], dtype=np.float64),
+            np.asarray([p[1] for p in points], dtype=np.float64),
+        )
+
+    @classmethod
+    def from_neo4j(cls, db):
+        nodes = db.query("MATCH (n:RoadNode) RETURN n.id AS id, n.lat AS lat, n.lon AS lon")
+        index = {r["id"]: i for i, r in enumerate(nodes)}
+        edges = db.query("""
+        MATCH (u:RoadNode)-[r:ROAD_SEGMENT]->(v:RoadNode)
+        RETURN u.id AS u, v.id AS v, r.cost AS cost, r.distance AS distance, r.geometry AS geometry
+        """)
+        return cls.from_edges(
+            [r["id"] for r in nodes],
+            [r["lat"] for r in nodes],
+            [r["lon"] for r in nodes],
+            [index[e["u"]] for e in edges],
+            [index[e["v"]] for e in edges],
+            [e["cost"] for e in edges],
+            [e["distance"] for e in edges],
+            [e["geometry"] for e in edges],
+        )
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    @property
+    def sources(self):
+        return np.repeat(np.arange(len(self.node_ids), dtype=np.int32), np.diff(self.offsets))
+
+    def lookup(self, node_id):
+        node_id = str(node_id)
+        k = int(np.searchsorted(self.node_ids, node_id, sorter=self.id_order))
+        if k < len(self.id_order) and self.node_ids[self.id_order[k]] == node_id:
+            return int(self.id_order[k])
+        return None
+
+    def weights(self, profile):
+        if profile == 'walk':
+            return self.distance / WALK_SPEED
+        return self.cost
+
+    @classmethod
+    def exists(cls, directory):
+        return graph_store.exists(directory, ARRAYS)
+
+    def save(self, directory):
+        graph_store.save_arrays(directory, {name: getattr(self, name) for name in ARRAYS})
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        arrays = graph_store.load_arrays(directory, ARRAYS, mmap_mode)
+        return cls(*(arrays[name] for name in ARRAYS))
+
+    def astar(self, s, t, profile):
+        if profile == 'walk':
+            weights, scale, speed = self.distance, 1.0 / WALK_SPEED, WALK_SPEED
+        else:
+            weights, scale, speed = self.cost, 1.0, MAX_DRIVE_SPEED
+        t_lat, t_lon = float(self.lats[t]), float(self.lons[t])
+        lats, lons = self.lats, self.lons
+
+        def h(v):
+            return point_distance(float(lats[v]), float(lons[v]), t_lat, t_lon) / speed
+
+        dist = {s: 0.0}
+        parent = {s: -1}
+        heap = [(h(s), s)]
+        closed = set()
+        deadline = admission.current()
+        while heap:
+            _, x = heapq.heappop(heap)
+            if x in closed:
+                continue
+            closed.add(x)
+            if deadline is not None and not len(closed) & 1023:
+                deadline.check()
+            if x == t:
+                break
+            d = dist[x]
+            a, b = int(self.offsets[x]), int(self.offsets[x + 1])
+            for y, w, e in zip(self.targets[a:b].tolist(), weights[a:b].tolist(), range(a, b)):
+                nd = d + w * scale
+                if nd < dist.get(y, INF):
+                    dist[y] = nd
+                    parent[y] = e
+                    heapq.heappush(heap, (nd + h(y), y))
+        if t not in dist:
+            return None
+        path, edges = [t], []
+        while path[-1] != s:
+            e = parent[path[-1]]
+            edges.append(e)
+            path.append(int(np.searchsorted(self.offsets, e, side="right") - 1))
+        path.reverse()
+        return dist[t], float(self.distance[edges].sum()), path
+
+    def coords(self, path, profile='drive'):
+        # Expand a node path into [lat, lon] pairs, restoring the shape points of simplified edges.
+        weights = self.distance if profile == 'walk' else self.cost
+        out = [[float(self.lats[path[0]]), float(self.lons[path[0]])]] if len(path) else []
+        for x, y in zip(path, path[1:]):
+            a, b = int(self.offsets[x]), int(self.offsets[x + 1])
+            hits = a + np.flatnonzero(self.targets[a:b] == y)
+            if len(hits):
+                e = int(hits[np.argmin(weights[hits])])
+                g0, g1 = int(self.geom_offsets[e]), int(self.geom_offsets[e + 1])
+                if g1 > g0:
+                    out.extend(np.column_stack((self.geom_lats[g0:g1], self.geom_lons[g0:g1])).tolist())
+            out.append([float(self.lats[y]), float(self.lons[y])])
+        return out
+
+    def dijkstra(self, sources, profile, limit=INF, targets=None):
+        if profile == 'walk':
+            weights, scale = self.distance, 1.0 / WALK_SPEED
+        else:
+            weights, scale = self.cost, 1.0
+        dist = {}
+        heap = []
+        for s, d in sources:
+            if d < dist.get(s, (INF,))[0]:
+                dist[s] = (d, 0.0)
+                heapq.heappush(heap, (d, s))
+        remaining = set(targets) if targets is not None else None
+        settled = {}
+        deadline = admission.current()
+        while heap:
+            d, x = heapq.heappop(heap)
+            if x in settled:
+                continue
+            if d > limit:
+                break
+            settled[x] = dist[x]
+            if deadline is not None and not len(settled) & 1023:
+                deadline.check()
+            length = dist[x][1]
+            if remaining is not None:
+                remaining.discard(x)
+                if not remaining:
+                    break
+            a, b = int(self.offsets[x]), int(self.offsets[x + 1])
+            for y, w, l in zip(self.targets[a:b].tolist(), weights[a:b].tolist(), self.distance[a:b].tolist()):
+                nd = d + w * scale
+                if nd <= limit and nd < dist.get(y, (INF,))[0]:
+                    dist[y] = (nd, length + l)
+                    heapq.heappush(heap, (nd, y))
+        return settled
@@ -1,170 +1,615 @@
-from backend.core.database import Neo4jConnector
+import os
+import time
+import asyncio
+import numpy as np
+from backend.core.region import default_region
+from backend.core.spatial import SpatialIndex
+from backend.core.transit import TransitEngine
+from backend.core.road_graph import RoadGraph
+from backend.core.ch import ContractionHierarchy
+from backend.core.cache import RouteCache
+from backend.core.projection import ProjectionManager, ProjectionUnavailable, projection_for
+from backend.core.road_graph import WALK_SPEED
+from backend.core import admission, graph_store, isochrone, polyline
+from backend.core.geo import haversine
+from backend.core.tiles import TileStore
+from backend.core.metrics import timed
+from backend.core.ev import EVPlanner, charger_power
 
 class MultimodalRouter:
-    def __init__(self):
-        self.db = Neo4jConnector()
-
-    def find_path(self, start_lat, start_lon, end_lat, end_lon, mode='transit'):
-        snap_query = """
-        MATCH (s:RoadNode) 
-        WITH s, point.distance(s.location, point({latitude: $start_lat, longitude: $start_lon})) AS d 
-        ORDER BY d LIMIT 1
-        MATCH (e:RoadNode) 
-        WITH s, e, point.distance(e.location, point({latitude: $end_lat, longitude: $end_lon})) AS d 
-        ORDER BY d LIMIT 1
-        RETURN s.id as start_node, e.id as end_node, 
-               point.distance(s.location, point({latitude: $start_lat, longitude: $start_lon})) as start_dist,
-               point.distance(e.location, point({latitude: $end_lat, longitude: $end_lon})) as end_dist
-        """
-        params = {
-            "start_lat": start_lat, "start_lon": start_lon,
-            "end_lat": end_lat, "end_lon": end_lon
-        }
-        snap_res = self.db.query(snap_query, params)
-        if not snap_res:
+    ev_query = """
+    MATCH (n:EVPoint)
+    RETURN n.id AS id, n.location.latitude AS lat, n.location.longitude AS lon, n.charger_type AS type
+    """
+
+    def __init__(self, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
+        self.adb = self.region.async_connector()
+        self.road_index = None
+        self.station_index = None
+        self.ev_index = None
+        self.transit = None
+        self.road_graph = None
+        self.hierarchies = {}
+        self.cache = RouteCache()
+        self.projections = ProjectionManager(region=self.region)
+        self.departure_bucket = int(os.getenv("ROUTE_CACHE_BUCKET", "300"))
+        self.gtfs_dir = os.path.join(self.region.data_dir, "gtfs")
+        self.isochrone_cell = float(os.getenv("ISOCHRONE_CELL_SIZE", "200"))
+        # Searches in flight per batch. They run on threads and the pure-Python scans hold the GIL, so this
+        # overlaps Neo4j I/O and numpy work; it does not spread a batch across cores.
+        self.batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", str(os.cpu_count() or 4)))
+        self.batch_route_timeout = float(os.getenv("BATCH_ROUTE_TIMEOUT", os.getenv("REQUEST_TIMEOUT", "15")))
+        self.attachments = {}
+        self.tiles = TileStore()
+        self.ev_planner = None
+        self.ev_power = None
+        self.ev_default_kw = float(os.getenv("EV_DEFAULT_CHARGER_KW", "22"))
+        self.version_stamp = None
+        self.versions = {}
+
+    def load(self):
+        # Read before the stores, so a change announced during the load is applied again rather than missed.
+        self.version_stamp, self.versions = self.read_versions()
+        self.load_indexes()
+        self.load_transit()
+        self.load_hierarchies()
+        self.load_ev()
+        self.load_tiles()
+
+    def refresh(self, summary):
+        # Picks up a FeedRefresher run: reloads what it rebuilt and drops the cached routes it affects.
+        if summary["roads"]:
+            self.attachments.clear()
+            self.load_indexes()
+            if summary["gtfs"]:
+                self.load_transit()
+            self.load_hierarchies()
+            self.load_ev()
+            self.load_tiles()
+            self.cache.clear()
+        elif summary["gtfs"]:
+            self.attachments.pop('stops', None)
+            self.attachments.pop('stations', None)
+            self.load_indexes()
+            self.load_transit()
+            self.load_tiles()
+            gtfs = summary["gtfs"]
+            if not gtfs["stops"] and not gtfs["transfers"] and gtfs["stop_times"] == gtfs.get("stop_times_removed"):
+                # Removed trips can only worsen the routes that rode them.
+                self.cache.invalidate_trips(summary["trips"])
+            else:
+                # New or retimed trips, moved stops and relinked transfers can improve any transit route.
+                self.cache.invalidate_mode('transit')
+
+    def read_versions(self):
+        store = self.region.store_dir()
+        stamp = graph_store.version_stamp(store)
+        return stamp, {key: entry["n"] for key, entry in graph_store.read_version(store).items()}
+
+    def sync(self):
+        # Applies the changes other processes announced in the store's VERSION.json since the last sync;
+        # returns the refresh summary applied, if any. Missing more than one refresh reloads everything.
+        if graph_store.version_stamp(self.region.store_dir()) == self.version_stamp:
+            return None
+        self.version_stamp = graph_store.version_stamp(self.region.store_dir())
+        version = graph_store.read_version(self.region.store_dir())
+        applied = None
+        data = version.get("data")
+        if data is not None and data["n"] != self.versions.get("data", 0):
+            if data["n"] == self.versions.get("data", 0) + 1:
+                applied = data["summary"]
+            else:
+                applied = {"roads": True, "gtfs": True, "trips": []}
+            self.refresh(applied)
+            self.versions["data"] = data["n"]
+        evs = version.get("evs")
+        if evs is not None and evs["n"] != self.versions.get("evs", 0):
+            self.reload_evs()
+            self.versions["evs"] = evs["n"]
+        return applied
+
+    def announced(self, key, n):
+        # Change n was made and applied by this worker; if it missed an earlier one, sync reloads instead.
+        if self.versions.get(key, 0) == n - 1:
+            self.versions[key] = n
+
+    def load_indexes(self):
+        road_index_dir = self.region.store_dir("road_index")
+        if SpatialIndex.exists(road_index_dir):
+            self.road_index = SpatialIndex.load(road_index_dir)
+        else:
+            roads = self.db.query("MATCH (n:RoadNode) RETURN n.id AS id, n.lat AS lat, n.lon AS lon")
+            self.road_index = SpatialIndex.from_records(roads)
+        stations = self.db.query("MATCH (s:Station) RETURN s.id AS id, s.lat AS lat, s.lon AS lon")
+        evs = self.db.query(self.ev_query)
+        self.station_index = SpatialIndex.from_records(stations)
+        self.ev_index = SpatialIndex.from_records(evs)
+        power = {r["id"]: charger_power(r["type"], self.ev_default_kw) for r in evs}
+        self.ev_power = np.asarray([power[i] for i in self.ev_index.ids.tolist()], dtype=np.float64)
+        print(f"Spatial indexes ready: {len(self.road_index)} road nodes, "
+              f"{len(self.station_index)} stations, {len(self.ev_index)} EV points.")
+
+    def load_transit(self):
+        transit_dir = self.region.store_dir("transit")
+        if TransitEngine.exists(transit_dir):
+            self.transit = TransitEngine.load(transit_dir)
+        elif os.path.exists(os.path.join(self.gtfs_dir, "stop_times.txt")):
+            self.transit = TransitEngine.from_gtfs(self.gtfs_dir)
+        else:
+            print("No GTFS feed found, transit routing falls back to the graph projection.")
+            return
+        print(f"Transit engine ready: {len(self.transit.stop_ids)} stops, {len(self.transit)} connections.")
+
+    def load_hierarchies(self):
+        road_dir = self.region.store_dir("road")
+        if not RoadGraph.exists(road_dir):
+            print("No road graph in the store, road routing falls back to the graph projection.")
+            return
+        self.road_graph = RoadGraph.load(road_dir)
+        for profile in ('drive', 'walk'):
+            ch_dir = self.region.store_dir(f"ch_{profile}")
+            if ContractionHierarchy.exists(ch_dir):
+                self.hierarchies[profile] = ContractionHierarchy.load(ch_dir)
+        print(f"Road graph attached: {len(self.road_graph)} nodes, hierarchies {sorted(self.hierarchies)}.")
+
+    def load_tiles(self):
+        stations = self.db.query("MATCH (s:Station) RETURN s.name AS name, s.lat AS lat, s.lon AS lon")
+        evs = self.db.query(self.ev_query)
+        self.tiles.set_points("stations", stations, ("name",))
+        self.tiles.set_points("evs", evs, ("type",))
+        if self.road_graph is not None:
+            self.tiles.set_roads(self.road_graph)
+        self.tiles.precompute()
+
+    def load_ev(self):
+        # Chargers are attached to their nearest road node and their pairwise legs computed once.
+        if self.road_graph is None or self.ev_index is None:
+            return
+        started = time.time()
+        self.attachments.pop('evs', None)
+        nodes, _ = self._attach('evs', self.ev_index.lats, self.ev_index.lons)
+        self.ev_planner = EVPlanner(self.road_graph, self.hierarchies.get('drive'), nodes, self.ev_power)
+        print(f"EV planner ready: {len(self.ev_planner)} chargers in {time.time() - started:.1f}s.")
+
+    def reload_evs(self):
+        # Chargers imported through another worker: re-read from Neo4j, with the EV tiles and routes redone.
+        evs = self.db.query(self.ev_query)
+        ev_index = SpatialIndex.from_records(evs)
+        power = {r["id"]: charger_power(r["type"], self.ev_default_kw) for r in evs}
+        self.ev_power = np.asarray([power[i] for i in ev_index.ids.tolist()], dtype=np.float64)
+        self.ev_index = ev_index
+        self.tiles.set_points("evs", evs, ("type",))
+        self.load_ev()
+        self.cache.invalidate_mode('ev')
+
+    def upsert_evs(self, records):
+        # Chargers imported through this worker (validated EVPoint rows) go into the index, tiles and planner
+        # from memory; other workers reload them when the import is announced.
+        if self.ev_index is None:
+            return
+        records = list({r["id"]: r for r in records}.values())  # the last row of a repeated id wins
+        power = dict(zip(self.ev_index.ids.tolist(), self.ev_power.tolist()))
+        power.update((r["id"], charger_power(r["charger_type"], self.ev_default_kw)) for r in records)
+        ids, lats, lons = [r["id"] for r in records], [r["lat"] for r in records], [r["lon"] for r in records]
+        ids_before = self.ev_index.ids.tolist()
+        ev_index = self.ev_index.upsert(ids, lats, lons)
+        self.ev_power = np.asarray([power[i] for i in ev_index.ids.tolist()], dtype=np.float64)
+        self.ev_index = ev_index
+        self.tiles.upsert_points("evs", [{"id": r["id"], "lat": r["lat"], "lon": r["lon"], "type": r["charger_type"]}
+                                         for r in records], ("type",))
+        if self.ev_planner is not None and 'evs' in self.attachments:
+            # Only these chargers are attached and only their legs searched; the rest keep theirs.
+            started = time.time()
+            new_nodes, new_dists = self._snap_nodes(lats, lons)
+            nodes, dists = self.attachments['evs']
+            nodes, dists = np.concatenate([nodes, new_nodes]), np.concatenate([dists, new_dists])
+            at = dict(zip(ids_before + ids, range(len(nodes))))  # an upserted id takes its new attachment
+            order = np.asarray([at[i] for i in ev_index.ids.tolist()], dtype=np.int64)
+            self.attachments['evs'] = (nodes[order], dists[order])
+            self.ev_planner = self.ev_planner.extended(nodes[order], self.ev_power)
+            print(f"EV planner extended by {len(records)} chargers in {time.time() - started:.1f}s.")
+        else:
+            self.load_ev()
+        self.cache.invalidate_mode('ev')
+
+    def snap(self, points):
+        if self.road_index is None:
+            self.load_indexes()
+        return self.road_index.snap(points)
+
+    async def find_path(self, start_lat, start_lon, end_lat, end_lon, mode='transit', departure_time=None,
+                        vehicle=None):
+        with timed("route.snap", rows=2):
+            (start_id, end_id), _ = self.snap([(start_lat, start_lon), (end_lat, end_lon)])
+        return await self.route_snapped(start_lat, start_lon, end_lat, end_lon, start_id, end_id,
+                                        mode, departure_time, vehicle)
+
+    def route_key(self, start_id, end_id, mode, departure_time, vehicle=None):
+        bucket = None
+        if mode == 'ev':
+            bucket = vehicle
+        elif mode == 'transit':
+            if departure_time is None and self.transit is not None:
+                departure_time = self.transit.now_seconds()
+            if departure_time is not None:
+                bucket = departure_time // self.departure_bucket
+        return (start_id, end_id, mode, bucket), departure_time
+
+    async def route_snapped(self, start_lat, start_lon, end_lat, end_lon, start_id, end_id,
+                            mode='transit', departure_time=None, vehicle=None):
+        if start_id is None or end_id is None:
             return {"segments": [], "totalCost": -1, "totalDistance": 0}
-        
-        node = snap_res[0]
-
-        rel_types = []
-        if mode == 'transit':
-            rel_types = ['ROAD_SEGMENT', 'WALK_TO', 'HAS_EVENT', 'AT_STATION']
-        elif mode == 'walk':
-            rel_types = ['ROAD_SEGMENT', 'WALK_TO']
+        key, departure_time = self.route_key(start_id, end_id, mode, departure_time, vehicle)
+
+        async def compute():
+            if mode == 'ev':
+                with timed("route.ev"):
+                    return await asyncio.to_thread(self.ev_path, start_id, end_id, vehicle)
+            if mode == 'transit' and self.transit is not None:
+                with timed("route.transit"):
+                    return await asyncio.to_thread(self.transit.route, start_lat, start_lon, end_lat, end_lon,
+                                                   departure_time)
+            if mode != 'transit' and self.road_graph is not None:
+                with timed("route.road"):
+                    return await asyncio.to_thread(self.road_path, start_id, end_id,
+                                                   'walk' if mode == 'walk' else 'drive')
+            return await self.gds_path(start_id, end_id, mode)
+
+        return await self.cache.get_or_compute(key, compute)
+
+    async def route_batch(self, requests, admit=None):
+        # requests: (start_lat, start_lon, end_lat, end_lon, mode, departure_time[, vehicle]) tuples.
+        # Yields (index, path) in completion order; identical OD pairs are computed once. admit(mode, work,
+        # timeout), when given, runs each route under admission control with its own deadline.
+        points = [p for r in requests for p in ((r[0], r[1]), (r[2], r[3]))]
+        with timed("route.snap", rows=len(points)):
+            ids, _ = self.snap(points)
+        groups = {}
+        for i, r in enumerate(requests):
+            start_id, end_id = ids[2 * i], ids[2 * i + 1]
+            vehicle = r[6] if len(r) > 6 else None
+            key = self.route_key(start_id, end_id, r[4], r[5], vehicle)[0] \
+                if start_id is not None and end_id is not None else i
+            if key in groups:
+                groups[key][1].append(i)
+            else:
+                groups[key] = (tuple(r[:6]) + (vehicle, start_id, end_id), [i])
+
+        async def search(start_lat, start_lon, end_lat, end_lon, mode, departure_time, vehicle, start_id, end_id):
+            # Every route gets its own deadline, so one pathological pair cannot stall the stream.
+            if admit is not None:
+                return await admit(mode, lambda: self.route_snapped(
+                    start_lat, start_lon, end_lat, end_lon, start_id, end_id, mode, departure_time, vehicle),
+                    self.batch_route_timeout)
+            with admission.deadline(self.batch_route_timeout) as deadline:
+                try:
+                    return await self.route_snapped(start_lat, start_lon, end_lat, end_lon, start_id, end_id,
+                                                    mode, departure_time, vehicle)
+                except asyncio.CancelledError:
+                    deadline.cancel()
+                    raise
+
+        async def run(args, indices):
+            try:
+                path = await search(*args)
+            except ProjectionUnavailable as e:
+                path = {"segments": [], "totalCost": -1, "totalDistance": 0,
+                        "error": f"Graph projection '{e}' is being rebuilt."}
+            except admission.DeadlineExceeded as e:
+                path = {"segments": [], "totalCost": -1, "totalDistance": 0, "error": f"Route exceeded: {e}"}
+            except admission.Overloaded as e:
+                path = {"segments": [], "totalCost": -1, "totalDistance": 0, "error": str(e),
+                        "retryAfter": e.retry_after}
+            except Exception as e:
+                # Any other failure stays on its own line; raising would cut the stream for every route left.
+                path = {"segments": [], "totalCost": -1, "totalDistance": 0, "error": f"Route failed: {e}"}
+            return indices, path
+
+        # Keep a bounded window of searches in flight so memory stays flat for any batch size.
+        pending = set()
+        work = iter(groups.values())
+        try:
+            while True:
+                for args, indices in work:
+                    pending.add(asyncio.ensure_future(run(args, indices)))
+                    if len(pending) >= self.batch_concurrency:
+                        break
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    indices, path = task.result()
+                    for i in indices:
+                        yield i, path
+        finally:
+            # The client went away mid-stream: stop the searches nobody will read.
+            for task in pending:
+                task.cancel()
+
+    async def matrix(self, sources, targets, mode='drive', departure_time=None):
+        if mode == 'transit' and self.transit is not None:
+            if departure_time is None:
+                departure_time = self.transit.now_seconds()
+            durations = await asyncio.to_thread(self._transit_matrix, sources, targets, departure_time)
+            return self._matrix_result(durations, None)
+
+        ids, _ = self.snap(list(sources) + list(targets))
+        source_ids, target_ids = ids[:len(sources)], ids[len(sources):]
+        if mode != 'transit' and self.road_graph is not None:
+            profile = 'walk' if mode == 'walk' else 'drive'
+            costs, distances = await asyncio.to_thread(self._road_matrix, source_ids, target_ids, profile)
+            return self._matrix_result(costs, distances)
+
+        costs = np.full((len(sources), len(targets)), np.inf)
+        distances = np.full((len(sources), len(targets)), np.inf)
+        for i, (s_lat, s_lon) in enumerate(sources):
+            for j, (t_lat, t_lon) in enumerate(targets):
+                path = await self.find_path(s_lat, s_lon, t_lat, t_lon, mode, departure_time)
+                if path["totalCost"] >= 0:
+                    costs[i, j], distances[i, j] = path["totalCost"], path["totalDistance"]
+        return self._matrix_result(costs, distances)
+
+    def _transit_matrix(self, sources, targets, departure_time):
+        return np.array([self.transit.one_to_many(s, targets, departure_time) for s in sources], dtype=np.float64)
+
+    def _road_matrix(self, source_ids, target_ids, profile):
+        graph = self.road_graph
+        sources = [graph.lookup(i) if i is not None else None for i in source_ids]
+        targets = [graph.lookup(i) if i is not None else None for i in target_ids]
+        if profile in self.hierarchies:
+            return self.hierarchies[profile].many_to_many(sources, targets)
+
+        costs = np.full((len(sources), len(targets)), np.inf)
+        distances = np.full((len(sources), len(targets)), np.inf)
+        wanted = {t for t in targets if t is not None}
+        for i, s in enumerate(sources):
+            if s is None:
+                continue
+            settled = graph.dijkstra([(s, 0.0)], profile, targets=wanted)
+            for j, t in enumerate(targets):
+                if t in settled:
+                    costs[i, j], distances[i, j] = settled[t]
+        return costs, distances
+
+    def _matrix_result(self, costs, distances):
+        def flat(values):
+            values = np.where(np.isfinite(values), np.round(values, 1), -1)
+            return values.ravel().tolist()
+        rows, cols = costs.shape
+        return {
+            "rows": rows,
+            "cols": cols,
+            "durations": flat(costs),
+            "distances": flat(distances) if distances is not None else None,
+        }
+
+    async def isochrone(self, lat, lon, minutes, mode='walk', departure_time=None):
+        if mode == 'transit' and departure_time is None and self.transit is not None:
+            departure_time = self.transit.now_seconds()
+        return await asyncio.to_thread(self._isochrone, lat, lon, sorted(minutes), mode, departure_time)
+
+    def _isochrone(self, lat, lon, minutes, mode, departure_time):
+        graph = self.road_graph
+        profile = 'drive' if mode == 'drive' else 'walk'
+        limit = minutes[-1] * 60.0
+        start_id, snap_dist = self.road_index.nearest(lat, lon)
+        origin = graph.lookup(start_id) if start_id is not None else None
+        sources = [(origin, snap_dist / WALK_SPEED)] if origin is not None else []
+        if mode == 'transit' and self.transit is not None:
+            # Stops reached by transit become extra walk sources, offset by their arrival time.
+            stop_nodes, stop_dists = self._attach('stops', self.transit.stop_lats, self.transit.stop_lons)
+            for stop, t in self.transit.reachable((lat, lon), departure_time, limit).items():
+                node = stop_nodes[stop]
+                if node >= 0:
+                    sources.append((int(node), t + stop_dists[stop] / WALK_SPEED))
+        if profile in self.hierarchies:
+            costs = self.hierarchies[profile].one_to_all(sources)
         else:
-            rel_types = ['ROAD_SEGMENT']
+            costs = np.full(len(graph), np.inf)
+            for v, (c, _) in graph.dijkstra(sources, profile, limit=limit).items():
+                costs[v] = c
+
+        station_nodes, station_dists = self._attach('stations', self.station_index.lats, self.station_index.lons)
+        ev_nodes, ev_dists = self._attach('evs', self.ev_index.lats, self.ev_index.lons)
+
+        def reached(index, nodes, dists, budget):
+            if len(nodes) == 0:
+                return []
+            times = np.where(nodes >= 0, costs[nodes] + dists / WALK_SPEED, np.inf)
+            return index.ids[times <= budget].tolist()
+
+        results = []
+        for m in minutes:
+            budget = m * 60.0
+            mask = costs <= budget
+            results.append({
+                "minutes": m,
+                "polygon": isochrone.polygon(graph.lats[mask], graph.lons[mask], self.isochrone_cell),
+                "stations": reached(self.station_index, station_nodes, station_dists, budget),
+                "evs": reached(self.ev_index, ev_nodes, ev_dists, budget),
+            })
+        return {"mode": mode, "isochrones": results}
+
+    def _attach(self, name, lats, lons):
+        # Nearest road node (graph position, -1 when unmatched) and distance for every point.
+        if name not in self.attachments:
+            self.attachments[name] = self._snap_nodes(lats, lons)
+        return self.attachments[name]
+
+    def _snap_nodes(self, lats, lons):
+        ids, dists = self.road_index.snap(list(zip(np.asarray(lats).tolist(), np.asarray(lons).tolist())))
+        graph = self.road_graph
+        nodes = [graph.lookup(i) if i is not None else None for i in ids]
+        return np.asarray([-1 if v is None else v for v in nodes], dtype=np.int64), dists
 
+    def road_path(self, start_id, end_id, profile):
+        graph = self.road_graph
+        s, t = graph.lookup(start_id), graph.lookup(end_id)
+        res = None
+        if s is not None and t is not None:
+            if profile in self.hierarchies:
+                res = self.hierarchies[profile].query(s, t)
+            else:
+                res = graph.astar(s, t, profile)
+        if res is None:
+            return {"segments": [], "totalCost": -1, "totalDistance": 0}
+        total_cost, total_distance, path = res
+        coords = graph.coords(path, profile)
+        segment = {"mode": "WALK" if profile == 'walk' else "DRIVE", "coords": coords}
+        return {"segments": [segment], "totalCost": total_cost, "totalDistance": total_distance}
+
+    def ev_path(self, start_id, end_id, vehicle):
+        # vehicle: (state of charge 0-1, battery capacity kWh, consumption kWh/km)
+        soc, capacity, consumption = vehicle
+        empty = {"segments": [], "totalCost": -1, "totalDistance": 0}
+        if self.ev_planner is None:
+            return {**empty, "error": "EV routing needs the road graph."}
+        graph = self.road_graph
+        s, t = graph.lookup(start_id), graph.lookup(end_id)
+        plan = self.ev_planner.plan(s, t, soc, capacity, consumption) if s is not None and t is not None else None
+        if plan is None:
+            return {**empty, "error": "No charging plan reaches the destination."}
+        _, total_cost, stops = plan
+
+        ev_nodes, _ = self.attachments['evs']
+        waypoints = [start_id] + [str(graph.node_ids[ev_nodes[c]]) for c, _, _, _ in stops] + [end_id]
+        segments, distance, leg_distance = [], 0.0, 0.0
+        for a, b in zip(waypoints[:-1], waypoints[1:]):
+            leg = self.road_path(a, b, 'drive')
+            segments.extend(leg["segments"])
+            leg_distance = max(leg["totalDistance"], 0)
+            distance += leg_distance
+        energy = stops[-1][2] if stops else soc * capacity
+        return {
+            "segments": segments,
+            "totalCost": total_cost,
+            "totalDistance": distance,
+            "chargingStops": [{
+                "id": self.ev_index.ids[c:c + 1].tolist()[0],
+                "lat": float(self.ev_index.lats[c]),
+                "lon": float(self.ev_index.lons[c]),
+                "power_kw": float(self.ev_power[c]),
+                "arrival_soc": round(arrive / capacity, 3),
+                "departure_soc": round(depart / capacity, 3),
+                "charge_seconds": round(seconds, 1),
+            } for c, arrive, depart, seconds in stops],
+            "arrival_soc": round((energy - leg_distance / 1000.0 * consumption) / capacity, 3),
+        }
+
+    async def gds_path(self, start_id, end_id, mode):
+        name = projection_for(mode)
+        graph = self.region.projection(name)
         query = """
         MATCH (s:RoadNode {id: $start_id})
         MATCH (e:RoadNode {id: $end_id})
-        CALL gds.shortestPath.astar.stream('multimodal', {
+        CALL gds.shortestPath.astar.stream($graph, {
             sourceNode: s,
             targetNode: e,
             latitudeProperty: 'lat',
             longitudeProperty: 'lon',
-            relationshipWeightProperty: 'cost',
-            relationshipTypes: $rels
+            relationshipWeightProperty: 'cost'
         })
         YIELD index, sourceNode, targetNode, totalCost, nodeIds, costs, path
-        RETURN [nodeId IN nodeIds | gds.util.asNode(nodeId)] AS nodes, totalCost
+        WITH [nodeId IN nodeIds | gds.util.asNode(nodeId)] AS nodes, totalCost
+        CALL {
+            WITH nodes
+            UNWIND range(0, size(nodes) - 2) AS i
+            WITH i, nodes[i] AS a, nodes[i + 1] AS b
+            OPTIONAL MATCH (a)-[r:ROAD_SEGMENT]->(b)
+            WITH i, head(collect(r.geometry)) AS geometry
+            ORDER BY i
+            RETURN collect(coalesce(geometry, '')) AS geometries
+        }
+        RETURN [n IN nodes | n.lat] AS lats, [n IN nodes | n.lon] AS lons,
+               [n IN nodes | n:TripEvent] AS trips, totalCost, geometries
         """
         try:
-            results = self.db.query(query, {
-                "start_id": node['start_node'], 
-                "end_id": node['end_node'],
-                "rels": rel_types
-            })
+            with timed("gds.astar"):
+                results = await self.adb.query(query, {"start_id": start_id, "end_id": end_id, "graph": graph})
         except Exception as e:
-            if "GraphNotFoundException" in str(e):
-                project_query = """
-                CALL gds.graph.project(
-                  'multimodal',
-                  {
-                    RoadNode: {properties: ['lat', 'lon']},
-                    Station: {properties: ['lat', 'lon']},
-                    TripEvent: {properties: ['lat', 'lon', 'time']}
-                  },
-                  {
-                    ROAD_SEGMENT: {properties: 'cost', orientation: 'UNDIRECTED'},
-                    WALK_TO: {properties: 'cost', orientation: 'UNDIRECTED'},
-                    HAS_EVENT: {properties: 'cost'},
-                    AT_STATION: {properties: 'cost'}
-                  }
-                )
-                """
-                self.db.write(project_query)
-                results = self.db.query(query, {
-                    "start_id": node['start_node'], 
-                    "end_id": node['end_node'],
-                    "rels": rel_types
-                })
-            else:
-                raise e
-        
+            if "GraphNotFoundException" in str(e) or "does not exist" in str(e):
+                # Never project inside a request: rebuild in the background and let the client retry.
+                self.projections.rebuild_in_background(name)
+                raise ProjectionUnavailable(graph)
+            raise
+
         if not results:
             return {"segments": [], "totalCost": -1, "totalDistance": 0}
 
         res = results[0]
-        nodes = res.get('nodes', [])
         total_cost = res.get('totalCost', 0)
-        
         if total_cost == float('inf') or total_cost != total_cost:
              return {"segments": [], "totalCost": -1, "totalDistance": 0}
+        with timed("route.materialize", rows=len(res['lats'])):
+            return self._materialize(res['lats'], res['lons'], res['trips'], res['geometries'], total_cost)
+
+    def _materialize(self, lats, lons, trips, geometries, total_cost):
+        n = len(lats)
+        if n == 0:
+            return {"segments": [], "totalCost": -1, "totalDistance": 0}
+        # Splice the shape points of simplified road edges in after the node they start from.
+        shapes = [polyline.decode(g) if g else [] for g in geometries]
+        sizes = np.array([len(shape) for shape in shapes] + [0] * (n - len(shapes)), dtype=np.int64)[:n]
+        pos = np.arange(n) + np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        all_lats = np.empty(n + sizes.sum())
+        all_lons = np.empty(n + sizes.sum())
+        all_lats[pos], all_lons[pos] = lats, lons
+        points = [p for shape in shapes for p in shape]
+        if points:
+            fill = np.ones(len(all_lats), dtype=bool)
+            fill[pos] = False
+            all_lats[fill] = [p[0] for p in points]
+            all_lons[fill] = [p[1] for p in points]
 
-        segments = []
-        current_segment = {"mode": "WALK", "coords": []}
-        
-        for i, node_data in enumerate(nodes):
-            current_segment["coords"].append([node_data['lat'], node_data['lon']])
-            
-            if i < len(nodes) - 1:
-                next_node = nodes[i+1]
-                is_trip_curr = 'time' in node_data
-                is_trip_next = 'time' in next_node
-                
-                if is_trip_curr and is_trip_next:
-                    if current_segment["mode"] != "TRANSIT":
-                        segments.append(current_segment)
-                        current_segment = {"mode": "TRANSIT", "coords": [[node_data['lat'], node_data['lon']]]}
-                elif is_trip_curr or is_trip_next: 
-                     if current_segment["mode"] != "TRANSIT":
-                        segments.append(current_segment)
-                        current_segment = {"mode": "TRANSIT", "coords": [[node_data['lat'], node_data['lon']]]}
-                else:
-                    if current_segment["mode"] != "WALK":
-                        segments.append(current_segment)
-                        current_segment = {"mode": "WALK", "coords": [[node_data['lat'], node_data['lon']]]}
-
-        segments.append(current_segment)
-        
-        total_distance = 0.0
-        from math import radians, sin, cos, sqrt, atan2
-        
-        def haversine(lat1, lon1, lat2, lon2):
-            R = 6371000
-            phi1, phi2 = radians(lat1), radians(lat2)
-            dphi = radians(lat2 - lat1)
-            dlambda = radians(lon2 - lon1)
-            a = sin(dphi / 2)**2 + cos(phi1) * cos(phi2) * sin(dlambda / 2)**2
-            return 2 * R * atan2(sqrt(a), sqrt(1 - a))
-
-        for i in range(len(nodes) - 1):
-            total_distance += haversine(
-                nodes[i]['lat'], nodes[i]['lon'],
-                nodes[i+1]['lat'], nodes[i+1]['lon']
-            )
-            
+        total_distance = float(haversine(all_lats[:-1], all_lons[:-1], all_lats[1:], all_lons[1:]).sum())
+        if n == 1:
+            return {"segments": [{"mode": "WALK", "coords": [[lats[0], lons[0]]]}],
+                    "totalCost": total_cost, "totalDistance": total_distance}
+
+        # A hop is part of a transit leg when either end is a trip event.
+        trips = np.asarray(trips, dtype=bool)
+        transit = trips[:-1] | trips[1:]
+        starts = np.flatnonzero(np.r_[True, transit[1:] != transit[:-1]])
+        ends = np.r_[starts[1:], n - 1]
+        coords = np.column_stack((all_lats, all_lons))
+        segments = [
+            {"mode": "TRANSIT" if transit[a] else "WALK", "coords": coords[pos[a]:pos[b] + 1].tolist()}
+            for a, b in zip(starts.tolist(), ends.tolist())
+        ]
         return {"segments": segments, "totalCost": total_cost, "totalDistance": total_distance}
-    
-    def get_all_stations(self):
+
+    async def get_all_stations(self):
         query = """
         MATCH (s:Station)
         RETURN s.name as name, s.lat as lat, s.lon as lon
         """
-        return self.db.query(query)
+        return await self.adb.query(query)
 
-    def get_ev_routes(self, lat, lon):
+    async def get_ev_routes(self, lat, lon, radius=5000):
+        # Candidates come from the in-memory index; Neo4j only fetches their properties by id.
+        ids, _ = self.ev_index.within(lat, lon, radius)
         query = """
-        MATCH (n:EVPoint)
-        WHERE point.distance(n.location, point({latitude: $lat, longitude: $lon})) < 5000
+        MATCH (n:EVPoint) WHERE n.id IN $ids
         RETURN n.location, n.charger_type, n.sockets
         """
-        return self.db.query(query, {"lat": lat, "lon": lon})
+        return await self.adb.query(query, {"ids": ids}) if ids else []
 
-    def get_all_evs(self):
+    async def get_all_evs(self):
         query = """
         MATCH (n:EVPoint)
         RETURN n.lat as lat, n.lon as lon, n.charger_type as type
         """
-        return self.db.query(query)
+        return await self.adb.query(query)
 
-    def get_graph_bounds(self):
+    async def get_graph_bounds(self):
         query = """
         MATCH (n:RoadNode)
         RETURN min(n.lat) as min_lat, max(n.lat) as max_lat, 
                min(n.lon) as min_lon, max(n.lon) as max_lon
         """
-        res = self.db.query(query)
+        res = await self.adb.query(query)
         if res:
             return res[0]
         return None
@@ -0,0 +1,187 @@
+import math
+import numpy as np
+from backend.core import graph_store
+from backend.core.geo import haversine, METERS_PER_DEG_LAT, METERS_PER_DEG_LON
+
+
+class SpatialIndex:
+    def __init__(self, ids, lats, lons, cell_size=250.0):
+        self.cell_size = float(cell_size)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        self.ref_lat = float(lats.mean()) if len(lats) else 0.0
+        self.kx = METERS_PER_DEG_LON * math.cos(math.radians(self.ref_lat))
+        self.ky = METERS_PER_DEG_LAT
+
+        x = lons * self.kx
+        y = lats * self.ky
+        cx = np.floor(x / self.cell_size).astype(np.int64)
+        cy = np.floor(y / self.cell_size).astype(np.int64)
+        if len(lats):
+            self.min_cx, self.min_cy = int(cx.min()), int(cy.min())
+            self.nx = int(cx.max()) - self.min_cx + 1
+            self.ny = int(cy.max()) - self.min_cy + 1
+        else:
+            self.min_cx = self.min_cy = 0
+            self.nx = self.ny = 0
+
+        keys = (cy - self.min_cy) * self.nx + (cx - self.min_cx)
+        order = np.argsort(keys, kind="stable")
+        self.ids = np.asarray(ids)[order]
+        self.lats = lats[order]
+        self.lons = lons[order]
+        self.xs = x[order]
+        self.ys = y[order]
+        self.cell_start = np.searchsorted(keys[order], np.arange(self.nx * self.ny + 1))
+
+    @classmethod
+    def from_records(cls, records, cell_size=250.0):
+        records = [r for r in records if r["lat"] is not None and r["lon"] is not None]
+        return cls(
+            [r["id"] for r in records],
+            [r["lat"] for r in records],
+            [r["lon"] for r in records],
+            cell_size=cell_size,
+        )
+
+    def upsert(self, ids, lats, lons):
+        # New index with these points added or moved by id, regridded from the arrays in memory. An id
+        # given more than once keeps its last position.
+        last = sorted({v: i for i, v in enumerate(ids)}.values())
+        new = {ids[i] for i in last}
+        keep = [i for i, v in enumerate(self.ids.tolist()) if v not in new]
+        return SpatialIndex(
+            [self.ids[i].item() for i in keep] + [ids[i] for i in last],
+            np.concatenate([self.lats[keep], np.asarray(lats, dtype=np.float64)[last]]),
+            np.concatenate([self.lons[keep], np.asarray(lons, dtype=np.float64)[last]]),
+            cell_size=self.cell_size,
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def save(self, directory):
+        meta = np.array([self.cell_size, self.ref_lat, self.kx, self.ky,
+                         self.min_cx, self.min_cy, self.nx, self.ny], dtype=np.float64)
+        graph_store.save_arrays(directory, {
+            "ids": self.ids, "lats": self.lats, "lons": self.lons,
+            "xs": self.xs, "ys": self.ys, "cell_start": self.cell_start, "meta": meta,
+        })
+
+    @classmethod
+    def exists(cls, directory):
+        return graph_store.exists(directory, ("ids", "cell_start", "meta"))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        arrays = graph_store.load_arrays(
+            directory, ("ids", "lats", "lons", "xs", "ys", "cell_start", "meta"), mmap_mode)
+        index = cls.__new__(cls)
+        meta = arrays.pop("meta")
+        index.cell_size, index.ref_lat, index.kx, index.ky = (float(v) for v in meta[:4])
+        index.min_cx, index.min_cy, index.nx, index.ny = (int(v) for v in meta[4:])
+        for name, arr in arrays.items():
+            setattr(index, name, arr)
+        return index
+
+    def _cell(self, lat, lon):
+        x = lon * self.kx
+        y = lat * self.ky
+        cx = int(math.floor(x / self.cell_size)) - self.min_cx
+        cy = int(math.floor(y / self.cell_size)) - self.min_cy
+        return x, y, cx, cy
+
+    def _row_range(self, row, c0, c1):
+        if row < 0 or row >= self.ny:
+            return None
+        c0, c1 = max(c0, 0), min(c1, self.nx - 1)
+        if c0 > c1:
+            return None
+        start = self.cell_start[row * self.nx + c0]
+        end = self.cell_start[row * self.nx + c1 + 1]
+        return (start, end) if end > start else None
+
+    def _ring(self, cx, cy, r):
+        if r == 0:
+            rng = self._row_range(cy, cx, cx)
+            return [rng] if rng else []
+        ranges = []
+        for row in (cy - r, cy + r):
+            rng = self._row_range(row, cx - r, cx + r)
+            if rng:
+                ranges.append(rng)
+        for row in range(cy - r + 1, cy + r):
+            for col in (cx - r, cx + r):
+                if 0 <= col < self.nx:
+                    rng = self._row_range(row, col, col)
+                    if rng:
+                        ranges.append(rng)
+        return ranges
+
+    def _covers_grid(self, cx, cy, r):
+        return cx - r <= 0 and cy - r <= 0 and cx + r >= self.nx - 1 and cy + r >= self.ny - 1
+
+    def nearest_index(self, lat, lon, max_dist=None):
+        if not len(self.ids):
+            return -1
+        x, y, cx, cy = self._cell(lat, lon)
+        # Start at the first ring that can overlap the grid when the point is outside it.
+        r = max(0, -cx, -cy, cx - self.nx + 1, cy - self.ny + 1)
+        best_i, best_d2 = -1, math.inf
+        while True:
+            reach = (r - 1) * self.cell_size
+            if best_i >= 0 and reach > 0 and reach * reach >= best_d2:
+                break
+            if max_dist is not None and reach > max_dist:
+                break
+            for start, end in self._ring(cx, cy, r):
+                dx = self.xs[start:end] - x
+                dy = self.ys[start:end] - y
+                d2 = dx * dx + dy * dy
+                j = int(d2.argmin())
+                if d2[j] < best_d2:
+                    best_i, best_d2 = start + j, float(d2[j])
+            if self._covers_grid(cx, cy, r):
+                break
+            r += 1
+        if best_i >= 0 and max_dist is not None and best_d2 > max_dist * max_dist:
+            return -1
+        return best_i
+
+    def nearest(self, lat, lon, max_dist=None):
+        i = self.nearest_index(lat, lon, max_dist)
+        if i < 0:
+            return None, -1.0
+        return self.ids[i].item(), float(haversine(lat, lon, self.lats[i], self.lons[i]))
+
+    def snap(self, points, max_dist=None):
+        ids, dists = [], np.full(len(points), -1.0)
+        for k, (lat, lon) in enumerate(points):
+            node_id, dist = self.nearest(lat, lon, max_dist)
+            ids.append(node_id)
+            dists[k] = dist
+        return ids, dists
+
+    def within(self, lat, lon, radius, k=None):
+        if not len(self.ids):
+            return [], np.empty(0)
+        x, y, cx, cy = self._cell(lat, lon)
+        reach = int(math.ceil(radius / self.cell_size))
+        idx = []
+        for row in range(cy - reach, cy + reach + 1):
+            rng = self._row_range(row, cx - reach, cx + reach)
+            if rng:
+                idx.append(np.arange(rng[0], rng[1]))
+        if not idx:
+            return [], np.empty(0)
+        idx = np.concatenate(idx)
+        dx = self.xs[idx] - x
+        dy = self.ys[idx] - y
+        d2 = dx * dx + dy * dy
+        keep = d2 <= radius * radius
+        idx, d2 = idx[keep], d2[keep]
+        order = np.argsort(d2, kind="stable")
+        if k is not None:
+            order = order[:k]
+        idx = idx[order]
+        return self.ids[idx].tolist(), haversine(lat, lon, self.lats[idx], self.lons[idx])
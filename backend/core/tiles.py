@@ -0,0 +1,183 @@
+import os
+import json
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from backend.core import polyline
+
+INDEX_ZOOM = 14
+MIN_ZOOM = {"stations": 10, "evs": 10, "roads": 13}
+MAX_ZOOM = 20
+
+
+def lonlat_to_tile(lat, lon, z):
+    n = 2 ** z
+    lat = np.clip(np.radians(lat), -1.4844, 1.4844)
+    x = np.floor((np.asarray(lon) + 180.0) / 360.0 * n).astype(np.int64)
+    y = np.floor((1.0 - np.arcsinh(np.tan(lat)) / math.pi) / 2.0 * n).astype(np.int64)
+    return np.clip(x, 0, n - 1), np.clip(y, 0, n - 1)
+
+
+def tile_bounds(z, x, y):
+    n = 2 ** z
+    lon0, lon1 = x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+    lat1 = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    lat0 = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return lat0, lon0, lat1, lon1
+
+
+def encode(layer, z, x, y, features):
+    # (body bytes, etag) of a tile.
+    body = json.dumps({"layer": layer, "z": z, "x": x, "y": y, "features": features},
+                      separators=(",", ":")).encode()
+    return body, '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+class TileLayer:
+    # Features bucketed by their tile at INDEX_ZOOM, sorted by (x, y) so that each column of a
+    # requested tile is one searchsorted range. A feature is listed once per base tile it touches.
+    def __init__(self, features, lats, lons, owners, points=False):
+        self.features = features
+        self.points = points
+        x, y = lonlat_to_tile(lats, lons, INDEX_ZOOM)
+        keys = np.unique(np.column_stack((x * (1 << INDEX_ZOOM) + y, owners)), axis=0) if len(owners) else \
+            np.empty((0, 2), dtype=np.int64)
+        self.keys = keys[:, 0]
+        self.owners = keys[:, 1]
+
+    def query(self, z, x, y):
+        if not len(self.keys):
+            return []
+        if z >= INDEX_ZOOM:
+            shift = z - INDEX_ZOOM
+            cols, rows = np.array([x >> shift]), (y >> shift, (y >> shift) + 1)
+        else:
+            span = 1 << (INDEX_ZOOM - z)
+            cols, rows = np.arange(x * span, (x + 1) * span), (y * span, (y + 1) * span)
+        lo = np.searchsorted(self.keys, cols * (1 << INDEX_ZOOM) + rows[0], side="left")
+        hi = np.searchsorted(self.keys, cols * (1 << INDEX_ZOOM) + rows[1], side="left")
+        found = [self.owners[a:b] for a, b in zip(lo.tolist(), hi.tolist()) if b > a]
+        if not found:
+            return []
+        return np.unique(np.concatenate(found)).tolist()
+
+
+class TileStore:
+    def __init__(self, cache_size=None, precompute_zoom=None):
+        self.layers = {}
+        self.records = {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size or int(os.getenv("TILE_CACHE_SIZE", "20000"))
+        self.precompute_zoom = precompute_zoom or int(os.getenv("TILE_PRECOMPUTE_ZOOM", "12"))
+        self.lock = threading.Lock()
+
+    def set_points(self, layer, records, props):
+        records = [r for r in records if r["lat"] is not None and r["lon"] is not None]
+        self._set(layer, self._point_layer(records, props))
+        self.records[layer] = records
+
+    def upsert_points(self, layer, records, props):
+        # Adds or moves points by id, the last record of an id winning; only the tiles under their old and
+        # new positions are dropped.
+        records = list({r["id"]: r for r in records}.values())
+        ids = {r["id"] for r in records}
+        current = self.records.get(layer, [])
+        moved = [(r["lat"], r["lon"]) for r in current if r.get("id") in ids]
+        merged = [r for r in current if r.get("id") not in ids] + list(records)
+        tile_layer = self._point_layer(merged, props)
+        with self.lock:
+            self.layers[layer] = tile_layer
+            self.records[layer] = merged
+        self.invalidate(layer, moved + [(r["lat"], r["lon"]) for r in records])
+
+    @staticmethod
+    def _point_layer(records, props):
+        lats = np.asarray([r["lat"] for r in records], dtype=np.float64)
+        lons = np.asarray([r["lon"] for r in records], dtype=np.float64)
+        features = [[round(r["lat"], 6), round(r["lon"], 6)] + [r.get(p) for p in props] for r in records]
+        return TileLayer(features, lats, lons, np.arange(len(records)), points=True)
+
+    def set_roads(self, graph):
+        # One feature per undirected segment, as an encoded polyline with its shape points.
+        src = graph.sources
+        keep = np.flatnonzero(src < graph.targets)
+        features, lats, lons, owners = [], [], [], []
+        for i, e in enumerate(keep.tolist()):
+            u, v = int(src[e]), int(graph.targets[e])
+            g0, g1 = int(graph.geom_offsets[e]), int(graph.geom_offsets[e + 1])
+            seg_lats = [float(graph.lats[u])] + graph.geom_lats[g0:g1].tolist() + [float(graph.lats[v])]
+            seg_lons = [float(graph.lons[u])] + graph.geom_lons[g0:g1].tolist() + [float(graph.lons[v])]
+            features.append(polyline.encode(list(zip(seg_lats, seg_lons))))
+            lats.extend(seg_lats)
+            lons.extend(seg_lons)
+            owners.extend([i] * len(seg_lats))
+        self._set("roads", TileLayer(features, np.asarray(lats), np.asarray(lons), np.asarray(owners, dtype=np.int64)))
+
+    def _set(self, layer, tile_layer):
+        with self.lock:
+            self.layers[layer] = tile_layer
+            for key in [k for k in self.cache if k[0] == layer]:
+                del self.cache[key]
+
+    def invalidate(self, layer, points):
+        # Drop cached tiles covering the given (lat, lon) points at every zoom.
+        if not points:
+            return
+        lats = np.asarray([p[0] for p in points])
+        lons = np.asarray([p[1] for p in points])
+        with self.lock:
+            for z in range(MIN_ZOOM.get(layer, 0), MAX_ZOOM + 1):
+                xs, ys = lonlat_to_tile(lats, lons, z)
+                for x, y in set(zip(xs.tolist(), ys.tolist())):
+                    self.cache.pop((layer, z, x, y), None)
+
+    def tile(self, layer, z, x, y):
+        # Returns (body bytes, etag), or None for an unknown layer.
+        key = (layer, z, x, y)
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit is not None:
+                self.cache.move_to_end(key)
+                return hit
+            tile_layer = self.layers.get(layer)
+        if tile_layer is None:
+            return None
+        value = encode(layer, z, x, y, self._features(tile_layer, layer, z, x, y))
+        with self.lock:
+            self.cache[key] = value
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return value
+
+    def features(self, layer, z, x, y):
+        # Uncached feature list, for merging tiles from several stores; None for an unknown layer.
+        tile_layer = self.layers.get(layer)
+        return None if tile_layer is None else self._features(tile_layer, layer, z, x, y)
+
+    @staticmethod
+    def _features(tile_layer, layer, z, x, y):
+        if not MIN_ZOOM.get(layer, 0) <= z <= MAX_ZOOM:
+            return []
+        features = [tile_layer.features[i] for i in tile_layer.query(z, x, y)]
+        if z > INDEX_ZOOM and tile_layer.points:
+            # Past the index zoom a base tile holds several requested tiles; points are cut exactly,
+            # road segments are returned whole for the client to clip.
+            lat0, lon0, lat1, lon1 = tile_bounds(z, x, y)
+            features = [f for f in features if lat0 <= f[0] < lat1 and lon0 <= f[1] < lon1]
+        return features
+
+    def precompute(self):
+        count = 0
+        for layer, tile_layer in list(self.layers.items()):
+            if not len(tile_layer.keys):
+                continue
+            base = tile_layer.keys
+            bx, by = base >> INDEX_ZOOM, base & ((1 << INDEX_ZOOM) - 1)
+            for z in range(MIN_ZOOM.get(layer, 0), self.precompute_zoom + 1):
+                shift = INDEX_ZOOM - z
+                for x, y in set(zip((bx >> shift).tolist(), (by >> shift).tolist())):
+                    self.tile(layer, z, x, y)
+                    count += 1
+        print(f"Tiles precomputed: {count}.")
@@ -0,0 +1,422 @@
+import os
+import datetime
+import numpy as np
+import pandas as pd
+from backend.core import admission, graph_store
+from backend.core.spatial import SpatialIndex
+from backend.core.geo import haversine
+
+WALK_SPEED = 1.4
+INF = float('inf')
+DAY = 86400
+
+
+def times_to_sec(series):
+    # Always three columns, so chunks of blank or malformed times come out as NaN instead of failing.
+    parts = series.astype("string").str.strip().str.extract(r'^(\d+):(\d+):(\d+)$').astype("float64")
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+ARRAYS = ("stop_ids", "stop_names", "stop_lats", "stop_lons", "trip_ids",
+          "conn_dep_stop", "conn_arr_stop", "conn_dep", "conn_arr", "conn_trip", "conn_seq",
+          "trip_conns", "trip_offsets", "fp_offsets", "fp_targets", "fp_costs", "timezone")
+
+
+class TransitEngine:
+    def __init__(self, arrays, access_radius=800.0, max_ride=4 * 3600):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.timezone = str(self.timezone[0]) or None
+        self.access_radius = access_radius
+        self.max_ride = max_ride
+        self.stop_index = SpatialIndex(np.arange(len(self.stop_ids)), self.stop_lats, self.stop_lons)
+        self.delays = None
+        self.last_departure = int(self.conn_dep[-1]) if len(self.conn_dep) else 0
+
+    @classmethod
+    def from_gtfs(cls, gtfs_dir, **kwargs):
+        stops = pd.read_csv(
+            os.path.join(gtfs_dir, "stops.txt"),
+            usecols=["stop_id", "stop_name", "stop_lat", "stop_lon"],
+            dtype={"stop_id": str, "stop_name": str, "stop_lat": np.float64, "stop_lon": np.float64},
+        )
+        stop_times = pd.read_csv(
+            os.path.join(gtfs_dir, "stop_times.txt"),
+            usecols=["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+            dtype={"trip_id": str, "arrival_time": str, "departure_time": str,
+                   "stop_id": str, "stop_sequence": np.int32},
+        )
+        timezone = None
+        agency_path = os.path.join(gtfs_dir, "agency.txt")
+        if os.path.exists(agency_path):
+            agency = pd.read_csv(agency_path, dtype=str)
+            if "agency_timezone" in agency and len(agency):
+                timezone = agency["agency_timezone"].iloc[0]
+        return cls.from_tables(stops, stop_times, timezone=timezone, **kwargs)
+
+    @classmethod
+    def from_tables(cls, stops, stop_times, timezone=None, transfer_radius=250.0, **kwargs):
+        stop_pos = pd.Series(np.arange(len(stops), dtype=np.int32), index=stops["stop_id"].values)
+
+        st = pd.DataFrame({
+            "trip_id": stop_times["trip_id"].values,
+            "seq": stop_times["stop_sequence"].values,
+            "stop": stop_pos.reindex(stop_times["stop_id"].values).values,
+            "arr": times_to_sec(stop_times["arrival_time"]).values,
+            "dep": times_to_sec(stop_times["departure_time"]).values,
+        })
+        # Non-timepoint rows carry no times; connections then span timepoint to timepoint.
+        st = st.dropna(subset=["stop", "arr", "dep"])
+        st = st.sort_values(["trip_id", "seq"], kind="stable")
+
+        trip_codes, trip_ids = pd.factorize(st["trip_id"], sort=False)
+        stop = st["stop"].to_numpy(np.int32)
+        arr = st["arr"].to_numpy(np.int32)
+        dep = st["dep"].to_numpy(np.int32)
+        seq = st["seq"].to_numpy(np.int32)
+
+        same_trip = trip_codes[:-1] == trip_codes[1:]
+        c_dep = dep[:-1][same_trip]
+        order = np.argsort(c_dep, kind="stable")
+        conn_trip = trip_codes[:-1][same_trip][order].astype(np.int32)
+        conn_seq = seq[:-1][same_trip][order]
+        trip_conns = np.lexsort((conn_seq, conn_trip)).astype(np.int32)
+
+        arrays = {
+            "stop_ids": np.asarray(stops["stop_id"].astype(str).tolist()),
+            "stop_names": np.asarray(stops["stop_name"].fillna("").astype(str).tolist()),
+            "stop_lats": stops["stop_lat"].to_numpy(np.float64),
+            "stop_lons": stops["stop_lon"].to_numpy(np.float64),
+            "trip_ids": np.asarray([str(t) for t in trip_ids]),
+            "conn_dep_stop": stop[:-1][same_trip][order],
+            "conn_arr_stop": stop[1:][same_trip][order],
+            "conn_dep": c_dep[order],
+            "conn_arr": arr[1:][same_trip][order],
+            "conn_trip": conn_trip,
+            "conn_seq": conn_seq,
+            "trip_conns": trip_conns,
+            "trip_offsets": np.searchsorted(conn_trip[trip_conns], np.arange(len(trip_ids) + 1)).astype(np.int64),
+            "timezone": np.asarray([timezone or ""]),
+        }
+        arrays.update(cls._footpaths(arrays["stop_lats"], arrays["stop_lons"], transfer_radius))
+        return cls(arrays, **kwargs)
+
+    @staticmethod
+    def _footpaths(lats, lons, radius):
+        index = SpatialIndex(np.arange(len(lats)), lats, lons)
+        offsets = [0]
+        targets, costs = [], []
+        for i in range(len(lats)):
+            ids, dists = index.within(lats[i], lons[i], radius)
+            for j, d in zip(ids, dists):
+                if j != i:
+                    targets.append(j)
+                    costs.append(int(d / WALK_SPEED))
+            offsets.append(len(targets))
+        return {
+            "fp_offsets": np.asarray(offsets, dtype=np.int64),
+            "fp_targets": np.asarray(targets, dtype=np.int32),
+            "fp_costs": np.asarray(costs, dtype=np.int32),
+        }
+
+    @classmethod
+    def exists(cls, directory):
+        return graph_store.exists(directory, ARRAYS)
+
+    def save(self, directory):
+        arrays = {name: getattr(self, name) for name in ARRAYS}
+        arrays["timezone"] = np.asarray([self.timezone or ""])
+        graph_store.save_arrays(directory, arrays)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r', **kwargs):
+        return cls(graph_store.load_arrays(directory, ARRAYS, mmap_mode), **kwargs)
+
+    def __len__(self):
+        return len(self.conn_dep)
+
+    def now_seconds(self):
+        tz = None
+        if self.timezone:
+            from zoneinfo import ZoneInfo
+            tz = ZoneInfo(self.timezone)
+        now = datetime.datetime.now(tz)
+        return now.hour * 3600 + now.minute * 60 + now.second
+
+    def service_days(self, departure_time):
+        # GTFS times run past 24:00 for trips of the previous service day. A departure early in the day also
+        # scans those trips on their own clock, one day later.
+        if departure_time + DAY <= self.last_departure:
+            return (0, DAY)
+        return (0,)
+
+    def nearby_stops(self, lat, lon):
+        ids, dists = self.stop_index.within(lat, lon, self.access_radius)
+        if not ids:
+            i = self.stop_index.nearest_index(lat, lon)
+            if i < 0:
+                return []
+            ids = [self.stop_index.ids[i].item()]
+            dists = [float(haversine(lat, lon, self.stop_index.lats[i], self.stop_index.lons[i]))]
+        return [(int(s), int(d / WALK_SPEED)) for s, d in zip(ids, dists)]
+
+    def _window(self, lo, hi):
+        # Connections departing in [lo, hi] in departure order, with realtime delays applied when
+        # an overlay is attached: (connection ids, dep stops, arr stops, dep times, arr times, trips).
+        view = self.delays.view if self.delays is not None else None
+        if view is None:
+            start = int(np.searchsorted(self.conn_dep, lo, side="left"))
+            end = int(np.searchsorted(self.conn_dep, hi, side="right"))
+            return (range(start, end), self.conn_dep_stop[start:end].tolist(),
+                    self.conn_arr_stop[start:end].tolist(), self.conn_dep[start:end].tolist(),
+                    self.conn_arr[start:end].tolist(), self.conn_trip[start:end].tolist())
+        order, dep, arr = view
+        start = int(np.searchsorted(dep, lo, side="left"))
+        end = int(np.searchsorted(dep, hi, side="right"))
+        idx = order[start:end]
+        return (idx.tolist(), self.conn_dep_stop[idx].tolist(), self.conn_arr_stop[idx].tolist(),
+                dep[start:end].tolist(), arr[start:end].tolist(), self.conn_trip[idx].tolist())
+
+    def departure(self, conn):
+        if self.delays is not None:
+            return self.delays.departure(conn)
+        return int(self.conn_dep[conn])
+
+    def arrival(self, conn):
+        if self.delays is not None:
+            return self.delays.arrival(conn)
+        return int(self.conn_arr[conn])
+
+    def earliest_arrival(self, sources, targets, departure_time):
+        n_stops = len(self.stop_ids)
+        arrival = [INF] * n_stops
+        # Journey pointers: kind 1 = ride (board connection, alight connection), 2 = walk (from stop).
+        kind = [0] * n_stops
+        ptr_a = [-1] * n_stops
+        ptr_b = [-1] * n_stops
+        for s, t in sources:
+            if t < arrival[s]:
+                arrival[s] = t
+
+        best, best_stop = INF, -1
+        for s, egress in targets.items():
+            if arrival[s] + egress < best:
+                best, best_stop = arrival[s] + egress, s
+
+        conns, dep_stop, arr_stop, dep_t, arr_t, trips = self._window(departure_time, departure_time + self.max_ride)
+        fp_off, fp_to, fp_cost = self.fp_offsets, self.fp_targets, self.fp_costs
+        boarded = {}
+        deadline = admission.current()
+
+        for k in range(len(dep_t)):
+            d = dep_t[k]
+            if d >= best:
+                break
+            if deadline is not None and not k & 1023:
+                deadline.check()
+            trip = trips[k]
+            board = boarded.get(trip)
+            if board is None:
+                if arrival[dep_stop[k]] > d:
+                    continue
+                board = boarded[trip] = k
+            v = arr_stop[k]
+            a = arr_t[k]
+            if a >= arrival[v]:
+                continue
+            arrival[v] = a
+            kind[v], ptr_a[v], ptr_b[v] = 1, conns[board], conns[k]
+            if v in targets and a + targets[v] < best:
+                best, best_stop = a + targets[v], v
+            for f in range(fp_off[v], fp_off[v + 1]):
+                w = int(fp_to[f])
+                aw = a + int(fp_cost[f])
+                if aw < arrival[w]:
+                    arrival[w] = aw
+                    kind[w], ptr_a[w], ptr_b[w] = 2, v, -1
+                    if w in targets and aw + targets[w] < best:
+                        best, best_stop = aw + targets[w], w
+
+        if best_stop < 0:
+            return None
+        legs = []
+        s = best_stop
+        while kind[s]:
+            if kind[s] == 1:
+                legs.append(("ride", ptr_a[s], ptr_b[s]))
+                s = int(self.conn_dep_stop[ptr_a[s]])
+            else:
+                legs.append(("walk", ptr_a[s], s))
+                s = ptr_a[s]
+        legs.reverse()
+        return {"arrival": best, "first_stop": s, "last_stop": best_stop, "legs": legs}
+
+    def one_to_many(self, origin, destinations, departure_time):
+        costs = [self._one_to_many(origin, destinations, departure_time + shift)
+                 for shift in self.service_days(departure_time)]
+        return [min(c) for c in zip(*costs)]
+
+    def _one_to_many(self, origin, destinations, departure_time):
+        sources = [(s, departure_time + t) for s, t in self.nearby_stops(*origin)]
+        target_stops = {}
+        for j, (lat, lon) in enumerate(destinations):
+            for s, t in self.nearby_stops(lat, lon):
+                target_stops.setdefault(s, []).append((j, t))
+
+        best = [
+            departure_time + float(haversine(origin[0], origin[1], lat, lon)) / WALK_SPEED
+            for lat, lon in destinations
+        ]
+        arrival = [INF] * len(self.stop_ids)
+
+        def reach(v, a):
+            arrival[v] = a
+            for j, egress in target_stops.get(v, ()):
+                if a + egress < best[j]:
+                    best[j] = a + egress
+
+        for s, t in sources:
+            if t < arrival[s]:
+                reach(s, t)
+
+        _, dep_stop, arr_stop, dep_t, arr_t, trips = self._window(departure_time, departure_time + self.max_ride)
+        fp_off, fp_to, fp_cost = self.fp_offsets, self.fp_targets, self.fp_costs
+        boarded = set()
+        worst = max(best, default=INF)
+        deadline = admission.current()
+
+        for k in range(len(dep_t)):
+            d = dep_t[k]
+            if k & 1023 == 0:
+                worst = max(best, default=INF)
+                if deadline is not None:
+                    deadline.check()
+            if d >= worst:
+                break
+            trip = trips[k]
+            if trip not in boarded:
+                if arrival[dep_stop[k]] > d:
+                    continue
+                boarded.add(trip)
+            v = arr_stop[k]
+            a = arr_t[k]
+            if a >= arrival[v]:
+                continue
+            reach(v, a)
+            for f in range(fp_off[v], fp_off[v + 1]):
+                w = int(fp_to[f])
+                aw = a + int(fp_cost[f])
+                if aw < arrival[w]:
+                    reach(w, aw)
+        return [b - departure_time for b in best]
+
+    def reachable(self, origin, departure_time, limit):
+        reached = {}
+        for shift in self.service_days(departure_time):
+            for s, t in self._reachable(origin, departure_time + shift, limit).items():
+                if t < reached.get(s, INF):
+                    reached[s] = t
+        return reached
+
+    def _reachable(self, origin, departure_time, limit):
+        horizon = departure_time + limit
+        arrival = [INF] * len(self.stop_ids)
+        for s, t in self.nearby_stops(*origin):
+            arrival[s] = min(arrival[s], departure_time + t)
+
+        _, dep_stop, arr_stop, dep_t, arr_t, trips = self._window(departure_time, horizon)
+        fp_off, fp_to, fp_cost = self.fp_offsets, self.fp_targets, self.fp_costs
+        boarded = set()
+        deadline = admission.current()
+
+        for k in range(len(dep_t)):
+            if deadline is not None and not k & 1023:
+                deadline.check()
+            trip = trips[k]
+            if trip not in boarded:
+                if arrival[dep_stop[k]] > dep_t[k]:
+                    continue
+                boarded.add(trip)
+            v = arr_stop[k]
+            a = arr_t[k]
+            if a > horizon or a >= arrival[v]:
+                continue
+            arrival[v] = a
+            for f in range(fp_off[v], fp_off[v + 1]):
+                w = int(fp_to[f])
+                aw = a + int(fp_cost[f])
+                if aw < arrival[w]:
+                    arrival[w] = aw
+        return {s: a - departure_time for s, a in enumerate(arrival) if a <= horizon}
+
+    def _ride_coords(self, board, alight):
+        trip = self.conn_trip[board]
+        conns = self.trip_conns[self.trip_offsets[trip]:self.trip_offsets[trip + 1]]
+        i = int(np.nonzero(conns == board)[0][0])
+        j = int(np.nonzero(conns == alight)[0][0])
+        hops = conns[i:j + 1]
+        stops = np.concatenate(([self.conn_dep_stop[board]], self.conn_arr_stop[hops]))
+        return np.column_stack((self.stop_lats[stops], self.stop_lons[stops])).tolist()
+
+    def route(self, start_lat, start_lon, end_lat, end_lon, departure_time=None):
+        if departure_time is None:
+            departure_time = self.now_seconds()
+        sources = [(s, departure_time + t) for s, t in self.nearby_stops(start_lat, start_lon)]
+        targets = {}
+        for s, t in self.nearby_stops(end_lat, end_lon):
+            targets[s] = min(t, targets.get(s, INF))
+
+        direct_walk = float(haversine(start_lat, start_lon, end_lat, end_lon)) / WALK_SPEED
+        # Times in the journey are on the clock of the service day it was found on; shift brings them back.
+        journey, shift = None, 0
+        for day in self.service_days(departure_time):
+            found = self.earliest_arrival([(s, t + day) for s, t in sources], targets, departure_time + day)
+            if found is not None and (journey is None or found["arrival"] - day < journey["arrival"] - shift):
+                journey, shift = found, day
+        start = [start_lat, start_lon]
+        end = [end_lat, end_lon]
+        if journey is None or journey["arrival"] - shift - departure_time >= direct_walk:
+            segments = [{"mode": "WALK", "coords": [start, end]}]
+            return self._result(segments, direct_walk, departure_time, departure_time + direct_walk, [])
+
+        first = journey["first_stop"]
+        segments = [{"mode": "WALK", "coords": [start, [float(self.stop_lats[first]), float(self.stop_lons[first])]]}]
+        trips = []
+        for leg in journey["legs"]:
+            if leg[0] == "ride":
+                _, board, alight = leg
+                trips.append(str(self.trip_ids[self.conn_trip[board]]))
+                segments.append({
+                    "mode": "TRANSIT",
+                    "trip_id": trips[-1],
+                    "from": str(self.stop_names[self.conn_dep_stop[board]]),
+                    "to": str(self.stop_names[self.conn_arr_stop[alight]]),
+                    "departure": self.departure(board) - shift,
+                    "arrival": self.arrival(alight) - shift,
+                    "coords": self._ride_coords(board, alight),
+                })
+            else:
+                _, a, b = leg
+                segments.append({"mode": "WALK", "coords": [
+                    [float(self.stop_lats[a]), float(self.stop_lons[a])],
+                    [float(self.stop_lats[b]), float(self.stop_lons[b])],
+                ]})
+        last = journey["last_stop"]
+        segments.append({"mode": "WALK", "coords": [[float(self.stop_lats[last]), float(self.stop_lons[last])], end]})
+        arrival = journey["arrival"] - shift
+        return self._result(segments, arrival - departure_time, departure_time, arrival, trips)
+
+    def _result(self, segments, total_cost, departure, arrival, trips):
+        total_distance = 0.0
+        for seg in segments:
+            c = np.asarray(seg["coords"], dtype=np.float64)
+            if len(c) > 1:
+                total_distance += float(haversine(c[:-1, 0], c[:-1, 1], c[1:, 0], c[1:, 1]).sum())
+        return {
+            "segments": segments,
+            "totalCost": float(total_cost),
+            "totalDistance": total_distance,
+            "departureTime": int(departure),
+            "arrivalTime": int(arrival),
+            "trips": trips,
+        }
@@ -0,0 +1,32 @@
+import time
+from backend.core.region import default_region
+from backend.core.road_graph import RoadGraph
+from backend.core.ch import ContractionHierarchy
+
+PROFILES = ('drive', 'walk')
+
+
+class CHBuilder:
+    def __init__(self, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
+
+    def is_built(self):
+        return all(ContractionHierarchy.exists(self.region.store_dir(f"ch_{p}")) for p in PROFILES)
+
+    def build(self, profiles=PROFILES):
+        started = time.time()
+        road_dir = self.region.store_dir("road")
+        if RoadGraph.exists(road_dir):
+            graph = RoadGraph.load(road_dir)
+        else:
+            graph = RoadGraph.from_neo4j(self.db)
+            graph.save(road_dir)
+        for profile in profiles:
+            ch = ContractionHierarchy.from_graph(graph, profile)
+            ch.save(self.region.store_dir(f"ch_{profile}"))
+        print(f"Contraction hierarchies ready in {time.time() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    CHBuilder().build()
@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from backend.core import graph_store
+
+NETWORK = ("node_ids", "lats", "lons", "node_values", "seg_u", "seg_v", "seg_keys", "seg_values")
+
+
+def state_dir(region):
+    # Fingerprints and snapshots of what was last loaded, next to the region's downloads.
+    return os.path.join(region.data_dir, "ingest")
+
+
+def fingerprint(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_fingerprints(directory):
+    path = os.path.join(directory, "fingerprints.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_fingerprints(directory, prints):
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, "fingerprints.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(prints, f, indent=2, sort_keys=True)
+    os.replace(tmp, os.path.join(directory, "fingerprints.json"))
+
+
+def hash_rows(frame):
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy(np.uint64)
+
+
+def diff(old_keys, old_values, new_keys, new_values):
+    # Row-level diff on 64-bit row hashes. Returns positions of inserted and changed rows in the
+    # new version and of removed rows in the old one.
+    order = np.argsort(old_keys, kind="stable")
+    keys = old_keys[order]
+    if len(keys):
+        pos = np.minimum(np.searchsorted(keys, new_keys), len(keys) - 1)
+        found = keys[pos] == new_keys
+    else:
+        pos = np.zeros(len(new_keys), dtype=np.int64)
+        found = np.zeros(len(new_keys), dtype=bool)
+    inserted = np.flatnonzero(~found)
+    changed = np.flatnonzero(found & (old_values[order][pos] != new_values))
+    removed = np.flatnonzero(~np.isin(old_keys, new_keys))
+    return inserted, changed, removed
+
+
+def network_arrays(net):
+    # Segments are keyed by their end nodes in id order plus the geometry read in that direction,
+    # so the same road hashes the same whichever way the loader or Neo4j lists it.
+    u = np.asarray(net["u"], dtype=np.int64)
+    v = np.asarray(net["v"], dtype=np.int64)
+    swap = u > v
+    geometry = [b if s else f for f, b, s in zip(net["fwd"], net["bwd"], swap.tolist())]
+    seg_u, seg_v = np.where(swap, v, u), np.where(swap, u, v)
+    lats = np.asarray(net["lats"], dtype=np.float64)
+    lons = np.asarray(net["lons"], dtype=np.float64)
+    return {
+        "node_ids": np.asarray(net["ids"], dtype=np.int64),
+        "lats": lats,
+        "lons": lons,
+        "node_values": hash_rows(pd.DataFrame({"lat": lats, "lon": lons})),
+        "seg_u": seg_u,
+        "seg_v": seg_v,
+        "seg_keys": hash_rows(pd.DataFrame({"u": seg_u, "v": seg_v, "geometry": geometry})),
+        "seg_values": hash_rows(pd.DataFrame({"distance": np.asarray(net["distance"], dtype=np.float64),
+                                              "cost": np.asarray(net["cost"], dtype=np.float64)})),
+    }
+
+
+def save_network(directory, net):
+    graph_store.save_arrays(os.path.join(directory, "osm_network"), network_arrays(net))
+
+
+def load_network(directory):
+    path = os.path.join(directory, "osm_network")
+    if not graph_store.exists(path, NETWORK):
+        return None
+    return graph_store.load_arrays(path, NETWORK, mmap_mode=None)
+
+
+def network_from_neo4j(db):
+    # Snapshot of a database loaded before snapshots were kept; one row per road, as the loader writes.
+    nodes = db.query("MATCH (n:RoadNode) RETURN n.id AS id, n.lat AS lat, n.lon AS lon")
+    segments = db.query("""
+    MATCH (u:RoadNode)-[r:ROAD_SEGMENT]->(v:RoadNode)
+    WHERE toInteger(u.id) < toInteger(v.id)
+    RETURN u.id AS u, v.id AS v, r.distance AS distance, r.cost AS cost, coalesce(r.geometry, '') AS geometry
+    """)
+    geometry = [r["geometry"] for r in segments]
+    return network_arrays({
+        "ids": [int(r["id"]) for r in nodes], "lats": [r["lat"] for r in nodes], "lons": [r["lon"] for r in nodes],
+        "u": [int(r["u"]) for r in segments], "v": [int(r["v"]) for r in segments],
+        "distance": [r["distance"] for r in segments], "cost": [r["cost"] for r in segments],
+        "fwd": geometry, "bwd": geometry,
+    })
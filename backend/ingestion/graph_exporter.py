@@ -0,0 +1,34 @@
+import os
+import time
+from backend.core.region import default_region
+from backend.core.road_graph import RoadGraph
+from backend.core.spatial import SpatialIndex
+from backend.core.transit import TransitEngine
+
+
+class GraphExporter:
+    def __init__(self, data_dir=None, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
+        self.data_dir = data_dir or self.region.data_dir
+
+    def is_exported(self):
+        return RoadGraph.exists(self.region.store_dir("road"))
+
+    def export(self):
+        started = time.time()
+        graph = RoadGraph.from_neo4j(self.db)
+        graph.save(self.region.store_dir("road"))
+        SpatialIndex(graph.node_ids, graph.lats, graph.lons).save(self.region.store_dir("road_index"))
+        print(f"Road graph exported: {len(graph)} nodes, {len(graph.targets)} segments.")
+
+        gtfs_dir = os.path.join(self.data_dir, "gtfs")
+        if os.path.exists(os.path.join(gtfs_dir, "stop_times.txt")):
+            transit = TransitEngine.from_gtfs(gtfs_dir)
+            transit.save(self.region.store_dir("transit"))
+            print(f"Timetable exported: {len(transit.stop_ids)} stops, {len(transit)} connections.")
+        print(f"Graph store ready at {self.region.store_dir()} in {time.time() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    GraphExporter().export()
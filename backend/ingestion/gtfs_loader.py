@@ -1,23 +1,80 @@
-import pandas as pd
 import os
-from backend.core.database import Neo4jConnector
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from backend.core.region import default_region
+from backend.core.metrics import timed
+from backend.core.projection import stamp
+from backend.core.spatial import SpatialIndex
+from backend.core.transit import times_to_sec, WALK_SPEED
 
 class GTFSLoader:
-    def __init__(self, gtfs_dir):
-        self.db = Neo4jConnector()
+    create_event_query = """
+    UNWIND $batch AS data
+    MATCH (s:Station {id: data.stop_id})
+    CREATE (e:TripEvent {id: data.event_id, arrival_time: data.arr, departure_time: data.dep,
+                         trip_id: data.trip_id, lat: s.lat, lon: s.lon,
+                         location: s.location, time: data.arr})
+    CREATE (s)-[:HAS_EVENT {cost: 0.0}]->(e)
+    CREATE (e)-[:AT_STATION {cost: 0.0}]->(s)
+    """
+    merge_event_query = """
+    UNWIND $batch AS data
+    MATCH (s:Station {id: data.stop_id})
+    MERGE (e:TripEvent {id: data.event_id})
+    SET e.arrival_time = data.arr,
+        e.departure_time = data.dep,
+        e.trip_id = data.trip_id,
+        e.lat = s.lat,
+        e.lon = s.lon,
+        e.location = s.location,
+        e.time = data.arr
+    MERGE (s)-[r:HAS_EVENT]->(e)
+    SET r.cost = 0.0
+    MERGE (e)-[r2:AT_STATION]->(s)
+    SET r2.cost = 0.0
+    """
+
+    def __init__(self, gtfs_dir, chunk_size=None, writers=None, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
         self.gtfs_dir = gtfs_dir
+        self.chunk_size = chunk_size or int(os.getenv("GTFS_CHUNK_SIZE", "100000"))
+        self.batch_size = int(os.getenv("GTFS_BATCH_SIZE", "5000"))
+        self.writers = writers or int(os.getenv("GTFS_WRITERS", "4"))
+        self.transfer_radius = float(os.getenv("TRANSFER_RADIUS", "500"))
+        self.transfer_k = int(os.getenv("TRANSFER_K", "8"))
+
+    def is_fresh(self):
+        return not self.db.query("MATCH (e:TripEvent) RETURN e.id AS id LIMIT 1")
 
     def load_gtfs(self):
-        stops = pd.read_csv(os.path.join(self.gtfs_dir, "stops.txt"))
-        stop_batch = []
-        for _, row in stops.iterrows():
-            stop_batch.append({
-                "id": str(row["stop_id"]),
-                "name": row["stop_name"],
-                "lat": float(row["stop_lat"]),
-                "lon": float(row["stop_lon"])
-            })
-        
+        # Without trip events the unique constraints guarantee no duplicate events, so CREATE is safe for
+        # them. Stations are always merged: an interrupted load may have written them before any event.
+        fresh = self.is_fresh()
+        stops = self.read_stops()
+        self.write_stops(stops)
+        self.load_stop_times(self.create_event_query if fresh else self.merge_event_query)
+        self.load_transfers(stops, fresh)
+        print("GTFS loading and connectivity established.")
+
+    def read_stops(self, gtfs_dir=None):
+        return pd.read_csv(
+            os.path.join(gtfs_dir or self.gtfs_dir, "stops.txt"),
+            usecols=["stop_id", "stop_name", "stop_lat", "stop_lon"],
+            dtype={"stop_id": str, "stop_name": str, "stop_lat": np.float64, "stop_lon": np.float64},
+        )
+
+    def write_stops(self, stops):
+        stop_batch = pd.DataFrame({
+            "id": stops["stop_id"],
+            "name": stops["stop_name"].where(stops["stop_name"].notna(), None),
+            "lat": stops["stop_lat"],
+            "lon": stops["stop_lon"],
+        }).to_dict("records")
+
         stop_query = """
         UNWIND $batch AS data
         MERGE (s:Station {id: data.id})
@@ -26,76 +83,108 @@ class GTFSLoader:
             s.lat = data.lat,
             s.lon = data.lon
         """
-        self.db.write(stop_query, {"batch": stop_batch})
+        if stop_batch:
+            stamp(self.db, ["Station"])
+        for i in range(0, len(stop_batch), self.batch_size):
+            batch = stop_batch[i:i + self.batch_size]
+            with timed("gtfs.stops", rows=len(batch)):
+                self.db.write(stop_query, {"batch": batch})
+
+    def stop_time_frames(self, gtfs_dir=None):
+        chunks = pd.read_csv(
+            os.path.join(gtfs_dir or self.gtfs_dir, "stop_times.txt"),
+            usecols=["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"],
+            dtype={"trip_id": str, "arrival_time": str, "departure_time": str,
+                   "stop_id": str, "stop_sequence": np.int32},
+            chunksize=self.chunk_size,
+        )
+        for chunk in chunks:
+            arr = times_to_sec(chunk["arrival_time"])
+            dep = times_to_sec(chunk["departure_time"])
+            # Non-timepoint rows carry no times and are skipped, as in the transit engine.
+            keep = (arr.notna() & dep.notna()).values
+            yield pd.DataFrame({
+                "stop_id": chunk["stop_id"].values[keep],
+                "event_id": (chunk["trip_id"] + "_" + chunk["stop_sequence"].astype(str)).values[keep],
+                "trip_id": chunk["trip_id"].values[keep],
+                "arr": arr.values[keep].astype(np.int64),
+                "dep": dep.values[keep].astype(np.int64),
+            })
+
+    def read_stop_times(self):
+        for frame in self.stop_time_frames():
+            for i in range(0, len(frame), self.batch_size):
+                yield frame.iloc[i:i + self.batch_size].to_dict("records")
+
+    def load_stop_times(self, event_query):
+        return self.write_stop_times(self.read_stop_times(), event_query)
+
+    def write_stop_times(self, batches, event_query):
+        started = time.time()
+        rows = 0
+        pending = deque()
+        stamp(self.db, ["TripEvent", "HAS_EVENT", "AT_STATION"])
+        # Keep a bounded number of batches in flight so memory stays flat for any feed size.
+        with ThreadPoolExecutor(max_workers=self.writers) as pool:
+            for batch in batches:
+                if len(pending) >= 2 * self.writers:
+                    rows += pending.popleft().result()
+                pending.append(pool.submit(self._write_batch, event_query, batch))
+            while pending:
+                rows += pending.popleft().result()
+        elapsed = max(time.time() - started, 1e-9)
+        print(f"Stop times: {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/s).")
+        return rows
+
+    def _write_batch(self, query, batch):
+        with timed("gtfs.stop_times", rows=len(batch)):
+            self.db.write_tx(query, {"batch": batch})
+        return len(batch)
 
-        stop_times = pd.read_csv(os.path.join(self.gtfs_dir, "stop_times.txt"))
-        
-        def time_to_sec(t_str):
-            h, m, s = map(int, t_str.split(':'))
-            return h * 3600 + m * 60 + s
+    def road_index(self):
+        road_index_dir = self.region.store_dir("road_index")
+        if SpatialIndex.exists(road_index_dir):
+            return SpatialIndex.load(road_index_dir)
+        return SpatialIndex.from_records(
+            self.db.query("MATCH (n:RoadNode) RETURN n.id AS id, n.lat AS lat, n.lon AS lon"))
 
-        event_query = """
+    def transfer_edges(self, stops, index):
+        edges = []
+        for stop_id, lat, lon in zip(stops["stop_id"].tolist(), stops["stop_lat"].tolist(),
+                                     stops["stop_lon"].tolist()):
+            ids, dists = index.within(lat, lon, self.transfer_radius, self.transfer_k)
+            if not ids:
+                # Stations with no road node in range still get a link to the nearest one.
+                node_id, dist = index.nearest(lat, lon)
+                if node_id is None:
+                    continue
+                ids, dists = [node_id], [dist]
+            for node_id, dist in zip(ids, np.asarray(dists).tolist()):
+                edges.append({"station": stop_id, "node": node_id, "distance": dist, "cost": dist / WALK_SPEED})
+        return edges
+
+    def load_transfers(self, stops, fresh):
+        started = time.time()
+        edges = self.transfer_edges(stops, self.road_index())
+        self.write_transfers(edges, "CREATE" if fresh else "MERGE")
+        print(f"Transfers: {len(edges)} station-road links in {time.time() - started:.1f}s.")
+        return len(edges)
+
+    def write_transfers(self, edges, op="MERGE"):
+        query = f"""
         UNWIND $batch AS data
-        MATCH (s:Station {id: data.stop_id})
-        MERGE (e:TripEvent {id: data.event_id})
-        SET e.arrival_time = data.arr,
-            e.departure_time = data.dep,
-            e.trip_id = data.trip_id,
-            e.lat = s.lat,
-            e.lon = s.lon,
-            e.location = s.location,
-            e.time = data.arr
-        MERGE (s)-[r:HAS_EVENT]->(e)
-        SET r.cost = 0.0
-        MERGE (e)-[r2:AT_STATION]->(s)
-        SET r2.cost = 0.0
-        """
-        
-        batch_size = 5000
-        for i in range(0, len(stop_times), batch_size):
-            batch = []
-            chunk = stop_times.iloc[i:i+batch_size]
-            for _, row in chunk.iterrows():
-                batch.append({
-                    "stop_id": str(row["stop_id"]),
-                    "event_id": f"{row['trip_id']}_{row['stop_sequence']}",
-                    "trip_id": str(row["trip_id"]),
-                    "arr": time_to_sec(row["arrival_time"]),
-                    "dep": time_to_sec(row["departure_time"])
-                })
-            self.db.write(event_query, {"batch": batch})
-        
-        transfer_query = """
-        MATCH (s:Station)
-        MATCH (n:RoadNode)
-        WHERE point.distance(s.location, n.location) < 500
-        MERGE (s)-[r:WALK_TO]->(n)
-        SET r.distance = point.distance(s.location, n.location),
-            r.cost = point.distance(s.location, n.location) / 1.4
-        MERGE (n)-[r2:WALK_TO]->(s)
-        SET r2.distance = point.distance(s.location, n.location),
-            r2.cost = point.distance(s.location, n.location) / 1.4
+        MATCH (s:Station {{id: data.station}})
+        MATCH (n:RoadNode {{id: data.node}})
+        {op} (s)-[r:WALK_TO]->(n)
+        SET r.distance = data.distance,
+            r.cost = data.cost
+        {op} (n)-[r2:WALK_TO]->(s)
+        SET r2.distance = data.distance,
+            r2.cost = data.cost
         """
-        self.db.write(transfer_query)
-        
-        fallback_query = """
-        MATCH (s:Station)
-        WHERE NOT (s)-[:WALK_TO]-()
-        CALL {
-            WITH s
-            MATCH (n:RoadNode)
-            WITH n, point.distance(s.location, n.location) AS dist
-            ORDER BY dist ASC
-            LIMIT 1
-            RETURN n, dist
-        }
-        MERGE (s)-[r:WALK_TO]->(n)
-        SET r.distance = dist,
-            r.cost = dist / 1.4
-        MERGE (n)-[r2:WALK_TO]->(s)
-        SET r2.distance = dist,
-            r2.cost = dist / 1.4
-        """
-        self.db.write(fallback_query)
-        
-        print("GTFS loading and connectivity established.")
+        if edges:
+            stamp(self.db, ["WALK_TO"])
+        for i in range(0, len(edges), self.batch_size):
+            batch = edges[i:i + self.batch_size]
+            with timed("gtfs.transfers", rows=len(batch)):
+                self.db.write(query, {"batch": batch})
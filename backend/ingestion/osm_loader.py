@@ -1,12 +1,28 @@
+import os
+import csv
+import argparse
 import requests
 import time
-import math
-from backend.core.database import Neo4jConnector
+import numpy as np
+from backend.core.region import default_region
+from backend.core.geo import haversine
+from backend.core.metrics import timed
+from backend.core.projection import stamp
+from backend.ingestion import feed_diff
+from backend.ingestion.osm_reader import OSMReader
+from backend.ingestion.simplify import simplify
 
 class OSMLoader:
-    def __init__(self, pbf_path=None, bbox="17.2,78.2,17.8,79.2"):
-        self.db = Neo4jConnector()
-        self.bbox = bbox
+    def __init__(self, pbf_path=None, bbox=None, csv_dir=None, region=None):
+        # Writing import CSVs is fully offline and needs no database connection.
+        region = region or default_region()
+        self.db = None if csv_dir else region.connector()
+        self.state_dir = feed_diff.state_dir(region)
+        self.pbf_path = pbf_path
+        self.csv_dir = csv_dir
+        self.simplify = os.getenv("OSM_SIMPLIFY", "1") == "1"
+        self.bbox = bbox or region.overpass_bbox()
+        self.batch_size = int(os.getenv("OSM_BATCH_SIZE", "20000"))
         self.overpass_url = "http://overpass-api.de/api/interpreter"
         self.speed_map = {
             "motorway": 100.0,
@@ -21,15 +37,16 @@ class OSMLoader:
             "pedestrian": 5.0
         }
 
-    def _haversine(self, lat1, lon1, lat2, lon2):
-        R = 6371000
-        phi1, phi2 = math.radians(lat1), math.radians(lat2)
-        dphi = math.radians(lat2 - lat1)
-        dlambda = math.radians(lon2 - lon1)
-        a = math.sin(dphi / 2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2)**2
-        return 2 * R * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
     def load_network(self):
+        network = self.read_network()
+        if network is not None:
+            self.write_network(*network)
+
+    def read_network(self):
+        # (sorted node ids, lats, lons, iterable of (refs, tags) ways), or None if the download failed.
+        if self.pbf_path:
+            return self.read_file(self.pbf_path)
+
         query = f"""
         [out:json][timeout:600];
         (
@@ -50,70 +67,192 @@ class OSMLoader:
             except Exception as e:
                 if attempt == max_retries - 1:
                     print(f"Overpass API failed after {max_retries} attempts: {e}")
-                    return
+                    return None
                 print(f"Overpass attempt {attempt+1} failed, retrying in 10s...")
                 time.sleep(10)
 
-        nodes = {str(n["id"]): n for n in data["elements"] if n["type"] == "node"}
-        ways = [w for w in data["elements"] if w["type"] == "way"]
+        nodes = [n for n in data["elements"] if n["type"] == "node"]
+        ids, first = np.unique(np.asarray([n["id"] for n in nodes], dtype=np.int64), return_index=True)
+        lats = np.asarray([n["lat"] for n in nodes], dtype=np.float64)[first]
+        lons = np.asarray([n["lon"] for n in nodes], dtype=np.float64)[first]
+        ways = ((np.asarray(w["nodes"], dtype=np.int64), w.get("tags", {}))
+                for w in data["elements"] if w["type"] == "way")
+        return ids, lats, lons, ways
 
-        node_batch = []
-        for nid, n in nodes.items():
-            node_batch.append({
-                "id": nid,
-                "lat": n["lat"],
-                "lon": n["lon"]
-            })
-        
-        node_query = """
-        UNWIND $batch AS data
-        MERGE (n:RoadNode {id: data.id})
-        SET n.location = point({latitude: data.lat, longitude: data.lon}),
-            n.lat = data.lat,
-            n.lon = data.lon
-        """
-        batch_size = 5000
-        for i in range(0, len(node_batch), batch_size):
-            self.db.write(node_query, {"batch": node_batch[i:i+batch_size]})
-
-        edge_batch = []
-        for w in ways:
-            highway = w.get("tags", {}).get("highway", "unclassified")
-            speed = self.speed_map.get(highway, 30.0)
-            
-            w_nodes = w["nodes"]
-            for i in range(len(w_nodes) - 1):
-                u_id = str(w_nodes[i])
-                v_id = str(w_nodes[i+1])
-                if u_id in nodes and v_id in nodes:
-                    u = nodes[u_id]
-                    v = nodes[v_id]
-                    
-                    distance = self._haversine(u["lat"], u["lon"], v["lat"], v["lon"])
-                    cost = (distance / 1000.0) / speed * 3600.0 if speed > 0 else distance
-                    
-                    edge_batch.append({
-                        "u": u_id,
-                        "v": v_id,
-                        "distance": distance,
-                        "speed_limit": speed,
-                        "cost": cost
-                    })
-
-        edge_query = """
-        UNWIND $batch AS data
-        MATCH (u:RoadNode {id: data.u})
-        MATCH (v:RoadNode {id: data.v})
-        MERGE (u)-[r:ROAD_SEGMENT {distance: data.distance}]->(v)
-        SET r.speed_limit = data.speed_limit,
-            r.cost = data.cost
-        MERGE (v)-[r2:ROAD_SEGMENT {distance: data.distance}]->(u)
-        SET r2.speed_limit = data.speed_limit,
-            r2.cost = data.cost
-        """
-        
-        batch_size = 5000
-        for i in range(0, len(edge_batch), batch_size):
-            self.db.write(edge_query, {"batch": edge_batch[i:i+batch_size]})
-        
-        print(f"OSM ingestion complete: {len(node_batch)} nodes, {len(edge_batch)} segments.")
+    def load_file(self, path):
+        started = time.time()
+        self.write_network(*self.read_file(path))
+        print(f"OSM file ingested in {time.time() - started:.1f}s.")
+
+    def read_file(self, path):
+        # Three streaming passes: referenced node ids, their coordinates, then nodes and segments.
+        started = time.time()
+        reader = OSMReader(path)
+        chunks, pending, size = [], [], 0
+        for refs, tags in reader.ways():
+            if "highway" not in tags:
+                continue
+            pending.append(refs)
+            size += len(refs)
+            if size >= 1 << 20:
+                chunks.append(np.unique(np.concatenate(pending)))
+                pending, size = [], 0
+        ref_ids = np.unique(np.concatenate(chunks + pending)) if chunks or pending else np.empty(0, np.int64)
+
+        lats = np.full(len(ref_ids), np.nan)
+        lons = np.full(len(ref_ids), np.nan)
+        for ids, node_lats, node_lons in reader.nodes():
+            pos = np.minimum(np.searchsorted(ref_ids, ids), max(len(ref_ids) - 1, 0))
+            hit = ref_ids[pos] == ids if len(ref_ids) else np.zeros(len(ids), dtype=bool)
+            lats[pos[hit]] = node_lats[hit]
+            lons[pos[hit]] = node_lons[hit]
+        print(f"OSM scan: {len(ref_ids)} road nodes referenced in {time.time() - started:.1f}s.")
+        return ref_ids, lats, lons, reader.ways()
+
+    def build_network(self, ids, lats, lons, ways):
+        # ids are sorted OSM node ids; lats/lons are NaN for nodes missing from the extract.
+        # Returns the graph as written: kept nodes, and one row per segment with both geometries.
+        known = ~np.isnan(lats)
+        last = max(len(ids) - 1, 0)
+        us, vs, speeds = [], [], []
+        for refs, tags in ways:
+            highway = tags.get("highway")
+            if highway is None or len(refs) < 2 or not len(ids):
+                continue
+            pos = np.minimum(np.searchsorted(ids, refs), last)
+            valid = (ids[pos] == refs) & known[pos]
+            ok = valid[:-1] & valid[1:]
+            us.append(pos[:-1][ok])
+            vs.append(pos[1:][ok])
+            speeds.append(np.full(int(ok.sum()), self.speed_map.get(highway, 30.0)))
+        u = np.concatenate(us) if us else np.empty(0, np.int64)
+        v = np.concatenate(vs) if vs else np.empty(0, np.int64)
+        speed = np.concatenate(speeds) if speeds else np.empty(0)
+        distance = haversine(lats[u], lons[u], lats[v], lons[v])
+        cost = distance / 1000.0 / speed * 3600.0
+        raw_nodes, raw_segments = len(np.union1d(u, v)), len(u)
+
+        if self.simplify:
+            keep, u, v, distance, cost, fwd, bwd = simplify(lats, lons, u, v, distance, cost)
+            speed = np.where(cost > 0, distance / np.maximum(cost, 1e-9) * 3.6, 30.0)
+        else:
+            keep = np.zeros(len(ids), dtype=bool)
+            keep[u] = True
+            keep[v] = True
+            fwd = bwd = [""] * len(u)
+        return {
+            "ids": ids[keep], "lats": lats[keep], "lons": lons[keep],
+            "u": ids[u], "v": ids[v], "distance": distance, "speed": speed, "cost": cost,
+            "fwd": list(fwd), "bwd": list(bwd), "raw_nodes": raw_nodes, "raw_segments": raw_segments,
+        }
+
+    def write_network(self, ids, lats, lons, ways):
+        net = self.build_network(ids, lats, lons, ways)
+        sink = OSMCsvSink(self.csv_dir) if self.csv_dir else OSMGraphSink(self.db, self.batch_size)
+        sink.nodes(net["ids"].astype(str), net["lats"], net["lons"])
+        sink.segments(net["u"].astype(str), net["v"].astype(str), net["distance"], net["speed"], net["cost"],
+                      net["fwd"], net["bwd"])
+        sink.close()
+        if self.db is not None:
+            # Later refreshes diff the next extract against what was written here.
+            feed_diff.save_network(self.state_dir, net)
+        print(f"OSM ingestion complete: {len(net['ids'])} nodes, {len(net['u'])} segments "
+              f"(from {net['raw_nodes']} nodes, {net['raw_segments']} segments).")
+        return len(net["ids"]), len(net["u"])
+
+
+class OSMGraphSink:
+    # CREATE-only batches for a fresh database; both directions of a segment are written together.
+    node_query = """
+    UNWIND $batch AS data
+    CREATE (n:RoadNode {id: data.id, lat: data.lat, lon: data.lon,
+                        location: point({latitude: data.lat, longitude: data.lon})})
+    """
+    edge_query = """
+    UNWIND $batch AS data
+    MATCH (u:RoadNode {id: data.u})
+    MATCH (v:RoadNode {id: data.v})
+    CREATE (u)-[:ROAD_SEGMENT {distance: data.distance, speed_limit: data.speed_limit, cost: data.cost,
+                               geometry: data.fwd}]->(v)
+    CREATE (v)-[:ROAD_SEGMENT {distance: data.distance, speed_limit: data.speed_limit, cost: data.cost,
+                               geometry: data.bwd}]->(u)
+    """
+
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+
+    def nodes(self, ids, lats, lons):
+        if len(ids):
+            stamp(self.db, ["RoadNode"])
+        for i in range(0, len(ids), self.batch_size):
+            batch = [{"id": n, "lat": la, "lon": lo} for n, la, lo in zip(
+                ids[i:i + self.batch_size].tolist(), lats[i:i + self.batch_size].tolist(),
+                lons[i:i + self.batch_size].tolist())]
+            with timed("osm.nodes", rows=len(batch)):
+                self.db.write(self.node_query, {"batch": batch})
+
+    def segments(self, us, vs, distances, speeds, costs, fwd, bwd):
+        if len(us):
+            stamp(self.db, ["ROAD_SEGMENT"])
+        rows = zip(us.tolist(), vs.tolist(), distances.tolist(), speeds.tolist(), costs.tolist(), fwd, bwd)
+        batch = []
+        for u, v, d, s, c, f, b in rows:
+            batch.append({"u": u, "v": v, "distance": d, "speed_limit": s, "cost": c, "fwd": f, "bwd": b})
+            if len(batch) >= self.batch_size:
+                self.write_segments(batch)
+                batch = []
+        if batch:
+            self.write_segments(batch)
+
+    def write_segments(self, batch):
+        with timed("osm.segments", rows=len(batch)):
+            self.db.write(self.edge_query, {"batch": batch})
+
+    def close(self):
+        pass
+
+
+class OSMCsvSink:
+    # Header files for `neo4j-admin database import full`.
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.node_file = open(os.path.join(directory, "road_nodes.csv"), "w", newline="")
+        self.edge_file = open(os.path.join(directory, "road_segments.csv"), "w", newline="")
+        self.node_writer = csv.writer(self.node_file)
+        self.edge_writer = csv.writer(self.edge_file)
+        self.node_writer.writerow(["id:ID(RoadNode)", "lat:double", "lon:double",
+                                   "location:point{crs:WGS-84}", ":LABEL"])
+        self.edge_writer.writerow([":START_ID(RoadNode)", ":END_ID(RoadNode)", "distance:double",
+                                   "speed_limit:double", "cost:double", "geometry", ":TYPE"])
+
+    def nodes(self, ids, lats, lons):
+        self.node_writer.writerows(
+            (n, la, lo, f"{{latitude:{la},longitude:{lo}}}", "RoadNode")
+            for n, la, lo in zip(ids.tolist(), lats.tolist(), lons.tolist()))
+
+    def segments(self, us, vs, distances, speeds, costs, fwd, bwd):
+        rows = zip(us.tolist(), vs.tolist(), distances.tolist(), speeds.tolist(), costs.tolist(), fwd, bwd)
+        for u, v, d, s, c, f, b in rows:
+            self.edge_writer.writerow((u, v, d, s, c, f, "ROAD_SEGMENT"))
+            self.edge_writer.writerow((v, u, d, s, c, b, "ROAD_SEGMENT"))
+
+    def close(self):
+        self.node_file.close()
+        self.edge_file.close()
+        print(f"Import CSVs written to {self.directory}. Load them into an empty database with:\n"
+              f"  neo4j-admin database import full --nodes={self.directory}/road_nodes.csv "
+              f"--relationships={self.directory}/road_segments.csv neo4j")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the road graph from a local OSM PBF or XML extract.")
+    parser.add_argument("path")
+    parser.add_argument("--csv-dir", help="write neo4j-admin import CSVs instead of loading into Neo4j")
+    args = parser.parse_args()
+    OSMLoader(pbf_path=args.path, csv_dir=args.csv_dir).load_network()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import bz2
+import gzip
+import lzma
+import struct
+import zlib
+import xml.etree.ElementTree as ET
+import numpy as np
+from backend.core.metrics import timed
+
+CHUNK = 65536
+
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    # Minimal protobuf wire decoder: yields (field, value) with ints for varints and bytes for blobs.
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 2:
+            size, pos = _varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == 1:
+            value, pos = None, pos + 8
+        elif wire == 5:
+            value, pos = None, pos + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire}")
+        yield field, value
+
+
+def _packed(buf, signed=False):
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if not len(b):
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.r_[0, ends[:-1] + 1]
+    shifts = (np.arange(len(b)) - np.repeat(starts, ends - starts + 1)) * 7
+    values = np.add.reduceat((b & 0x7F).astype(np.uint64) << shifts.astype(np.uint64), starts)
+    if signed:
+        return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    return values.astype(np.int64)
+
+
+def _zigzag(v):
+    return (v >> 1) ^ -(v & 1)
+
+
+class OSMReader:
+    # Streams nodes and ways from an .osm.pbf or OSM XML (.osm, .osm.gz, .osm.bz2) file.
+    def __init__(self, path):
+        self.path = path
+        self.is_pbf = path.endswith(".pbf")
+
+    def nodes(self):
+        return self._pbf_nodes() if self.is_pbf else self._xml_nodes()
+
+    def ways(self):
+        return self._pbf_ways() if self.is_pbf else self._xml_ways()
+
+    def _open(self):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, "rb")
+        if self.path.endswith(".bz2"):
+            return bz2.open(self.path, "rb")
+        return open(self.path, "rb")
+
+    def _xml(self, tag):
+        with self._open() as f:
+            for _, elem in ET.iterparse(f, events=("end",)):
+                if elem.tag == tag:
+                    yield elem
+                    elem.clear()
+                elif elem.tag in ("node", "way", "relation"):
+                    elem.clear()
+
+    def _xml_nodes(self):
+        ids, lats, lons = [], [], []
+        for elem in self._xml("node"):
+            ids.append(int(elem.get("id")))
+            lats.append(float(elem.get("lat")))
+            lons.append(float(elem.get("lon")))
+            if len(ids) >= CHUNK:
+                yield np.asarray(ids, dtype=np.int64), np.asarray(lats), np.asarray(lons)
+                ids, lats, lons = [], [], []
+        if ids:
+            yield np.asarray(ids, dtype=np.int64), np.asarray(lats), np.asarray(lons)
+
+    def _xml_ways(self):
+        for elem in self._xml("way"):
+            tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+            refs = np.asarray([int(nd.get("ref")) for nd in elem.iter("nd")], dtype=np.int64)
+            yield refs, tags
+
+    def _blocks(self):
+        with open(self.path, "rb") as f:
+            while True:
+                head = f.read(4)
+                if len(head) < 4:
+                    return
+                header = dict(_fields(f.read(struct.unpack(">I", head)[0])))
+                blob = dict(_fields(f.read(header[3])))
+                if bytes(header[1]) != b"OSMData":
+                    continue
+                with timed("osm.blob", nbytes=header[3]):
+                    if 1 in blob:
+                        data = bytes(blob[1])
+                    elif 3 in blob:
+                        data = zlib.decompress(blob[3])
+                    elif 4 in blob:
+                        data = lzma.decompress(blob[4])
+                    else:
+                        raise ValueError("Unsupported PBF blob compression")
+                yield data
+
+    def _pbf_groups(self):
+        for data in self._blocks():
+            strings, groups = [], []
+            granularity, lat_offset, lon_offset = 100, 0, 0
+            for field, value in _fields(data):
+                if field == 1:
+                    strings = [bytes(s).decode("utf-8") for f, s in _fields(value) if f == 1]
+                elif field == 2:
+                    groups.append(value)
+                elif field == 17:
+                    granularity = value
+                elif field == 19:
+                    lat_offset = _zigzag(value)
+                elif field == 20:
+                    lon_offset = _zigzag(value)
+
+            def scale(raw, offset):
+                return (offset + granularity * raw) * 1e-9
+
+            for group in groups:
+                yield strings, scale, lat_offset, lon_offset, group
+
+    def _pbf_nodes(self):
+        for _, scale, lat_offset, lon_offset, group in self._pbf_groups():
+            ids, lats, lons = [], [], []
+            for field, value in _fields(group):
+                if field == 2:
+                    dense = {f: v for f, v in _fields(value) if f in (1, 8, 9)}
+                    if 1 in dense:
+                        yield (np.cumsum(_packed(dense[1], True)),
+                               scale(np.cumsum(_packed(dense[8], True)), lat_offset),
+                               scale(np.cumsum(_packed(dense[9], True)), lon_offset))
+                elif field == 1:
+                    node = {f: v for f, v in _fields(value) if f in (1, 8, 9)}
+                    ids.append(_zigzag(node[1]))
+                    lats.append(scale(_zigzag(node[8]), lat_offset))
+                    lons.append(scale(_zigzag(node[9]), lon_offset))
+            if ids:
+                yield np.asarray(ids, dtype=np.int64), np.asarray(lats), np.asarray(lons)
+
+    def _pbf_ways(self):
+        for strings, _, _, _, group in self._pbf_groups():
+            for field, value in _fields(group):
+                if field != 3:
+                    continue
+                keys = vals = refs = b""
+                for f, v in _fields(value):
+                    if f == 2:
+                        keys = v
+                    elif f == 3:
+                        vals = v
+                    elif f == 8:
+                        refs = v
+                tags = {strings[k]: strings[v] for k, v in zip(_packed(keys).tolist(), _packed(vals).tolist())}
+                yield np.cumsum(_packed(refs, True)), tags
@@ -1,34 +1,205 @@
+import os
+import time
+import fcntl
+import threading
 import requests
 from google.transit import gtfs_realtime_pb2
-from backend.core.database import Neo4jConnector
+from backend.core.region import default_region
+from backend.core.delays import DelayOverlay
+from backend.core.metrics import timed
 
 class RealtimeFeeder:
-    def __init__(self, feed_url):
+    def __init__(self, feed_url, cache=None, transit=None, interval=None, checkpoint_interval=None, region=None):
+        # feed_url may be an http(s) URL, a file:// URL or a local path to a serialized FeedMessage.
         self.feed_url = feed_url
-        self.db = Neo4jConnector()
+        region = region or default_region()
+        self.db = region.connector()
+        # Uvicorn workers share one poller: the holder of the lock fetches the feed, writes it to the shared
+        # copy and checkpoints; the other workers apply the shared copy to their own timetables.
+        self.lock_path = os.path.join(region.data_dir, ".realtime.lock")
+        self.shared_path = os.path.join(region.data_dir, "realtime.pb")
+        self.lock_file = None
+        self.shared_stamp = None
+        self.cache = cache
+        self.transit = None
+        self.overlay = None
+        self.attach(transit)
+        self.interval = interval or float(os.getenv("GTFS_RT_INTERVAL", "30"))
+        self.checkpoint_interval = checkpoint_interval or float(os.getenv("GTFS_RT_CHECKPOINT", "300"))
+        self.last_checkpoint = time.monotonic()
+        self.checkpointed = {}
+        self.stop_event = threading.Event()
+        self.feeds = 0
+        self.errors = 0
+        self.last_apply_ms = 0.0
+        self.max_apply_ms = 0.0
+        self.total_apply_ms = 0.0
+        self.last_feed_timestamp = 0
+        self.last_updates = 0
+
+    def attach(self, transit):
+        # Delays live on the timetable; a reloaded timetable starts with a fresh overlay.
+        self.transit = transit
+        if transit is not None:
+            self.overlay = transit.delays = DelayOverlay(transit)
+
+    def fetch(self):
+        with timed("realtime.fetch") as t:
+            path = self.feed_url[len("file://"):] if self.feed_url.startswith("file://") else self.feed_url
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    body = f.read()
+            else:
+                response = requests.get(self.feed_url, timeout=30)
+                response.raise_for_status()
+                body = response.content
+            t.nbytes = len(body)
+            return body
+
+    def lead(self):
+        # Non-blocking, retried every interval; the lock moves on when its holder stops or exits.
+        if self.lock_file is None:
+            if self.stop_event.is_set():
+                return False
+            lock = open(self.lock_path, "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                return False
+            self.lock_file = lock
+        return True
+
+    def share(self, body):
+        tmp = f"{self.shared_path}.{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(body)
+        os.replace(tmp, self.shared_path)
+
+    def read_shared(self):
+        # The leader's latest feed, or None when it has not changed since it was last applied here.
+        try:
+            st = os.stat(self.shared_path)
+        except FileNotFoundError:
+            return None
+        if (st.st_ino, st.st_mtime_ns) == self.shared_stamp:
+            return None
+        self.shared_stamp = (st.st_ino, st.st_mtime_ns)
+        with open(self.shared_path, "rb") as f:
+            return f.read()
 
     def update_delays(self):
-        response = requests.get(self.feed_url)
+        leader = self.lead()
+        body = self.fetch() if leader else self.read_shared()
+        if body is None:
+            return
+        if leader:
+            self.share(body)
         feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(response.content)
-        
-        for entity in feed.entity:
-            if entity.HasField('trip_update'):
-                self._apply_update(entity.trip_update)
+        with timed("realtime.parse", nbytes=len(body)):
+            feed.ParseFromString(body)
+
+        started = time.perf_counter()
+        with timed("realtime.apply") as stage:
+            updates = {}
+            for entity in feed.entity:
+                if entity.HasField('trip_update'):
+                    update = entity.trip_update
+                    rows = updates.setdefault(update.trip.trip_id, [])
+                    for stu in update.stop_time_update:
+                        rows.append((
+                            stu.stop_sequence if stu.HasField('stop_sequence') else None,
+                            stu.stop_id,
+                            stu.arrival.delay if stu.HasField('arrival') else None,
+                            stu.departure.delay if stu.HasField('departure') else None,
+                        ))
+
+            if self.overlay is not None:
+                changed = self.overlay.apply(updates)
+            else:
+                changed = set(updates)
+            if self.cache is not None and changed:
+                self.cache.invalidate_trips(changed)
+            stage.rows = sum(len(rows) for rows in updates.values())
 
-    def _apply_update(self, update):
+        elapsed = (time.perf_counter() - started) * 1000.0
+        self.feeds += 1
+        self.last_apply_ms = elapsed
+        self.max_apply_ms = max(self.max_apply_ms, elapsed)
+        self.total_apply_ms += elapsed
+        self.last_feed_timestamp = feed.header.timestamp
+        self.last_updates = stage.rows
+
+        if not leader:
+            return
+        if self.overlay is None:
+            self.checkpoint(self._events(updates))
+        elif time.monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint(self.overlay.delayed_events())
+
+    @staticmethod
+    def _events(updates):
+        events = {}
+        for trip_id, rows in updates.items():
+            for seq, _, arr, dep in rows:
+                if seq is not None:
+                    events[(trip_id, seq)] = arr if arr is not None else (dep or 0)
+        return events
+
+    def checkpoint(self, events):
+        # One batched write per checkpoint; events that recovered since the last one are reset to zero.
         query = """
         UNWIND $updates AS upd
-        MATCH (e:TripEvent) 
-        WHERE e.id STARTS WITH upd.trip_id + '_' + upd.stop_id
+        MATCH (e:TripEvent {id: upd.event_id})
         SET e.delay = upd.delay,
-            e.actual_time = datetime(e.time) + duration({seconds: upd.delay})
+            e.actual_time = e.time + upd.delay
         """
-        batch = []
-        for stop_time_update in update.stop_time_update:
-            batch.append({
-                "trip_id": update.trip.trip_id,
-                "stop_id": stop_time_update.stop_id,
-                "delay": stop_time_update.arrival.delay
-            })
-        self.db.write(query, {"updates": batch})
+        batch = {key: delay for key, delay in events.items() if self.checkpointed.get(key, 0) != delay}
+        for key in self.checkpointed.keys() - events.keys():
+            batch[key] = 0
+        if batch:
+            with timed("realtime.checkpoint", rows=len(batch)):
+                self.db.write(query, {"updates": [
+                    {"event_id": f"{trip_id}_{seq}", "delay": delay} for (trip_id, seq), delay in batch.items()
+                ]})
+        self.checkpointed = {key: delay for key, delay in events.items() if delay}
+        self.last_checkpoint = time.monotonic()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.update_delays()
+            except Exception as e:
+                self.errors += 1
+                print(f"Realtime feed update failed: {e}")
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.lock_file is None:
+            return
+        try:
+            if self.overlay is not None:
+                self.checkpoint(self.overlay.delayed_events())
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def stats(self):
+        return {
+            "leader": self.lock_file is not None,
+            "feeds": self.feeds,
+            "errors": self.errors,
+            "last_apply_ms": round(self.last_apply_ms, 3),
+            "max_apply_ms": round(self.max_apply_ms, 3),
+            "mean_apply_ms": round(self.total_apply_ms / self.feeds, 3) if self.feeds else 0.0,
+            "last_feed_timestamp": self.last_feed_timestamp,
+            "last_updates": self.last_updates,
+            "delayed_events": len(self.overlay.events) if self.overlay is not None else 0,
+            "interval": self.interval,
+        }
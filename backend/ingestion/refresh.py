@@ -0,0 +1,355 @@
+import os
+import time
+import shutil
+import zipfile
+import argparse
+import numpy as np
+import pandas as pd
+import requests
+from backend.core import graph_store
+from backend.core.metrics import timed
+from backend.core.projection import ProjectionManager, stamp
+from backend.core.region import default_region, load_regions
+from backend.core.road_graph import RoadGraph
+from backend.core.spatial import SpatialIndex
+from backend.core.transit import TransitEngine
+from backend.ingestion import feed_diff
+from backend.ingestion.ch_builder import CHBuilder
+from backend.ingestion.gtfs_loader import GTFSLoader
+from backend.ingestion.osm_loader import OSMLoader, OSMGraphSink
+
+# Projected labels and relationship types each stage's ad-hoc queries can touch.
+STAMPS = {
+    "osm.nodes": ["RoadNode", "ROAD_SEGMENT", "WALK_TO"],
+    "osm.segments": ["ROAD_SEGMENT"],
+    "gtfs.stops": ["Station", "TripEvent", "WALK_TO", "HAS_EVENT", "AT_STATION"],
+    "gtfs.stop_times": ["TripEvent", "HAS_EVENT", "AT_STATION"],
+    "gtfs.transfers": ["WALK_TO"],
+}
+
+
+def download(url, dest):
+    print(f"Downloading {url}...")
+    r = requests.get(url, stream=True)
+    r.raise_for_status()
+    with open(dest, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=8192):
+            f.write(chunk)
+
+
+class FeedRefresher:
+    # Brings a loaded region up to date with its current feeds. Each GTFS file and the OSM extract
+    # is fingerprinted; changed ones are diffed row by row against the last loaded version and
+    # only inserted, changed and removed rows are written. Transfers are relinked around touched
+    # stops and roads, and only the projections and stores that depend on changed data are rebuilt.
+    def __init__(self, region=None):
+        self.region = region or default_region()
+        self.db = self.region.connector()
+        self.data_dir = self.region.data_dir
+        self.state_dir = feed_diff.state_dir(self.region)
+        self.gtfs_dir = os.path.join(self.data_dir, "gtfs")
+        self.batch_size = int(os.getenv("REFRESH_BATCH_SIZE", "5000"))
+        self.transfer_radius = float(os.getenv("TRANSFER_RADIUS", "500"))
+
+    def record(self):
+        # Called after a full load, so the next refresh has a baseline to compare against.
+        prints = {}
+        if self.region.osm_file and os.path.exists(self.region.osm_file):
+            prints["osm"] = feed_diff.fingerprint(self.region.osm_file)
+        gtfs_zip = os.path.join(self.data_dir, "gtfs.zip")
+        if os.path.exists(gtfs_zip):
+            prints["gtfs.zip"] = feed_diff.fingerprint(gtfs_zip)
+            prints.update(self._file_prints(self.gtfs_dir))
+        feed_diff.save_fingerprints(self.state_dir, prints)
+
+    @staticmethod
+    def _file_prints(gtfs_dir):
+        return {f"gtfs/{name}": feed_diff.fingerprint(os.path.join(gtfs_dir, name))
+                for name in ("stops.txt", "stop_times.txt") if os.path.exists(os.path.join(gtfs_dir, name))}
+
+    def run(self):
+        started = time.time()
+        print(f"Refreshing region '{self.region.name}' from its feeds...")
+        prints = feed_diff.load_fingerprints(self.state_dir)
+        summary = {"region": self.region.name, "roads": None, "gtfs": None, "trips": [],
+                   "projections": [], "seconds": 0.0}
+
+        road = self.refresh_osm(prints)
+        points = None
+        if road is not None:
+            summary["roads"] = road["counts"]
+            points = road["points"]
+            self.save_roads(road["net"])
+            feed_diff.save_fingerprints(self.state_dir, prints)
+
+        gtfs = self.refresh_gtfs(prints, points)
+        if gtfs is not None:
+            summary["gtfs"] = gtfs["counts"]
+            summary["trips"] = gtfs["trips"]
+            feed_diff.save_fingerprints(self.state_dir, prints)
+
+        touched = set()
+        if road is not None:
+            touched.update(("road", "walk", "multimodal"))
+        if gtfs is not None and (gtfs["counts"]["stops"] or gtfs["counts"]["transfers"]):
+            touched.update(("walk", "multimodal"))
+        if gtfs is not None and gtfs["counts"]["stop_times"]:
+            touched.add("multimodal")
+        projections = ProjectionManager(region=self.region)
+        for name in projections.names:
+            if name in touched:
+                projections.project(name)
+                summary["projections"].append(name)
+
+        if road is not None:
+            CHBuilder(region=self.region).build()
+        summary["seconds"] = round(time.time() - started, 1)
+        if road is not None or gtfs is not None:
+            # Every serving worker attached to the store applies the summary on its next sync.
+            graph_store.bump_version(self.region.store_dir(), "data", summary=summary)
+        print(f"Refresh of region '{self.region.name}' done in {summary['seconds']}s: "
+              f"roads {summary['roads']}, gtfs {summary['gtfs']}.")
+        return summary
+
+    def refresh_osm(self, prints):
+        osm_file = self.region.osm_file
+        if osm_file:
+            digest = feed_diff.fingerprint(osm_file)
+            if prints.get("osm") == digest:
+                print("OSM extract unchanged.")
+                return None
+        loader = OSMLoader(pbf_path=osm_file, region=self.region)
+        network = loader.read_network()
+        if network is None:
+            return None
+        net = loader.build_network(*network)
+        new = feed_diff.network_arrays(net)
+        old = feed_diff.load_network(self.state_dir)
+        if old is None:
+            old = feed_diff.network_from_neo4j(self.db)
+
+        n_ins, n_chg, n_rem = feed_diff.diff(old["node_ids"], old["node_values"], new["node_ids"], new["node_values"])
+        s_ins, s_chg, s_rem = feed_diff.diff(old["seg_keys"], old["seg_values"], new["seg_keys"], new["seg_values"])
+        counts = {"nodes_inserted": len(n_ins), "nodes_changed": len(n_chg), "nodes_removed": len(n_rem),
+                  "segments_inserted": len(s_ins), "segments_changed": len(s_chg), "segments_removed": len(s_rem)}
+        if osm_file:
+            prints["osm"] = digest
+        if not any(counts.values()):
+            print("OSM network unchanged.")
+            return None
+
+        # Segments are rewritten per pair of end nodes, which also covers parallel roads between them.
+        touched = np.concatenate([s_ins, s_chg])
+        pair_u = np.concatenate([old["seg_u"][s_rem], new["seg_u"][touched]])
+        pair_v = np.concatenate([old["seg_v"][s_rem], new["seg_v"][touched]])
+        pairs = np.unique(feed_diff.hash_rows(pd.DataFrame({"u": pair_u, "v": pair_v})))
+        new_pairs = feed_diff.hash_rows(pd.DataFrame({"u": new["seg_u"], "v": new["seg_v"]}))
+        rewrite = np.flatnonzero(np.isin(new_pairs, pairs))
+
+        upsert = np.concatenate([n_ins, n_chg])
+        self._write("osm.nodes", """
+        UNWIND $batch AS data
+        MERGE (n:RoadNode {id: data.id})
+        SET n.lat = data.lat, n.lon = data.lon, n.location = point({latitude: data.lat, longitude: data.lon})
+        """, [{"id": str(i), "lat": la, "lon": lo} for i, la, lo in zip(
+            new["node_ids"][upsert].tolist(), new["lats"][upsert].tolist(), new["lons"][upsert].tolist())])
+        self._write("osm.segments", """
+        UNWIND $batch AS data
+        MATCH (u:RoadNode {id: data.u})-[r:ROAD_SEGMENT]-(v:RoadNode {id: data.v})
+        DELETE r
+        """, [{"u": str(u), "v": str(v)} for u, v in zip(pair_u.tolist(), pair_v.tolist())])
+        sink = OSMGraphSink(self.db, self.batch_size)
+        sink.segments(np.asarray(net["u"])[rewrite].astype(str), np.asarray(net["v"])[rewrite].astype(str),
+                      np.asarray(net["distance"])[rewrite], np.asarray(net["speed"])[rewrite],
+                      np.asarray(net["cost"])[rewrite], [net["fwd"][i] for i in rewrite.tolist()],
+                      [net["bwd"][i] for i in rewrite.tolist()])
+        self._write("osm.nodes", """
+        UNWIND $batch AS data
+        MATCH (n:RoadNode {id: data.id})
+        DETACH DELETE n
+        """, [{"id": str(i)} for i in old["node_ids"][n_rem].tolist()])
+        feed_diff.save_network(self.state_dir, net)
+
+        # Touched area: moved, added and removed nodes, and the ends of every rewritten segment.
+        ends = np.unique(np.concatenate([pair_u, pair_v]))
+        pos = np.minimum(np.searchsorted(new["node_ids"], ends), max(len(new["node_ids"]) - 1, 0))
+        ends = pos[new["node_ids"][pos] == ends] if len(new["node_ids"]) else pos[:0]
+        lats = np.concatenate([new["lats"][upsert], old["lats"][n_rem], old["lats"][n_chg], new["lats"][ends]])
+        lons = np.concatenate([new["lons"][upsert], old["lons"][n_rem], old["lons"][n_chg], new["lons"][ends]])
+        print(f"OSM diff applied: {counts}.")
+        return {"counts": counts, "points": (lats, lons), "net": net}
+
+    def save_roads(self, net):
+        # The road store is rebuilt from the new network in memory rather than read back from Neo4j.
+        ids = np.asarray(net["ids"])
+        u = np.searchsorted(ids, net["u"])
+        v = np.searchsorted(ids, net["v"])
+        graph = RoadGraph.from_edges(ids, net["lats"], net["lons"], np.concatenate([u, v]), np.concatenate([v, u]),
+                                     np.concatenate([net["cost"], net["cost"]]),
+                                     np.concatenate([net["distance"], net["distance"]]), net["fwd"] + net["bwd"])
+        graph.save(self.region.store_dir("road"))
+        SpatialIndex(graph.node_ids, graph.lats, graph.lons).save(self.region.store_dir("road_index"))
+
+    def refresh_gtfs(self, prints, points=None):
+        if not self.region.gtfs_url:
+            return None
+        loader = GTFSLoader(self.gtfs_dir, region=self.region)
+        gtfs_zip = os.path.join(self.data_dir, "gtfs.zip")
+        new_zip = gtfs_zip + ".new"
+        download(self.region.gtfs_url, new_zip)
+        digest = feed_diff.fingerprint(new_zip)
+        if prints.get("gtfs.zip") == digest:
+            os.remove(new_zip)
+            print("GTFS feed unchanged.")
+            if points is None:
+                return None
+            stops = loader.read_stops()
+            transfers = self.relink(loader, stops, stops.iloc[:0], points)
+            return {"counts": {"stops": 0, "stop_times": 0, "stop_times_removed": 0, "transfers": transfers},
+                    "trips": []}
+
+        new_dir = self.gtfs_dir + ".new"
+        shutil.rmtree(new_dir, ignore_errors=True)
+        with zipfile.ZipFile(new_zip, 'r') as zip_ref:
+            zip_ref.extractall(new_dir)
+        files = self._file_prints(new_dir)
+        if not os.path.exists(os.path.join(self.gtfs_dir, "stop_times.txt")):
+            # No previous version on disk to diff against: load everything through MERGE.
+            GTFSLoader(new_dir, region=self.region).load_gtfs()
+            counts, trips = {"stops": -1, "stop_times": -1, "stop_times_removed": 0, "transfers": -1}, []
+        else:
+            counts, trips = self._apply_gtfs(loader, new_dir, files, prints, points)
+
+        shutil.rmtree(self.gtfs_dir + ".old", ignore_errors=True)
+        if os.path.exists(self.gtfs_dir):
+            os.replace(self.gtfs_dir, self.gtfs_dir + ".old")
+        os.replace(new_dir, self.gtfs_dir)
+        shutil.rmtree(self.gtfs_dir + ".old", ignore_errors=True)
+        os.replace(new_zip, gtfs_zip)
+        prints.update(files)
+        prints["gtfs.zip"] = digest
+        if counts["stops"] or counts["stop_times"]:
+            TransitEngine.from_gtfs(self.gtfs_dir).save(self.region.store_dir("transit"))
+        return {"counts": counts, "trips": trips}
+
+    def _apply_gtfs(self, loader, new_dir, files, prints, points):
+        stops = loader.read_stops(new_dir)
+        stop_ins, stop_chg, stop_rem = np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64)
+        removed_stops = []
+        if files.get("gtfs/stops.txt") != prints.get("gtfs/stops.txt"):
+            old_stops = loader.read_stops(self.gtfs_dir)
+            stop_ins, stop_chg, stop_rem = feed_diff.diff(*self._stop_hashes(old_stops), *self._stop_hashes(stops))
+            removed_stops = old_stops["stop_id"].values[stop_rem].tolist()
+            upsert = stops.iloc[np.concatenate([stop_ins, stop_chg])]
+            loader.write_stops(upsert)
+            # Events carry their station's coordinates.
+            self._write("gtfs.stops", """
+            UNWIND $batch AS data
+            MATCH (s:Station {id: data.id})-[:HAS_EVENT]->(e:TripEvent)
+            SET e.lat = s.lat, e.lon = s.lon, e.location = s.location
+            """, [{"id": i} for i in stops["stop_id"].values[stop_chg].tolist()])
+
+        event_rows, removed_rows, trips = 0, 0, set()
+        if files.get("gtfs/stop_times.txt") != prints.get("gtfs/stop_times.txt"):
+            old_keys, old_values = self._stop_time_hashes(loader, self.gtfs_dir)
+            new_keys, new_values = self._stop_time_hashes(loader, new_dir)
+            ins, chg, rem = feed_diff.diff(old_keys, old_values, new_keys, new_values)
+            del old_keys, old_values, new_keys, new_values
+            positions = np.sort(np.concatenate([ins, chg]))
+            removed = self._rows(loader, self.gtfs_dir, rem)
+            written = self._rows(loader, new_dir, positions)
+            changed = written["event_id"].values[np.isin(positions, chg)].tolist()
+            # A changed row may have moved to another stop, so it is deleted and created again.
+            self._write("gtfs.stop_times", """
+            UNWIND $batch AS data
+            MATCH (e:TripEvent {id: data.event_id})
+            DETACH DELETE e
+            """, [{"event_id": e} for e in removed["event_id"].tolist() + changed])
+            records = written.to_dict("records")
+            loader.write_stop_times((records[i:i + loader.batch_size]
+                                     for i in range(0, len(records), loader.batch_size)), loader.create_event_query)
+            event_rows, removed_rows = len(ins) + len(chg) + len(rem), len(rem)
+            trips = set(removed["trip_id"].tolist()) | set(written["trip_id"].tolist())
+
+        if removed_stops:
+            self._write("gtfs.stops", """
+            UNWIND $batch AS data
+            MATCH (s:Station {id: data.id})
+            DETACH DELETE s
+            """, [{"id": i} for i in removed_stops])
+
+        relink = stops.iloc[np.concatenate([stop_ins, stop_chg])]
+        transfers = self.relink(loader, stops, relink, points)
+        counts = {"stops": len(stop_ins) + len(stop_chg) + len(stop_rem), "stop_times": event_rows,
+                  "stop_times_removed": removed_rows, "transfers": transfers}
+        print(f"GTFS diff applied: {counts}.")
+        return counts, sorted(trips)
+
+    def relink(self, loader, stops, relink, points):
+        # New and moved stops, plus every stop within the transfer radius of a touched road node.
+        if points is not None and len(points[0]) and len(stops):
+            index = SpatialIndex(np.arange(len(stops)), stops["stop_lat"].values, stops["stop_lon"].values)
+            near = set()
+            for lat, lon in zip(points[0].tolist(), points[1].tolist()):
+                near.update(index.within(lat, lon, self.transfer_radius)[0])
+            relink = pd.concat([relink, stops.iloc[sorted(near)]]).drop_duplicates("stop_id")
+        if not len(relink):
+            return 0
+        self._write("gtfs.transfers", """
+        UNWIND $batch AS data
+        MATCH (s:Station {id: data.id})-[r:WALK_TO]-()
+        DELETE r
+        """, [{"id": i} for i in relink["stop_id"].tolist()])
+        edges = loader.transfer_edges(relink, loader.road_index())
+        loader.write_transfers(edges, "CREATE")
+        return len(relink)
+
+    @staticmethod
+    def _stop_hashes(stops):
+        return (feed_diff.hash_rows(stops[["stop_id"]]),
+                feed_diff.hash_rows(stops[["stop_name", "stop_lat", "stop_lon"]]))
+
+    @staticmethod
+    def _stop_time_hashes(loader, gtfs_dir):
+        keys, values = [], []
+        for frame in loader.stop_time_frames(gtfs_dir):
+            keys.append(feed_diff.hash_rows(frame[["event_id"]]))
+            values.append(feed_diff.hash_rows(frame[["stop_id", "trip_id", "arr", "dep"]]))
+        if not keys:
+            return np.empty(0, np.uint64), np.empty(0, np.uint64)
+        return np.concatenate(keys), np.concatenate(values)
+
+    @staticmethod
+    def _rows(loader, gtfs_dir, positions):
+        # Rows at the given positions of the parsed stop_times, in position order, in one streaming pass.
+        positions = np.sort(positions)
+        frames, offset = [], 0
+        for frame in loader.stop_time_frames(gtfs_dir):
+            lo, hi = np.searchsorted(positions, [offset, offset + len(frame)])
+            if hi > lo:
+                frames.append(frame.iloc[positions[lo:hi] - offset])
+            offset += len(frame)
+        if not frames:
+            return pd.DataFrame(columns=["stop_id", "event_id", "trip_id", "arr", "dep"])
+        return pd.concat(frames, ignore_index=True)
+
+    def _write(self, stage, query, rows):
+        if rows:
+            stamp(self.db, STAMPS[stage])
+        for i in range(0, len(rows), self.batch_size):
+            batch = rows[i:i + self.batch_size]
+            with timed(stage, rows=len(batch)):
+                self.db.write(query, {"batch": batch})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply feed changes to a loaded region incrementally.")
+    parser.add_argument("--region", help="region name from REGIONS_FILE (default: the only/default region)")
+    args = parser.parse_args()
+    regions = {r.name: r for r in load_regions()}
+    region = regions[args.region] if args.region else next(iter(regions.values()))
+    FeedRefresher(region).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import numpy as np
+from backend.core import polyline
+
+
+def simplify(lats, lons, u, v, distance, cost):
+    # Contract chains of degree-2 shape points into single edges between intersections and dead ends.
+    # Segments are undirected; returns the kept-node mask and the compound edges with the shape
+    # points they replace, encoded from u to v and from v to u.
+    n, m = len(lats), len(u)
+    ends = np.concatenate([u, v])
+    order = np.argsort(ends, kind="stable")
+    offsets = np.searchsorted(ends[order], np.arange(n + 1))
+    incident = np.concatenate([np.arange(m), np.arange(m)])[order]
+    degree = np.diff(offsets)
+
+    keep = degree != 2
+    cand = np.flatnonzero(degree == 2)
+    e1, e2 = incident[offsets[cand]], incident[offsets[cand] + 1]
+    n1 = np.where(u[e1] == cand, v[e1], u[e1])
+    n2 = np.where(u[e2] == cand, v[e2], u[e2])
+    # Self-loops and the middle of a double edge must stay.
+    keep[cand[(n1 == n2) | (n1 == cand) | (n2 == cand)]] = True
+
+    us, vs, dists, costs = u.tolist(), v.tolist(), distance.tolist(), cost.tolist()
+    offs, inc, kept = offsets.tolist(), incident.tolist(), keep.tolist()
+    lat_list, lon_list = lats.tolist(), lons.tolist()
+    visited = [False] * m
+    out_u, out_v, out_d, out_c, fwd, bwd = [], [], [], [], [], []
+
+    def walk(start, e):
+        cur, d, c, shape = start, 0.0, 0.0, []
+        while True:
+            visited[e] = True
+            d += dists[e]
+            c += costs[e]
+            cur = vs[e] if us[e] == cur else us[e]
+            if kept[cur]:
+                break
+            shape.append([lat_list[cur], lon_list[cur]])
+            a = offs[cur]
+            e = inc[a + 1] if inc[a] == e else inc[a]
+        if cur == start:
+            return
+        out_u.append(start)
+        out_v.append(cur)
+        out_d.append(d)
+        out_c.append(c)
+        fwd.append(polyline.encode(shape) if shape else "")
+        bwd.append(polyline.encode(shape[::-1]) if shape else "")
+
+    for k in np.flatnonzero(keep).tolist():
+        for e in inc[offs[k]:offs[k + 1]]:
+            if not visited[e]:
+                walk(k, e)
+    # Whatever is left forms closed rings of shape points with no way in or out; they are dropped.
+    for e in range(m):
+        if not visited[e]:
+            kept[us[e]] = True
+            walk(us[e], e)
+
+    keep &= degree > 0
+    used = np.zeros(n, dtype=bool)
+    used[out_u] = True
+    used[out_v] = True
+    return (keep & used, np.asarray(out_u, dtype=np.int64), np.asarray(out_v, dtype=np.int64),
+            np.asarray(out_d), np.asarray(out_c), fwd, bwd)
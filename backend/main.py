@@ -1,12 +1,22 @@
-from fastapi import FastAPI
-from backend.core.routing import MultimodalRouter
-from backend.core.admin import AdminManager
-from backend.core.bootstrapper import Bootstrapper
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response, PlainTextResponse
+from backend.core import polyline
+from backend.core.projection import ProjectionUnavailable
+from backend.core import metrics
+from backend.core import tiles
+from backend.core.profiler import SamplingProfiler
+from backend.core.admin import AdminManager, BulkImport, body_format
+from backend.core import database
+from backend.core.region_manager import RegionManager, RegionUnavailable
+from backend.core.admission import AdmissionController, Overloaded, DeadlineExceeded, ClientDisconnected
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from typing import Optional
+from typing import Optional, List
 import os
+import json
+import time
+import asyncio
 
 app = FastAPI()
 
@@ -18,46 +28,327 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-router = MultimodalRouter()
+regions = RegionManager()
 admin = AdminManager()
+admission = AdmissionController()
 
 frontend_path = os.path.join(os.path.dirname(__file__), "..", "frontend")
 app.mount("/static", StaticFiles(directory=frontend_path), name="static")
 
 @app.on_event("startup")
 async def startup_event():
-    Bootstrapper().run()
+    # Only preloaded regions are ingested and loaded here; the rest load on their first request.
+    regions.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    regions.stop()
+    await database.close_async_drivers()
+    database.close_drivers()
+
+async def single_router():
+    # Endpoints that predate regions keep their response shape when only one region is configured.
+    if len(regions) == 1:
+        return await regions.router(next(iter(regions.regions)))
+    return None
 
 @app.get("/")
 async def read_index():
     from fastapi.responses import FileResponse
     return FileResponse(os.path.join(frontend_path, "index.html"))
 
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    # Server-Timing is opt-in: globally with SERVER_TIMING=1 or per request with "X-Server-Timing: 1".
+    wanted = SERVER_TIMING or request.headers.get("x-server-timing") == "1"
+    timings, token = metrics.start_request_timing() if wanted else (None, None)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        if token is not None:
+            metrics.stop_request_timing(token)
+    elapsed = time.perf_counter() - started
+    route = request.scope.get("route")
+    metrics.HTTP_SECONDS.observe(request.method, route.path if route else "unmatched", response.status_code,
+                                 value=elapsed)
+    if timings is not None:
+        timings.append(("total", elapsed))
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+def _numeric(name, stats):
+    return {(name, k): v for k, v in stats.items() if isinstance(v, (int, float))}
+
+def _cache_stats():
+    stats = {}
+    for name, router in regions.loaded().items():
+        stats.update(_numeric(name, router.cache.stats()))
+    return stats
+
+def _realtime_stats():
+    stats = {}
+    for name, feeder in regions.loaded_feeders().items():
+        stats.update(_numeric(name, feeder.stats()))
+    return stats
+
+def _tile_stats():
+    return {(name,): len(router.tiles.cache) for name, router in regions.loaded().items()}
+
+def _admission_stats():
+    return {(mode, k): v for mode, stats in admission.stats().items() for k, v in stats.items()}
+
+def _region_stats():
+    return {(k,): v for k, v in regions.stats().items() if isinstance(v, (int, float))}
+
+metrics.REGISTRY.register(metrics.Gauge("route_cache", "Route cache counters.", _cache_stats, ("region", "stat")))
+metrics.REGISTRY.register(metrics.Gauge("realtime_feed", "GTFS-RT feeder counters.", _realtime_stats,
+                                        ("region", "stat")))
+metrics.REGISTRY.register(metrics.Gauge("tile_cache_size", "Cached map tiles.", _tile_stats, ("region",)))
+metrics.REGISTRY.register(metrics.Gauge("regions", "Region loading counters.", _region_stats, ("stat",)))
+metrics.REGISTRY.register(metrics.Gauge("admission", "Admission control counters per mode.", _admission_stats,
+                                        ("mode", "stat")))
+
+@app.exception_handler(ProjectionUnavailable)
+async def projection_unavailable(request, exc):
+    return JSONResponse(status_code=503, headers={"Retry-After": "30"},
+                        content={"detail": f"Graph projection '{exc}' is being rebuilt, retry shortly."})
+
+@app.exception_handler(RegionUnavailable)
+async def region_unavailable(request, exc):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+@app.exception_handler(Overloaded)
+async def overloaded(request, exc):
+    return JSONResponse(status_code=503, headers={"Retry-After": str(exc.retry_after)}, content={"detail": str(exc)})
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request, exc):
+    return JSONResponse(status_code=504, content={"detail": str(exc)})
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request, exc):
+    # Nobody reads it; 499 keeps abandoned requests apart from errors in the latency histogram.
+    return Response(status_code=499)
+
+def admit(kind, request, work):
+    # Deadlines default to REQUEST_TIMEOUT; clients can ask for less with X-Request-Timeout (seconds).
+    return admission.run(kind, work, request, request.headers.get("x-request-timeout"))
+
 class RouteRequest(BaseModel):
     start_lat: float
     start_lon: float
     end_lat: float
     end_lon: float
     mode: Optional[str] = 'transit'
+    departure_time: Optional[int] = None
+    format: Optional[str] = 'coords'
+    battery_soc: Optional[float] = 0.8
+    battery_capacity_kwh: Optional[float] = 60.0
+    consumption_kwh_per_km: Optional[float] = 0.18
+
+def vehicle(req):
+    # Only EV routes depend on the battery; other modes share cache entries regardless of it.
+    if req.mode != 'ev':
+        return None
+    if not 0 <= req.battery_soc <= 1 or req.battery_capacity_kwh <= 0 or req.consumption_kwh_per_km <= 0:
+        raise HTTPException(status_code=400, detail="battery_soc must be in [0, 1]; capacity and consumption positive.")
+    return (req.battery_soc, req.battery_capacity_kwh, req.consumption_kwh_per_km)
 
 @app.post("/route")
-async def find_route(req: RouteRequest):
-    path = router.find_path(req.start_lat, req.start_lon, req.end_lat, req.end_lon, mode=req.mode)
+async def find_route(req: RouteRequest, request: Request):
+    router = await regions.router_for([(req.start_lat, req.start_lon), (req.end_lat, req.end_lon)])
+    battery = vehicle(req)
+    path = await admit(req.mode, request, lambda: router.find_path(
+        req.start_lat, req.start_lon, req.end_lat, req.end_lon,
+        mode=req.mode, departure_time=req.departure_time, vehicle=battery))
+    if req.format == 'polyline':
+        path = polyline.encode_route(path)
     return {"path": path}
 
+BATCH_MAX_ROUTES = int(os.getenv("BATCH_MAX_ROUTES", "100000"))
+
+@app.post("/route/batch")
+async def find_routes(reqs: List[RouteRequest], request: Request):
+    if len(reqs) > BATCH_MAX_ROUTES:
+        raise HTTPException(status_code=400, detail=f"Batch larger than {BATCH_MAX_ROUTES} routes.")
+    batch = [(r.start_lat, r.start_lon, r.end_lat, r.end_lon, r.mode, r.departure_time, vehicle(r)) for r in reqs]
+    requested = request.headers.get("x-request-timeout")
+
+    def admit_route(mode, work, timeout):
+        # Each route is admitted under its mode like a single /route; a shed route becomes an error line.
+        # The stream itself is cancelled on disconnect, so routes get no watcher of their own.
+        return admission.run(mode, work, None, requested if requested is not None else timeout)
+
+    async def lines():
+        async for i, path in regions.route_batch(batch, admit_route):
+            if reqs[i].format == 'polyline':
+                path = polyline.encode_route(path)
+            yield json.dumps({"index": i, "path": path}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+class MatrixRequest(BaseModel):
+    sources: List[List[float]]
+    targets: List[List[float]]
+    mode: Optional[str] = 'drive'
+    departure_time: Optional[int] = None
+
+MATRIX_MAX_CELLS = int(os.getenv("MATRIX_MAX_CELLS", "250000"))
+
+@app.post("/matrix")
+async def travel_matrix(req: MatrixRequest, request: Request):
+    if len(req.sources) * len(req.targets) > MATRIX_MAX_CELLS:
+        raise HTTPException(status_code=400, detail=f"Matrix larger than {MATRIX_MAX_CELLS} cells.")
+    router = await regions.router_for(req.sources + req.targets)
+    return await admit("matrix", request, lambda: router.matrix(req.sources, req.targets, mode=req.mode,
+                                                                  departure_time=req.departure_time))
+
+class IsochroneRequest(BaseModel):
+    lat: float
+    lon: float
+    minutes: List[float] = [10, 20, 30]
+    mode: Optional[str] = 'walk'
+    departure_time: Optional[int] = None
+
+ISOCHRONE_MAX_MINUTES = float(os.getenv("ISOCHRONE_MAX_MINUTES", "120"))
+
+@app.post("/isochrone")
+async def isochrone(req: IsochroneRequest, request: Request):
+    if not req.minutes or min(req.minutes) <= 0 or max(req.minutes) > ISOCHRONE_MAX_MINUTES:
+        raise HTTPException(status_code=400, detail=f"Minutes must be between 0 and {ISOCHRONE_MAX_MINUTES}.")
+    router = await regions.router_for([(req.lat, req.lon)])
+    if router.road_graph is None:
+        raise HTTPException(status_code=503, detail="Road graph not loaded.")
+    return await admit("isochrone", request, lambda: router.isochrone(req.lat, req.lon, req.minutes, mode=req.mode,
+                                                                       departure_time=req.departure_time))
+
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+profile_lock = asyncio.Lock()
+
+@app.get("/debug/profile")
+async def profile(seconds: float = 10.0, hz: int = 100):
+    # Samples every thread's stack for a while and returns collapsed stacks for a flame graph.
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler disabled, set PROFILER_ENABLED=1.")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running.")
+    async with profile_lock:
+        sampler = SamplingProfiler(hz=min(max(hz, 1), 1000)).start()
+        try:
+            await asyncio.sleep(min(max(seconds, 0.1), 120.0))
+        finally:
+            sampler.stop()
+    return PlainTextResponse(sampler.collapsed())
+
+@app.get("/regions")
+async def region_stats():
+    return regions.stats()
+
+@app.post("/admin/refresh")
+async def refresh_region(region: Optional[str] = None):
+    # Applies feed changes incrementally; other workers pick them up within REGION_SYNC_INTERVAL.
+    if region is None and len(regions) > 1:
+        raise HTTPException(status_code=400, detail="Name the region to refresh.")
+    name = region or next(iter(regions.regions))
+    if name not in regions.regions:
+        raise HTTPException(status_code=404, detail=f"Unknown region '{name}'.")
+    summary = await asyncio.to_thread(regions.refresh, name)
+    return {**summary, "trips": len(summary["trips"])}
+
+import_lock = asyncio.Lock()
+
+async def bulk_import(kind, request):
+    fmt = body_format(request.headers.get("content-type"))
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Send text/csv, application/x-ndjson or a JSON array.")
+    # One import at a time, so router updates never interleave.
+    async with import_lock:
+        return await BulkImport(kind, regions).run(request.stream(), fmt)
+
+@app.post("/admin/ev-points")
+async def import_ev_points(request: Request):
+    return await bulk_import("ev_points", request)
+
+@app.post("/admin/bike-hubs")
+async def import_bike_hubs(request: Request):
+    return await bulk_import("bike_hubs", request)
+
+@app.get("/admission/stats")
+async def admission_stats():
+    return admission.stats()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    router = await single_router()
+    if router is not None:
+        return router.cache.stats()
+    return {name: router.cache.stats() for name, router in regions.loaded().items()}
+
+def _feeder_stats(feeder):
+    return {"enabled": True, **feeder.stats()} if feeder is not None else {"enabled": False}
+
+@app.get("/realtime/stats")
+async def realtime_stats():
+    feeders = regions.loaded_feeders()
+    if len(regions) == 1:
+        return _feeder_stats(next(iter(feeders.values()), None))
+    return {name: _feeder_stats(feeders.get(name)) for name in regions.loaded()}
+
 @app.get("/bounds")
 async def get_bounds():
-    bounds = router.get_graph_bounds()
+    router = await single_router()
+    bounds = await router.get_graph_bounds() if router is not None else regions.index.bounds()
     return {"bounds": bounds}
 
 @app.get("/stations")
 async def get_stations():
-    return {"stations": router.get_all_stations()}
+    # Stations and chargers of the loaded regions; the map itself reads them as tiles.
+    return {"stations": [s for router in regions.loaded().values() for s in await router.get_all_stations()]}
 
 @app.get("/evs")
 async def get_evs():
-    return {"evs": router.get_all_evs()}
+    return {"evs": [e for router in regions.loaded().values() for e in await router.get_all_evs()]}
+
+TILE_MAX_AGE = int(os.getenv("TILE_MAX_AGE", "300"))
+
+@app.get("/tiles/{layer}/{z}/{x}/{y}")
+async def get_tile(layer: str, z: int, x: int, y: int, request: Request):
+    if z < 0 or z > 22 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Tile out of range.")
+    if layer not in tiles.MIN_ZOOM:
+        raise HTTPException(status_code=404, detail=f"Unknown tile layer '{layer}'.")
+    # Tiles below the layer's zoom range are empty and must not pull regions in.
+    covering = regions.index.intersecting(*tiles.tile_bounds(z, x, y)) if z >= tiles.MIN_ZOOM[layer] else []
+    # A region without the layer (no road graph loaded, say) contributes nothing to it.
+    if len(covering) == 1:
+        router = await regions.router(covering[0].name)
+        value = router.tiles.tile(layer, z, x, y)
+        if value is None:
+            raise HTTPException(status_code=404, detail=f"Layer '{layer}' is not available here.")
+        body, etag = value
+    else:
+        features, served = [], not covering
+        for region in covering:
+            router = await regions.router(region.name)
+            found = router.tiles.features(layer, z, x, y)
+            if found is not None:
+                features += found
+                served = True
+        if not served:
+            raise HTTPException(status_code=404, detail=f"Layer '{layer}' is not available here.")
+        body, etag = tiles.encode(layer, z, x, y, features)
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={TILE_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,58 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from backend.core.routing import MultimodalRouter
+from benchmarks.report import percentiles
+
+
+async def run():
+    parser = argparse.ArgumentParser(description="Compare CH queries against the GDS A* path.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--mode", choices=["drive", "walk"], default="drive")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    router = MultimodalRouter()
+    router.load_hierarchies()
+    graph = router.road_graph
+    if graph is None or args.mode not in router.hierarchies:
+        raise SystemExit("Contraction hierarchies are missing, run python -m backend.ingestion.ch_builder first.")
+    ch = router.hierarchies[args.mode]
+
+    rng = random.Random(args.seed)
+    pairs = [(rng.randrange(len(graph)), rng.randrange(len(graph))) for _ in range(args.queries)]
+
+    ch_times, gds_times, mismatches = [], [], 0
+    for s, t in pairs:
+        started = time.perf_counter()
+        res = ch.query(s, t)
+        ch_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        gds = await router.gds_path(str(graph.node_ids[s]), str(graph.node_ids[t]), args.mode)
+        gds_times.append(time.perf_counter() - started)
+
+        # GDS only optimises the drive cost, so compare totals for that profile only.
+        if args.mode == 'drive' and res is not None and gds["totalCost"] >= 0:
+            if abs(res[0] - gds["totalCost"]) > 1e-3 * max(1.0, gds["totalCost"]):
+                mismatches += 1
+
+    report = {
+        "mode": args.mode,
+        "queries": args.queries,
+        "nodes": len(graph),
+        "ch": percentiles(ch_times),
+        "gds": percentiles(gds_times),
+        "cost_mismatches": mismatches,
+    }
+    print(json.dumps(report, indent=2))
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
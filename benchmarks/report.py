@@ -0,0 +1,47 @@
+import json
+import resource
+import numpy as np
+
+
+def percentiles(samples):
+    ms = np.asarray(samples) * 1000.0
+    if not len(ms):
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None}
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def compare(report, baseline, tolerance=0.1):
+    # Flags every latency that grew, and every rate that shrank, by more than the tolerance.
+    regressions = []
+
+    def walk(new, old, path):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            name = f"{path}.{key}" if path else key
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                walk(value, old[key], name)
+            elif isinstance(value, (int, float)) and isinstance(old[key], (int, float)) and old[key] > 0:
+                ratio = value / old[key]
+                if (key.endswith("_ms") and ratio > 1 + tolerance) or \
+                        (key.endswith("_per_s") or key.endswith("_qps")) and ratio < 1 - tolerance:
+                    regressions.append({"metric": name, "baseline": old[key], "current": value,
+                                        "change": round(ratio - 1, 3)})
+
+    walk(report, baseline, "")
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import requests
+from backend.core import graph_store
+from backend.core.ch import ContractionHierarchy
+from backend.core.road_graph import RoadGraph
+from backend.core.routing import MultimodalRouter
+from backend.core.spatial import SpatialIndex
+from backend.core.transit import TransitEngine
+from backend.ingestion.gtfs_loader import GTFSLoader
+from backend.ingestion.osm_loader import OSMLoader
+from benchmarks import synthetic
+from benchmarks.report import percentiles, peak_rss_mb, compare, load
+
+MODES = ("drive", "walk", "transit")
+
+
+def rate(rows, seconds):
+    return round(rows / max(seconds, 1e-9), 1)
+
+
+def ingest(city, work, report, neo4j=False):
+    csv_dir = os.path.join(work, "csv")
+    started = time.perf_counter()
+    nodes, segments = OSMLoader(csv_dir=csv_dir).write_network(city["ids"], city["lats"], city["lons"],
+                                                                iter(city["ways"]))
+    elapsed = time.perf_counter() - started
+    report["ingestion"]["osm"] = {"nodes": nodes, "segments": segments, "seconds": round(elapsed, 3),
+                                  "rows_per_s": rate(nodes + 2 * segments, elapsed)}
+
+    gtfs_dir = os.path.join(work, "gtfs")
+    loader = GTFSLoader(gtfs_dir)
+    started = time.perf_counter()
+    rows = sum(len(batch) for batch in loader.read_stop_times())
+    elapsed = time.perf_counter() - started
+    report["ingestion"]["gtfs_stop_times"] = {"rows": rows, "seconds": round(elapsed, 3),
+                                              "rows_per_s": rate(rows, elapsed)}
+
+    if neo4j:
+        # Same loaders against a live (empty) database, as the bootstrapper runs them.
+        started = time.perf_counter()
+        OSMLoader().write_network(city["ids"], city["lats"], city["lons"], iter(city["ways"]))
+        elapsed = time.perf_counter() - started
+        report["ingestion"]["osm_neo4j"] = {"seconds": round(elapsed, 3),
+                                            "rows_per_s": rate(nodes + 2 * segments, elapsed)}
+        started = time.perf_counter()
+        loader.load_gtfs()
+        elapsed = time.perf_counter() - started
+        report["ingestion"]["gtfs_neo4j"] = {"seconds": round(elapsed, 3), "rows_per_s": rate(rows, elapsed)}
+    return csv_dir, gtfs_dir
+
+
+def build(csv_dir, gtfs_dir, report, hierarchies=True):
+    # Builds the graph store the API serves from, reading back the loader's own CSV output.
+    started = time.perf_counter()
+    nodes = pd.read_csv(os.path.join(csv_dir, "road_nodes.csv"), usecols=[0, 1, 2],
+                        dtype={"id:ID(RoadNode)": str})
+    nodes.columns = ["id", "lat", "lon"]
+    edges = pd.read_csv(os.path.join(csv_dir, "road_segments.csv"), usecols=[0, 1, 2, 4, 5],
+                        dtype={":START_ID(RoadNode)": str, ":END_ID(RoadNode)": str, "geometry": str},
+                        keep_default_na=False)
+    edges.columns = ["u", "v", "distance", "cost", "geometry"]
+    index = pd.Series(np.arange(len(nodes)), index=nodes["id"].values)
+    graph = RoadGraph.from_edges(nodes["id"].values, nodes["lat"].values, nodes["lon"].values,
+                                 index[edges["u"].values].values, index[edges["v"].values].values,
+                                 edges["cost"].values, edges["distance"].values, edges["geometry"].tolist())
+    graph.save(graph_store.store_dir("road"))
+    SpatialIndex(graph.node_ids, graph.lats, graph.lons).save(graph_store.store_dir("road_index"))
+    report["build"]["road_graph_s"] = round(time.perf_counter() - started, 3)
+
+    if hierarchies:
+        for profile in ("drive", "walk"):
+            started = time.perf_counter()
+            ContractionHierarchy.from_graph(graph, profile).save(graph_store.store_dir(f"ch_{profile}"))
+            report["build"][f"ch_{profile}_s"] = round(time.perf_counter() - started, 3)
+
+    started = time.perf_counter()
+    TransitEngine.from_gtfs(gtfs_dir).save(graph_store.store_dir("transit"))
+    report["build"]["transit_s"] = round(time.perf_counter() - started, 3)
+
+
+def summarize(latencies, failures, elapsed):
+    return {**percentiles(latencies), "queries": len(latencies), "failures": failures,
+            "throughput_qps": rate(len(latencies), elapsed)}
+
+
+async def replay(pairs, modes, report, departure_time):
+    router = MultimodalRouter()
+    router.road_index = SpatialIndex.load(graph_store.store_dir("road_index"))
+    router.load_transit()
+    router.load_hierarchies()
+
+    for mode in modes:
+        # Cold: every OD pair is computed. Batch: the same pairs through the batch pipeline.
+        router.cache.clear()
+        latencies, failures = [], 0
+        started = time.perf_counter()
+        for start_lat, start_lon, end_lat, end_lon in pairs:
+            t0 = time.perf_counter()
+            path = await router.find_path(start_lat, start_lon, end_lat, end_lon, mode=mode,
+                                          departure_time=departure_time)
+            latencies.append(time.perf_counter() - t0)
+            failures += path["totalCost"] < 0
+        report["router"][mode] = summarize(latencies, failures, time.perf_counter() - started)
+
+        router.cache.clear()
+        started = time.perf_counter()
+        count = 0
+        async for _ in router.route_batch([p + (mode, departure_time) for p in pairs]):
+            count += 1
+        report["router"][mode]["batch_qps"] = rate(count, time.perf_counter() - started)
+
+
+def replay_api(url, pairs, modes, report, departure_time, concurrency):
+    session = requests.Session()
+
+    def call(body):
+        t0 = time.perf_counter()
+        try:
+            response = session.post(f"{url}/route", json=body, timeout=60)
+            ok = response.status_code == 200 and response.json()["path"]["totalCost"] >= 0
+        except Exception:
+            ok = False
+        return time.perf_counter() - t0, ok
+
+    for mode in modes:
+        bodies = [{"start_lat": a, "start_lon": b, "end_lat": c, "end_lon": d, "mode": mode,
+                   "departure_time": departure_time} for a, b, c, d in pairs]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(call, bodies))
+        report["api"][mode] = summarize([r[0] for r in results], sum(not r[1] for r in results),
+                                        time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic end-to-end routing benchmark.")
+    parser.add_argument("--nodes", type=int, default=10000, help="road nodes in the synthetic grid")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--headway", type=int, default=600, help="seconds between trips on each line")
+    parser.add_argument("--departure-time", type=int, default=8 * 3600)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-ch", action="store_true", help="skip contraction hierarchies (A* instead)")
+    parser.add_argument("--neo4j", action="store_true", help="also run the loaders against Neo4j")
+    parser.add_argument("--api", help="base URL of a running server to replay POST /route against")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--work-dir", help="keep generated data here instead of a temp directory")
+    parser.add_argument("--out", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    work = args.work_dir or tempfile.mkdtemp(prefix="routing-bench-")
+    os.environ["GRAPH_STORE_DIR"] = os.path.join(work, "graph")
+    modes = [m for m in args.modes.split(",") if m]
+    report = {"config": vars(args), "generate": {}, "ingestion": {}, "build": {}, "router": {}, "api": {}}
+
+    try:
+        started = time.perf_counter()
+        city = synthetic.road_grid(args.nodes, seed=args.seed)
+        stop_times = synthetic.gtfs_feed(os.path.join(work, "gtfs"), city, headway=args.headway)
+        pairs = synthetic.od_pairs(city, args.queries, seed=args.seed)
+        report["generate"] = {"nodes": len(city["ids"]), "ways": len(city["ways"]), "stop_times": stop_times,
+                              "seconds": round(time.perf_counter() - started, 3)}
+
+        csv_dir, gtfs_dir = ingest(city, work, report, neo4j=args.neo4j)
+        build(csv_dir, gtfs_dir, report, hierarchies=not args.no_ch)
+        asyncio.run(replay(pairs, modes, report, args.departure_time))
+        if args.api:
+            replay_api(args.api.rstrip("/"), pairs, modes, report, args.departure_time, args.concurrency)
+        report["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    if args.baseline:
+        report["regressions"] = compare(report, load(args.baseline), args.tolerance)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
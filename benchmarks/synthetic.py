@@ -0,0 +1,142 @@
+import os
+import math
+import numpy as np
+import pandas as pd
+
+ORIGIN = (17.385, 78.486)
+METERS_PER_DEGREE = 111320.0
+
+
+def road_grid(nodes, spacing=100.0, drop=0.03, seed=42, origin=ORIGIN):
+    # Jittered street grid with one shape point between neighbouring intersections, so node count
+    # is about 3 * side^2. Every tenth street is primary; a few blocks are cut to break symmetry.
+    rng = np.random.default_rng(seed)
+    side = max(2, int(round(math.sqrt(nodes / 3.0))))
+    dlat = spacing / METERS_PER_DEGREE
+    dlon = spacing / (METERS_PER_DEGREE * math.cos(math.radians(origin[0])))
+    jitter = 0.1
+
+    rows, cols = np.mgrid[0:side, 0:side]
+    i_lat = origin[0] + (rows + rng.uniform(-jitter, jitter, rows.shape)) * dlat
+    i_lon = origin[1] + (cols + rng.uniform(-jitter, jitter, cols.shape)) * dlon
+    h_lat = (i_lat[:, :-1] + i_lat[:, 1:]) / 2 + rng.uniform(-jitter, jitter, (side, side - 1)) * dlat
+    h_lon = (i_lon[:, :-1] + i_lon[:, 1:]) / 2
+    v_lat = (i_lat[:-1, :] + i_lat[1:, :]) / 2
+    v_lon = (i_lon[:-1, :] + i_lon[1:, :]) / 2 + rng.uniform(-jitter, jitter, (side - 1, side)) * dlon
+
+    intersections = np.arange(side * side, dtype=np.int64).reshape(side, side)
+    h_ids = side * side + np.arange(side * (side - 1), dtype=np.int64).reshape(side, side - 1)
+    v_ids = side * side + side * (side - 1) + np.arange((side - 1) * side, dtype=np.int64).reshape(side - 1, side)
+    lats = np.concatenate([i_lat.ravel(), h_lat.ravel(), v_lat.ravel()])
+    lons = np.concatenate([i_lon.ravel(), h_lon.ravel(), v_lon.ravel()])
+
+    ways = []
+    for k in range(side):
+        highway = "primary" if k % 10 == 0 else "residential"
+        for refs in (_street(intersections[k, :], h_ids[k, :]), _street(intersections[:, k], v_ids[:, k])):
+            # Cutting block b removes refs[2b:2b+3] links, so split the street around it.
+            cuts = np.flatnonzero(rng.random(side - 1) < drop)
+            start = 0
+            for b in cuts.tolist():
+                if 2 * b + 1 - start >= 2:
+                    ways.append((refs[start:2 * b + 1], {"highway": highway}))
+                start = 2 * b + 2
+            if len(refs) - start >= 2:
+                ways.append((refs[start:], {"highway": highway}))
+
+    return {
+        "ids": np.arange(len(lats), dtype=np.int64),
+        "lats": lats,
+        "lons": lons,
+        "ways": ways,
+        "intersections": intersections,
+        "spacing": spacing,
+    }
+
+
+def _street(corners, shapes):
+    refs = np.empty(2 * len(corners) - 1, dtype=np.int64)
+    refs[0::2] = corners
+    refs[1::2] = shapes
+    return refs
+
+
+def gtfs_feed(directory, city, line_every=8, stop_every=4, headway=600, start=5 * 3600, end=23 * 3600,
+              speed=8.0, dwell=20, timezone="Asia/Kolkata"):
+    # Bus lines run both ways along every line_every-th street, stopping at every stop_every-th
+    # corner; lines that cross share the corner stop. Returns the number of stop_times rows.
+    os.makedirs(directory, exist_ok=True)
+    grid = city["intersections"]
+    side = len(grid)
+    lats, lons = city["lats"], city["lons"]
+    streets = [grid[k, ::stop_every] for k in range(line_every // 2, side, line_every)] + \
+              [grid[::stop_every, k] for k in range(line_every // 2, side, line_every)]
+    streets = [s for s in streets if len(s) >= 2]
+
+    lines = [s for street in streets for s in (street, street[::-1])]
+    departures = np.arange(start, end, headway, dtype=np.int64)
+    trip_frames, trips = [], []
+    for n, stops in enumerate(lines):
+        hop = city["spacing"] * stop_every / speed + dwell
+        offsets = np.concatenate([[0], np.cumsum(np.full(len(stops) - 1, hop))]).astype(np.int64)
+        arrival = departures[:, None] + offsets[None, :]
+        trip_ids = np.char.add(f"T{n}_", departures.astype(str))
+        trip_frames.append(pd.DataFrame({
+            "trip_id": np.repeat(trip_ids, len(stops)),
+            "arr": arrival.ravel(),
+            "dep": arrival.ravel() + np.tile(np.where(np.arange(len(stops)) < len(stops) - 1, dwell, 0),
+                                             len(departures)),
+            "stop_id": np.tile(np.char.add("S", stops.astype(str)), len(departures)),
+            "stop_sequence": np.tile(np.arange(1, len(stops) + 1), len(departures)),
+        }))
+        trips.append(pd.DataFrame({"route_id": f"R{n}", "service_id": "ALL", "trip_id": trip_ids}))
+
+    stop_nodes = np.unique(np.concatenate(lines)) if lines else np.empty(0, np.int64)
+    pd.DataFrame({
+        "stop_id": np.char.add("S", stop_nodes.astype(str)),
+        "stop_name": np.char.add("Stop ", stop_nodes.astype(str)),
+        "stop_lat": lats[stop_nodes].round(6),
+        "stop_lon": lons[stop_nodes].round(6),
+    }).to_csv(os.path.join(directory, "stops.txt"), index=False)
+    pd.DataFrame({"agency_id": ["SYN"], "agency_name": ["Synthetic Transit"],
+                  "agency_url": ["http://example.com"], "agency_timezone": [timezone]}) \
+        .to_csv(os.path.join(directory, "agency.txt"), index=False)
+    pd.DataFrame({"route_id": [f"R{n}" for n in range(len(lines))], "agency_id": "SYN",
+                  "route_short_name": [str(n) for n in range(len(lines))], "route_type": 3}) \
+        .to_csv(os.path.join(directory, "routes.txt"), index=False)
+    pd.DataFrame({"service_id": ["ALL"], "monday": [1], "tuesday": [1], "wednesday": [1], "thursday": [1],
+                  "friday": [1], "saturday": [1], "sunday": [1], "start_date": ["20240101"],
+                  "end_date": ["20991231"]}).to_csv(os.path.join(directory, "calendar.txt"), index=False)
+    if trips:
+        pd.concat(trips).to_csv(os.path.join(directory, "trips.txt"), index=False)
+
+    rows = 0
+    path = os.path.join(directory, "stop_times.txt")
+    with open(path, "w") as f:
+        f.write("trip_id,arrival_time,departure_time,stop_id,stop_sequence\n")
+        for frame in trip_frames:
+            pd.DataFrame({
+                "trip_id": frame["trip_id"],
+                "arrival_time": _clock(frame["arr"]),
+                "departure_time": _clock(frame["dep"]),
+                "stop_id": frame["stop_id"],
+                "stop_sequence": frame["stop_sequence"],
+            }).to_csv(f, index=False, header=False)
+            rows += len(frame)
+    return rows
+
+
+def _clock(seconds):
+    seconds = pd.Series(seconds)
+    return ((seconds // 3600).astype(str).str.zfill(2) + ":" +
+            (seconds // 60 % 60).astype(str).str.zfill(2) + ":" +
+            (seconds % 60).astype(str).str.zfill(2))
+
+
+def od_pairs(city, count, seed=7):
+    # Fixed origin-destination points inside the grid's bounding box.
+    rng = np.random.default_rng(seed)
+    lats, lons = city["lats"], city["lons"]
+    lat = rng.uniform(lats.min(), lats.max(), (count, 2))
+    lon = rng.uniform(lons.min(), lons.max(), (count, 2))
+    return [(float(a), float(b), float(c), float(d)) for (a, c), (b, d) in zip(lat, lon)]
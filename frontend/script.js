@@ -69,33 +69,66 @@ fetch(`${API_URL}/bounds`)
     })
     .catch(err => console.error(err));
 
-fetch(`${API_URL}/stations`)
-    .then(res => res.json())
-    .then(data => {
-        if (data.stations) {
-            data.stations.forEach(st => {
-                L.marker([st.lat, st.lon], { icon: createStationIcon() })
-                    .addTo(map)
-                    .bindPopup(`<b>${st.name}</b><br>Transit Station`);
-            });
-            if (window.lucide) lucide.createIcons();
-        }
-    })
-    .catch(err => console.error(err));
+// Stations and EV points are loaded per map tile, only for the tiles in view.
+const TILE_LAYERS = {
+    stations: feature => L.marker([feature[0], feature[1]], { icon: createStationIcon() })
+        .bindPopup(`<b>${feature[2]}</b><br>Transit Station`),
+    evs: feature => L.marker([feature[0], feature[1]], { icon: createEVIcon() })
+        .bindPopup(`<b>EV Charging Station</b><br>Type: ${feature[2] || 'Standard'}`)
+};
+const TILE_MIN_ZOOM = 10;
+const TILE_MAX_ZOOM = 14;
+const TILE_MAX_COUNT = 64;
+const loadedTiles = new Map();
 
-fetch(`${API_URL}/evs`)
-    .then(res => res.json())
-    .then(data => {
-        if (data.evs) {
-            data.evs.forEach(ev => {
-                L.marker([ev.lat, ev.lon], { icon: createEVIcon() })
-                    .addTo(map)
-                    .bindPopup(`<b>EV Charging Station</b><br>Type: ${ev.type || 'Standard'}`);
+function tileRange(bounds, z) {
+    const n = 2 ** z;
+    const x = lon => Math.min(n - 1, Math.max(0, Math.floor((lon + 180) / 360 * n)));
+    const y = lat => {
+        const r = lat * Math.PI / 180;
+        return Math.min(n - 1, Math.max(0, Math.floor((1 - Math.asinh(Math.tan(r)) / Math.PI) / 2 * n)));
+    };
+    return [x(bounds.getWest()), x(bounds.getEast()), y(bounds.getNorth()), y(bounds.getSouth())];
+}
+
+function loadVisibleTiles() {
+    const z = Math.min(TILE_MAX_ZOOM, Math.max(TILE_MIN_ZOOM, Math.floor(map.getZoom())));
+    const [x0, x1, y0, y1] = tileRange(map.getBounds(), z);
+    if ((x1 - x0 + 1) * (y1 - y0 + 1) > TILE_MAX_COUNT) return;
+
+    const visible = new Set();
+    for (let x = x0; x <= x1; x++) {
+        for (let y = y0; y <= y1; y++) {
+            Object.keys(TILE_LAYERS).forEach(layer => {
+                const key = `${layer}/${z}/${x}/${y}`;
+                visible.add(key);
+                if (loadedTiles.has(key)) return;
+                const group = L.layerGroup().addTo(map);
+                loadedTiles.set(key, group);
+                fetch(`${API_URL}/tiles/${key}`)
+                    .then(res => res.json())
+                    .then(data => {
+                        (data.features || []).forEach(f => TILE_LAYERS[layer](f).addTo(group));
+                        if (window.lucide) lucide.createIcons();
+                    })
+                    .catch(err => {
+                        loadedTiles.delete(key);
+                        map.removeLayer(group);
+                        console.error(err);
+                    });
             });
-            if (window.lucide) lucide.createIcons();
         }
-    })
-    .catch(err => console.error(err));
+    }
+    loadedTiles.forEach((group, key) => {
+        if (!visible.has(key)) {
+            map.removeLayer(group);
+            loadedTiles.delete(key);
+        }
+    });
+}
+
+map.on('moveend', loadVisibleTiles);
+map.whenReady(loadVisibleTiles);
 
 const startDisplay = document.getElementById('start-coord');
 const endDisplay = document.getElementById('end-coord');